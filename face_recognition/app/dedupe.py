@@ -0,0 +1,80 @@
+"""Offline search for faces enrolled under more than one principal.
+
+Compares every stored template against every other one with blocked matrix
+multiplies, so memory stays at one block x block similarity tile on top of
+the embeddings themselves, and groups matches into clusters.
+
+    python dedupe.py [--threshold 0.7] [--block 4096] [--version Facenet/opencv]
+"""
+import argparse
+import json
+
+import numpy as np
+
+from store import CURRENT_VERSION, EMBEDDINGS_PATH, FaceStore
+
+
+class DisjointSet:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def find_duplicate_clusters(ids, matrix, threshold, block=4096):
+    """Clusters of principals whose templates are at least `threshold` cosine-similar.
+
+    `matrix` rows must be unit-normalized. Only the upper triangle of the
+    similarity matrix is computed, one (block x block) tile at a time.
+    """
+    count = len(ids)
+    groups = DisjointSet(count)
+    best = {}
+    for row_start in range(0, count, block):
+        rows = matrix[row_start:row_start + block]
+        for col_start in range(row_start, count, block):
+            tile = rows @ matrix[col_start:col_start + block].T
+            if col_start == row_start:
+                # Same block on both sides: keep pairs above the diagonal only
+                tile = np.triu(tile, k=1)
+            for i, j in zip(*np.nonzero(tile >= threshold)):
+                a, b = row_start + i, col_start + j
+                groups.union(a, b)
+                best[(a, b)] = float(tile[i, j])
+
+    clusters = {}
+    for (a, b), similarity in best.items():
+        members, top = clusters.get(groups.find(a), (set(), 0.0))
+        members.update((a, b))
+        clusters[groups.find(a)] = (members, max(top, similarity))
+    result = [
+        {"principals": sorted(ids[member] for member in members), "max_similarity": round(top, 4)}
+        for members, top in clusters.values()
+    ]
+    return sorted(result, key=lambda cluster: -cluster["max_similarity"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate face enrollments")
+    parser.add_argument("--path", default=EMBEDDINGS_PATH)
+    parser.add_argument("--version", default=CURRENT_VERSION)
+    parser.add_argument("--threshold", type=float, default=0.7)
+    parser.add_argument("--block", type=int, default=4096)
+    args = parser.parse_args()
+
+    ids, matrix = FaceStore(args.path).load().matrix(args.version)
+    clusters = find_duplicate_clusters(ids, matrix, args.threshold, args.block)
+    print(json.dumps({"version": args.version, "templates": len(ids), "clusters": clusters}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.responses import JSONResponse
+
+# CPU-bound face work (decode, liveness, embedding) runs on this many threads
+FACE_WORKERS = int(os.environ.get("FACE_WORKERS", "2"))
+# Default and upper bound (seconds) for how long a single face job may take,
+# clients can ask for a shorter one with the X-Request-Timeout header
+FACE_JOB_DEADLINE = float(os.environ.get("FACE_JOB_DEADLINE", "20"))
+FACE_JOB_MAX_DEADLINE = float(os.environ.get("FACE_JOB_MAX_DEADLINE", "60"))
+# Requests allowed to wait for a worker on top of the ones being processed,
+# anything beyond that is turned away before its upload is read
+FACE_QUEUE_DEPTH = int(os.environ.get("FACE_QUEUE_DEPTH", "8"))
+FACE_MAX_UPLOAD_BYTES = int(os.environ.get("FACE_MAX_UPLOAD_BYTES", str(5 * 1024 * 1024)))
+# Assumed job duration (seconds) until real stage timings have been observed
+DEFAULT_JOB_SECONDS = 1.0
+# Number of recent queue waits kept for the percentiles in /stats
+WAIT_SAMPLES = 256
+# How often a waiting request checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = 0.1
+# Smoothing factor for the per-stage duration averages
+STAGE_EWMA_ALPHA = 0.2
+
+
+class JobCancelled(Exception):
+    def __init__(self, reason, stage=None):
+        super().__init__(f"Face job cancelled ({reason})")
+        self.reason = reason
+        self.stage = stage
+
+
+class FaceJob:
+    """One face request moving through a fixed list of stages on a worker."""
+
+    def __init__(self, kind, stages, deadline, stats):
+        self.kind = kind
+        self.stages = stages
+        self.deadline = deadline
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.stage = None
+        self.cancel_reason = None
+        self._stats = stats
+        self._stage_started = None
+
+    def cancel(self, reason):
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+
+    def remaining_stages(self):
+        if self.stage is None:
+            return self.stages
+        return self.stages[self.stages.index(self.stage):]
+
+    def check(self):
+        """Raise JobCancelled if the job was abandoned, without entering a new stage.
+
+        For the last moment before a side effect the client must not get
+        once it has left, e.g. committing an enrollment.
+        """
+        if self.cancel_reason is None and time.monotonic() >= self.deadline:
+            self.cancel_reason = "deadline"
+        if self.cancel_reason is not None:
+            raise JobCancelled(self.cancel_reason, self.stage)
+
+    def checkpoint(self, stage):
+        """Close the previous stage and enter `stage`, unless the job was abandoned."""
+        now = time.monotonic()
+        if self.stage is not None:
+            self._stats.observe_stage(self.kind, self.stage, now - self._stage_started)
+        if self.cancel_reason is None and now >= self.deadline:
+            self.cancel_reason = "deadline"
+        self.stage = stage
+        self._stage_started = now
+        if self.cancel_reason is not None:
+            raise JobCancelled(self.cancel_reason, stage)
+
+    def finish(self):
+        if self.stage is not None:
+            self._stats.observe_stage(self.kind, self.stage, time.monotonic() - self._stage_started)
+        self.stage = None
+
+
+class JobStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled_queued = 0
+        self.cancelled_running = 0
+        self.cancel_reasons = {}
+        self.stages_skipped = 0
+        self.seconds_saved = 0.0
+        self.stage_seconds = {}
+        self.rejected = {}
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    def observe_stage(self, kind, stage, seconds):
+        with self._lock:
+            per_kind = self.stage_seconds.setdefault(kind, {})
+            previous = per_kind.get(stage)
+            if previous is None:
+                per_kind[stage] = seconds
+            else:
+                per_kind[stage] = previous + STAGE_EWMA_ALPHA * (seconds - previous)
+
+    def observe_wait(self, seconds):
+        with self._lock:
+            self.waits.append(seconds)
+
+    def record_rejected(self, status):
+        with self._lock:
+            self.rejected[status] = self.rejected.get(status, 0) + 1
+
+    def job_seconds(self):
+        """Average end-to-end worker time of a job, across job kinds."""
+        with self._lock:
+            totals = [sum(stages.values()) for stages in self.stage_seconds.values() if stages]
+        if not totals:
+            return DEFAULT_JOB_SECONDS
+        return sum(totals) / len(totals)
+
+    def record_submitted(self):
+        with self._lock:
+            self.submitted += 1
+
+    def record_completed(self):
+        with self._lock:
+            self.completed += 1
+
+    def record_failed(self):
+        with self._lock:
+            self.failed += 1
+
+    def record_cancelled(self, job, queued):
+        # Work saved is estimated from the average duration of the stages the job never ran
+        skipped = job.stages if queued else job.remaining_stages()
+        with self._lock:
+            if queued:
+                self.cancelled_queued += 1
+            else:
+                self.cancelled_running += 1
+            self.cancel_reasons[job.cancel_reason] = self.cancel_reasons.get(job.cancel_reason, 0) + 1
+            self.stages_skipped += len(skipped)
+            per_kind = self.stage_seconds.get(job.kind, {})
+            self.seconds_saved += sum(per_kind.get(stage, 0.0) for stage in skipped)
+
+    def snapshot(self):
+        with self._lock:
+            waits = sorted(self.waits)
+            return {
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": {
+                    "queued": self.cancelled_queued,
+                    "running": self.cancelled_running,
+                    "by_reason": dict(self.cancel_reasons),
+                },
+                "saved": {
+                    "stages_skipped": self.stages_skipped,
+                    "estimated_worker_seconds": round(self.seconds_saved, 3),
+                },
+                "stage_seconds": {
+                    kind: {stage: round(seconds, 4) for stage, seconds in stages.items()}
+                    for kind, stages in self.stage_seconds.items()
+                },
+                "rejected": dict(self.rejected),
+                "queue_wait_seconds": {
+                    "p50": round(_percentile(waits, 0.5), 4),
+                    "p95": round(_percentile(waits, 0.95), 4),
+                    "max": round(waits[-1], 4) if waits else 0.0,
+                },
+            }
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def request_deadline(request):
+    timeout = FACE_JOB_DEADLINE
+    header = request.headers.get("x-request-timeout")
+    if header:
+        try:
+            timeout = float(header)
+        except ValueError:
+            pass
+    timeout = max(0.0, min(timeout, FACE_JOB_MAX_DEADLINE))
+    return time.monotonic() + timeout
+
+
+def _discard_result(future):
+    if not future.cancelled():
+        future.exception()
+
+
+class FaceWorkerPool:
+    def __init__(self, workers=FACE_WORKERS, queue_depth=FACE_QUEUE_DEPTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="face-worker")
+        self.stats = JobStats()
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = 0
+        self._admitted = 0
+
+    def _acquire(self):
+        with self._in_flight_lock:
+            self._in_flight += 1
+
+    def _release(self):
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def idle_workers(self):
+        with self._in_flight_lock:
+            return max(0, self.workers - self._in_flight)
+
+    def queued(self):
+        with self._in_flight_lock:
+            return max(0, self._in_flight - self.workers)
+
+    def expected_wait(self, ahead):
+        """Seconds until a request with `ahead` jobs in front of it gets a worker."""
+        return max(0, ahead - self.workers + 1) * self.stats.job_seconds() / self.workers
+
+    def admit(self):
+        """Reserve a slot for an incoming request, or return (status, retry_after) to reject it."""
+        with self._in_flight_lock:
+            ahead = max(self._admitted, self._in_flight)
+            if ahead < self.workers + self.queue_depth:
+                self._admitted += 1
+                return None
+        retry_after = max(1, math.ceil(self.expected_wait(ahead)))
+        # Queue full: 429 tells the client to back off. If even a free slot
+        # would be served after the job deadline, the service is overloaded: 503.
+        status = 503 if self.expected_wait(ahead) > FACE_JOB_DEADLINE else 429
+        self.stats.record_rejected(status)
+        return status, retry_after
+
+    def release_admission(self):
+        with self._in_flight_lock:
+            self._admitted -= 1
+
+    def queue_snapshot(self):
+        with self._in_flight_lock:
+            in_flight, admitted = self._in_flight, self._admitted
+        return {
+            "workers": self.workers,
+            "capacity": self.workers + self.queue_depth,
+            "admitted": admitted,
+            "in_flight": in_flight,
+            "depth": max(0, in_flight - self.workers),
+            "expected_wait_seconds": round(self.expected_wait(in_flight), 3),
+        }
+
+    def _run(self, job, fn, args):
+        job.started_at = time.monotonic()
+        self.stats.observe_wait(job.started_at - job.created_at)
+        try:
+            result = fn(job, *args)
+            job.finish()
+            self.stats.record_completed()
+            return result
+        except JobCancelled:
+            self.stats.record_cancelled(job, queued=job.stage == job.stages[0])
+            raise
+        except Exception:
+            self.stats.record_failed()
+            raise
+        finally:
+            self._release()
+
+    def _run_background(self, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            self._release()
+
+    def submit_background(self, fn, *args):
+        """Run low-priority work (e.g. re-embedding) on the pool, returns a concurrent future."""
+        self._acquire()
+        return self._executor.submit(self._run_background, fn, args)
+
+    async def run(self, request, kind, stages, fn, *args):
+        """Run fn(job, *args) on a worker, giving up when the client leaves or the deadline passes.
+
+        fn must call job.checkpoint(stage) before each of its stages.
+        """
+        job = FaceJob(kind, stages, request_deadline(request), self.stats)
+        self.stats.record_submitted()
+        self._acquire()
+        concurrent_future = self._executor.submit(self._run, job, fn, args)
+        future = asyncio.wrap_future(concurrent_future)
+        while True:
+            done, _ = await asyncio.wait({future}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return future.result()
+            if await request.is_disconnected():
+                job.cancel("disconnected")
+            elif time.monotonic() >= job.deadline:
+                job.cancel("deadline")
+            else:
+                continue
+            if concurrent_future.cancel():
+                # Never reached a worker, drop it from the queue outright
+                self._release()
+                self.stats.record_cancelled(job, queued=True)
+            else:
+                # Already running, the worker stops at its next checkpoint
+                future.add_done_callback(_discard_result)
+            print(f"Cancelled {kind} job ({job.cancel_reason}) at stage {job.stage or 'queued'}")
+            raise JobCancelled(job.cancel_reason, job.stage)
+
+
+class AdmissionMiddleware:
+    """Bounded admission for the face inference routes.
+
+    Runs before FastAPI parses the multipart body, so a rejected request
+    never gets its image read into memory, and an admitted one is read at
+    most FACE_MAX_UPLOAD_BYTES in before it is turned away with a 413.
+    """
+
+    def __init__(self, app, pool, paths):
+        self.app = app
+        self.pool = pool
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse({"detail": "Image upload too large"}, status_code=413)
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > FACE_MAX_UPLOAD_BYTES:
+            await too_large(scope, receive, send)
+            return
+
+        rejection = self.pool.admit()
+        if rejection is not None:
+            status, retry_after = rejection
+            response = JSONResponse(
+                {"detail": "Face service is busy, retry later", "retry_after": retry_after},
+                status_code=status,
+                headers={"Retry-After": str(retry_after), "X-Queue-Depth": str(self.pool.queued())},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            # Read here rather than as the app parses the form: a limit hit inside
+            # the form parser would surface as its own 400. Chunked uploads have
+            # no content-length, so this is also where they are counted.
+            messages = deque()
+            received = 0
+            more_body = True
+            while more_body:
+                message = await receive()
+                if message["type"] != "http.request":
+                    # Client gone before the upload finished, nothing to answer
+                    return
+                received += len(message.get("body", b""))
+                if received > FACE_MAX_UPLOAD_BYTES:
+                    await too_large(scope, receive, send)
+                    return
+                messages.append(message)
+                more_body = message.get("more_body", False)
+
+            async def replay_body():
+                if messages:
+                    return messages.popleft()
+                return await receive()
+
+            async def send_with_queue_depth(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-queue-depth", str(self.pool.queued()).encode()))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, replay_body, send_with_queue_depth)
+        finally:
+            self.pool.release_admission()
@@ -2,15 +2,33 @@ import os
 os.environ.setdefault("CUDA_VISIBLE_DEVICES", "-1")  # Force CPU-only runtime
 os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")   # Reduce TF logging (errors only)
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from deepface import DeepFace
 import numpy as np
 import cv2
 import uvicorn
 from typing import Dict
+import asyncio
+import hmac
 import json
+import tempfile
+import threading
 import numpy as np
+from jobs import AdmissionMiddleware, FaceWorkerPool, JobCancelled
+from migration import EmbeddingMigration
+from snapshot import SnapshotError, import_store, iter_snapshot
+from store import (
+    CURRENT_VERSION,
+    FACE_DETECTOR,
+    FACE_MODEL,
+    FaceStore,
+    face_crop,
+    numpy_to_list,
+    parse_version,
+    save_crop,
+)
 
 # Extra safety: disable TF GPU from API if present
 try:
@@ -25,53 +43,169 @@ except Exception:
 
 app = FastAPI()
 
+face_workers = FaceWorkerPool()
+
+REGISTER_STAGES = ("decode", "embed", "dedupe", "store")
+# Bearer token for the snapshot export/restore endpoints, which stay disabled without it
+FACE_ADMIN_TOKEN = os.environ.get("FACE_ADMIN_TOKEN", "")
+# Enrollment is refused when the face already matches another principal this
+# closely (cosine similarity), set above 1 to disable the check
+FACE_DUPLICATE_THRESHOLD = float(os.environ.get("FACE_DUPLICATE_THRESHOLD", "0.7"))
+VERIFY_STAGES = ("decode", "liveness", "embed", "match")
 
+# Added before CORS so that 429/503 rejections still carry CORS headers
+app.add_middleware(AdmissionMiddleware, pool=face_workers, paths=["/register-face", "/verify-face"])
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After", "X-Queue-Depth"],
 )
 
-def numpy_to_list(embedding):
-    if isinstance(embedding, dict):
-        # If it's a dictionary, assume it's the DeepFace output and extract 'embedding'
-        return np.array(embedding.get('embedding', [])).tolist()
-    elif isinstance(embedding, list):
-        return embedding
-    elif isinstance(embedding, np.ndarray):
-        return embedding.tolist()
-    return [] # Return empty list for unexpected types
-
 def list_to_numpy(embedding_list):
     return np.array(embedding_list)
 
 
-def load_embeddings():
-    try:
-        with open('face_embeddings.json', 'r') as f:
-            raw_embeddings = json.load(f)
-            # Ensure all loaded embeddings are in the correct list format
-            cleaned_embeddings = {}
-            for principal_id, embedding_data in raw_embeddings.items():
-                cleaned_embeddings[principal_id] = numpy_to_list(embedding_data)
-            return cleaned_embeddings
-    except FileNotFoundError:
-        return {}
-
-face_embeddings = load_embeddings()
+face_store = FaceStore().load()
+_store_lock = threading.Lock()
+
+
+def represent(img, model_name=FACE_MODEL, detector_backend=FACE_DETECTOR):
+    return DeepFace.represent(img, model_name=model_name, detector_backend=detector_backend)[0]
+
+
+face_migration = EmbeddingMigration(face_store, face_workers, lambda crop: numpy_to_list(represent(crop)), _store_lock)
+
+
+@app.on_event("startup")
+async def start_migration():
+    face_migration.start()
+
+
+def decode_image(contents):
+    # Use frombuffer (fromstring is deprecated for binary data)
+    nparr = np.frombuffer(contents, dtype=np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    if img is None:
+        raise HTTPException(status_code=422, detail="Invalid image data")
+    return img
+
+
+def cancelled_error(e):
+    if e.reason == "deadline":
+        return HTTPException(status_code=504, detail="Face job exceeded its deadline")
+    # Nobody is listening anymore, 499 mirrors nginx's "client closed request"
+    return HTTPException(status_code=499, detail="Client disconnected")
+
 
 @app.get("/check-registration/{principal_id}")
 async def check_registration(principal_id: str):
     print(f"Checking registration for principal_id: {principal_id}")
-    if principal_id in face_embeddings:
+    if principal_id in face_store:
         return {"status": "registered"}
     else:
         return {"status": "unregistered"}
 
+@app.get("/stats")
+async def stats():
+    return {**face_workers.stats.snapshot(), "queue": face_workers.queue_snapshot()}
+
+@app.get("/migration/status")
+async def migration_status():
+    return face_migration.status()
+
+
+def require_admin(request):
+    if not FACE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    supplied = request.headers.get("authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode(), FACE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.get("/admin/snapshot")
+async def export_snapshot(request: Request):
+    require_admin(request)
+    # Registrations keep going while the copy streams out
+    records = face_store.snapshot()
+    print(f"Streaming snapshot of {len(records)} principals")
+    return StreamingResponse(
+        iter_snapshot(records),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": "attachment; filename=face_store.femb"},
+    )
+
+def restore_store(stream):
+    with _store_lock:
+        import_store(face_store, stream)
+
+@app.post("/admin/restore")
+async def restore_snapshot(request: Request):
+    require_admin(request)
+    with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+        async for piece in request.stream():
+            spool.write(piece)
+        spool.seek(0)
+        try:
+            await asyncio.to_thread(restore_store, spool)
+        except SnapshotError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    # The replica serves from memory right away, the JSON copy catches up in the background
+    threading.Thread(target=face_store.save, name="face-store-save", daemon=True).start()
+    return {"status": "success", "principals": len(face_store)}
+
+
+def legacy_probes(img):
+    """{version: embedding of img by that version's model/detector} for each version still in use.
+
+    While a migration is pending, principals without a current template can
+    only be compared with a probe embedded the way their old one was.
+    """
+    probes = {}
+    for version in face_store.legacy_versions(CURRENT_VERSION):
+        model_name, detector_backend = parse_version(version)
+        probes[version] = numpy_to_list(represent(img, model_name, detector_backend))
+    return probes
+
+
+def register_face_job(job, principal_id, contents):
+    job.checkpoint("decode")
+    img = decode_image(contents)
+
+    job.checkpoint("embed")
+    embedding_data = represent(img)
+    embedding = numpy_to_list(embedding_data)
+    legacy_embeddings = legacy_probes(img)
+
+    job.checkpoint("dedupe")
+    with _store_lock:
+        # Checked under the store lock so two concurrent enrollments of the
+        # same face under different principals can't both get through
+        duplicates = face_store.search(CURRENT_VERSION, embedding, k=1, skip=[principal_id])
+        for version, legacy_embedding in legacy_embeddings.items():
+            duplicates += face_store.search(
+                version, legacy_embedding, k=1, skip=[principal_id], exclude_version=CURRENT_VERSION
+            )
+        duplicates.sort(key=lambda match: -match[1])
+        if duplicates and duplicates[0][1] >= FACE_DUPLICATE_THRESHOLD:
+            print(f"Rejected enrollment of {principal_id}: matches {duplicates[0][0]} ({duplicates[0][1]:.3f})")
+            raise HTTPException(status_code=409, detail="This face is already registered to another account")
+
+        job.checkpoint("store")
+        # Keep the face crop so the template can be rebuilt if the model changes
+        crop = face_crop(img, embedding_data.get("facial_area", {}))
+        # Last chance to notice the client left: once the template is set the
+        # enrollment counts, and the client was already told it failed
+        job.check()
+        # A fresh enrollment replaces any templates from older models
+        face_store.set_template(principal_id, CURRENT_VERSION, embedding, keep_others=False)
+        save_crop(principal_id, crop)
+        face_store.save()
+
 @app.post("/register-face")
 async def register_face(
+    request: Request,
     principal_id: str = Form(...),
     file: UploadFile = File(...)
 ):
@@ -82,76 +216,78 @@ async def register_face(
             raise HTTPException(status_code=422, detail="File must be an image")
         
         contents = await file.read()
-        # Use frombuffer (fromstring is deprecated for binary data)
-        nparr = np.frombuffer(contents, dtype=np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            raise HTTPException(status_code=422, detail="Invalid image data")
-
-        embedding_data = DeepFace.represent(img, model_name="Facenet")[0]
-        embedding = numpy_to_list(embedding_data)
-    
-        face_embeddings[principal_id] = embedding
-        
-        with open('face_embeddings.json', 'w') as f:
-            json.dump(face_embeddings, f)
+        await face_workers.run(request, "register", REGISTER_STAGES, register_face_job, principal_id, contents)
         
         return {"status": "success", "message": "Face registered successfully"}
         
+    except JobCancelled as e:
+        raise cancelled_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=422, detail=str(e))
 
+
+def verify_face_job(job, contents):
+    job.checkpoint("decode")
+    img = decode_image(contents)
+
+    job.checkpoint("liveness")
+    is_live = check_liveness(img)
+    if not is_live:
+        return {"status": "error", "message": "Liveness check failed - eyes not detected"}
+
+    job.checkpoint("embed")
+    current_embedding_data = represent(img)
+    current_embedding = numpy_to_list(current_embedding_data) # Ensure it's a list
+    # Dual-read while a migration is pending
+    legacy_embeddings = legacy_probes(img)
+
+    job.checkpoint("match")
+    matches = face_store.search(CURRENT_VERSION, current_embedding)
+    for version, legacy_embedding in legacy_embeddings.items():
+        matches += face_store.search(version, legacy_embedding, exclude_version=CURRENT_VERSION)
+
+    best_match = None
+    highest_similarity = 0
+    threshold = 0.7
+
+    for principal_id, similarity in matches:
+        print(f"Similarity with {principal_id}: {similarity}")
+        if similarity > highest_similarity:
+            highest_similarity = similarity
+            best_match = principal_id
+
+    if highest_similarity >= threshold:
+        return {
+            "status": "success", 
+            "message": "Face verified successfully", 
+            "principal_id": best_match,
+            "similarity": float(highest_similarity)
+        }
+    else:
+        return {
+            "status": "failed", 
+            "message": "No matching face found", 
+            "similarity": float(highest_similarity) if highest_similarity > 0 else 0
+        }
+
 @app.post("/verify-face")
 async def verify_face(
+    request: Request,
     file: UploadFile = File(...)
 ):
     try:
-        if not face_embeddings:
+        if not len(face_store):
             raise HTTPException(status_code=404, detail="No faces registered in the system")
         
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-        if img is None:
-            raise HTTPException(status_code=422, detail="Invalid image data")
-        
-        is_live = check_liveness(img)
-        if not is_live:
-            return {"status": "error", "message": "Liveness check failed - eyes not detected"}
-        
-        current_embedding_data = DeepFace.represent(img, model_name="Facenet")[0]
-        current_embedding = numpy_to_list(current_embedding_data) # Ensure it's a list
-        
-        best_match = None
-        highest_similarity = 0
-        threshold = 0.7
-        
-        for principal_id, stored_embedding in face_embeddings.items():
-            # stored_embedding is already a list due to load_embeddings cleaning
-            similarity = cosine_similarity(np.array(stored_embedding), np.array(current_embedding))
-            
-            print(f"Similarity with {principal_id}: {similarity}")
-            
-            if similarity > highest_similarity:
-                highest_similarity = similarity
-                best_match = principal_id
-        
-        if highest_similarity >= threshold:
-            return {
-                "status": "success", 
-                "message": "Face verified successfully", 
-                "principal_id": best_match,
-                "similarity": float(highest_similarity)
-            }
-        else:
-            return {
-                "status": "failed", 
-                "message": "No matching face found", 
-                "similarity": float(highest_similarity) if highest_similarity > 0 else 0
-            }
+        return await face_workers.run(request, "verify", VERIFY_STAGES, verify_face_job, contents)
             
+    except JobCancelled as e:
+        raise cancelled_error(e)
+    except HTTPException:
+        raise
     except Exception as e:
         print("Error in verify_face:", str(e))
         raise HTTPException(
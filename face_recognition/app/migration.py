@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+from store import CURRENT_VERSION, load_crop
+
+# Re-embeddings per second the migration may issue, and how long it waits
+# when every worker is busy serving real requests
+FACE_MIGRATION_RATE = float(os.environ.get("FACE_MIGRATION_RATE", "0.5"))
+MIGRATION_BUSY_BACKOFF = 1.0
+# Persist progress every this many re-embedded principals
+MIGRATION_SAVE_EVERY = 25
+
+
+class EmbeddingMigration:
+    """Re-embeds retained enrollment crops with the current model/detector.
+
+    Runs on a daemon thread and only submits work to the face pool when a
+    worker is idle, so login traffic always goes first. Until it finishes,
+    verification keeps matching un-migrated principals against their old
+    templates.
+
+    Writes hold `lock`, the lock enrollments and restores take, so a
+    template re-embedded from an old crop never lands on top of a newer
+    enrollment or in a store that was just restored.
+    """
+
+    def __init__(self, store, pool, embed_fn, lock, version=CURRENT_VERSION):
+        self.store = store
+        self.lock = lock
+        self.pool = pool
+        self.embed_fn = embed_fn
+        self.version = version
+        self.migrated = 0
+        self.failed = {}
+        self.missing_crops = []
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or not self.store.pending(self.version):
+            return
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="face-migration", daemon=True)
+        self._thread.start()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _reembed(self, principal_id):
+        crop = load_crop(principal_id)
+        if crop is None:
+            return None
+        return self.embed_fn(crop)
+
+    def _run(self):
+        print(f"Starting face template migration to {self.version}")
+        unsaved = 0
+        for principal_id in self.store.pending(self.version):
+            while self.pool.idle_workers() == 0:
+                time.sleep(MIGRATION_BUSY_BACKOFF)
+            try:
+                embedding = self.pool.submit_background(self._reembed, principal_id).result()
+            except Exception as e:
+                print(f"Migration failed for {principal_id}: {str(e)}")
+                self.failed[principal_id] = str(e)
+                continue
+            if embedding is None:
+                self.missing_crops.append(principal_id)
+                continue
+            with self.lock:
+                # Re-enrolled or restored away while the crop was embedded
+                if principal_id not in self.store or self.store.has_template(principal_id, self.version):
+                    continue
+                self.store.set_template(principal_id, self.version, embedding)
+            self.migrated += 1
+            unsaved += 1
+            if unsaved >= MIGRATION_SAVE_EVERY:
+                self.store.save()
+                unsaved = 0
+            time.sleep(1.0 / FACE_MIGRATION_RATE)
+
+        # Old templates are only dropped for principals that have a new one,
+        # anyone without a usable crop stays on dual-read until they re-enroll
+        with self.lock:
+            self.store.drop_other_versions(self.version)
+        self.store.save()
+        self.finished_at = time.time()
+        print(f"Face template migration finished: {self.migrated} migrated, "
+              f"{len(self.missing_crops)} without crops, {len(self.failed)} failed")
+
+    def status(self):
+        return {
+            "version": self.version,
+            "stored_versions": sorted(self.store.versions()),
+            "running": self.running(),
+            "pending": len(self.store.pending(self.version)),
+            "migrated": self.migrated,
+            "failed": len(self.failed),
+            "missing_crops": len(self.missing_crops),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
@@ -0,0 +1,148 @@
+"""Streaming binary snapshots of the face template store.
+
+Layout (little-endian):
+
+    header   b"FEMBSNAP" u16 format version, u16 reserved
+    chunk*   b"CHNK" u32 count, u32 dim, u32 meta length, u32 crc32,
+             meta (JSON: {"version": ..., "ids": [...]}), count*dim float32
+    trailer  b"DONE" u32 chunk count, u64 template count
+
+Each chunk holds up to SNAPSHOT_CHUNK_SIZE templates of one model/detector
+version, and its crc32 covers the meta and the matrix bytes.
+
+    python snapshot.py export face_store.femb
+    python snapshot.py import face_store.femb
+    python snapshot.py verify face_store.femb
+"""
+import argparse
+import json
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+from store import EMBEDDINGS_PATH, FaceStore
+
+SNAPSHOT_MAGIC = b"FEMBSNAP"
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_CHUNK_SIZE = 4096
+
+_HEADER = struct.Struct("<8sHH")
+_CHUNK = struct.Struct("<4sIIII")
+_TRAILER = struct.Struct("<4sIQ")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def iter_snapshot(records, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """Yield the encoded snapshot of `records` ({principal_id: {version: embedding}}) piece by piece."""
+    yield _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0)
+
+    by_version = {}
+    for principal_id, templates in records.items():
+        for version, embedding in templates.items():
+            by_version.setdefault(version, []).append((principal_id, embedding))
+
+    chunks = 0
+    total = 0
+    for version, entries in by_version.items():
+        for start in range(0, len(entries), chunk_size):
+            batch = entries[start:start + chunk_size]
+            matrix = np.asarray([embedding for _, embedding in batch], dtype="<f4")
+            meta = json.dumps({"version": version, "ids": [principal_id for principal_id, _ in batch]}).encode("utf-8")
+            body = matrix.tobytes()
+            crc = zlib.crc32(body, zlib.crc32(meta))
+            yield _CHUNK.pack(b"CHNK", matrix.shape[0], matrix.shape[1], len(meta), crc) + meta + body
+            chunks += 1
+            total += matrix.shape[0]
+
+    yield _TRAILER.pack(b"DONE", chunks, total)
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SnapshotError("Snapshot is truncated")
+    return data
+
+
+def read_snapshot(stream):
+    """Yield (version, ids, float32 matrix) per chunk, verifying checksums as it goes."""
+    magic, version, _ = _HEADER.unpack(_read_exact(stream, _HEADER.size))
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError("Not a face store snapshot")
+    if version != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"Unsupported snapshot format {version}")
+
+    chunks = 0
+    total = 0
+    while True:
+        tag = _read_exact(stream, 4)
+        if tag == b"DONE":
+            expected_chunks, expected_total = struct.unpack("<IQ", _read_exact(stream, _TRAILER.size - 4))
+            if (expected_chunks, expected_total) != (chunks, total):
+                raise SnapshotError("Snapshot trailer does not match its contents")
+            return
+        if tag != b"CHNK":
+            raise SnapshotError("Corrupt chunk header")
+        count, dim, meta_length, crc = struct.unpack("<IIII", _read_exact(stream, _CHUNK.size - 4))
+        meta = _read_exact(stream, meta_length)
+        body = _read_exact(stream, count * dim * 4)
+        if zlib.crc32(body, zlib.crc32(meta)) != crc:
+            raise SnapshotError(f"Checksum mismatch in chunk {chunks}")
+        try:
+            info = json.loads(meta)
+            version, ids = info["version"], info["ids"]
+        except (ValueError, TypeError, KeyError) as e:
+            raise SnapshotError(f"Corrupt metadata in chunk {chunks}: {e}") from e
+        if not isinstance(version, str) or not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            raise SnapshotError(f"Corrupt metadata in chunk {chunks}: version and ids must be strings")
+        if len(ids) != count:
+            raise SnapshotError(f"Chunk {chunks} has {len(ids)} ids for {count} templates")
+        yield version, ids, np.frombuffer(body, dtype="<f4").reshape(count, dim)
+        chunks += 1
+        total += count
+
+
+def export_store(store, stream):
+    for piece in iter_snapshot(store.snapshot()):
+        stream.write(piece)
+
+
+def import_store(store, stream):
+    """Replace the store's contents with a snapshot. Nothing changes unless the whole snapshot is valid."""
+    store.restore(read_snapshot(stream))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import face store snapshots")
+    parser.add_argument("command", choices=["export", "import", "verify"])
+    parser.add_argument("file", help="snapshot file, '-' for stdin/stdout")
+    parser.add_argument("--path", default=EMBEDDINGS_PATH, help="face embeddings JSON store")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        store = FaceStore(args.path).load()
+        if args.file == "-":
+            export_store(store, sys.stdout.buffer)
+        else:
+            with open(args.file, "wb") as f:
+                export_store(store, f)
+        print(f"Exported {len(store)} principals", file=sys.stderr)
+    elif args.command == "import":
+        store = FaceStore(args.path)
+        with (sys.stdin.buffer if args.file == "-" else open(args.file, "rb")) as f:
+            import_store(store, f)
+        store.save()
+        print(f"Imported {len(store)} principals into {args.path}", file=sys.stderr)
+    else:
+        with (sys.stdin.buffer if args.file == "-" else open(args.file, "rb")) as f:
+            total = sum(len(ids) for _, ids, _ in read_snapshot(f))
+        print(f"Snapshot OK: {total} templates", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
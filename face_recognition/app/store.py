@@ -0,0 +1,321 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import cv2
+import numpy as np
+
+# Model and detector used for new embeddings. Changing either one starts a
+# background re-embedding migration (see migration.py).
+FACE_MODEL = os.environ.get("FACE_MODEL", "Facenet")
+FACE_DETECTOR = os.environ.get("FACE_DETECTOR", "opencv")
+# Untagged embeddings from before versioning were all Facenet + DeepFace's default detector
+LEGACY_MODEL = "Facenet"
+LEGACY_DETECTOR = "opencv"
+
+EMBEDDINGS_PATH = os.environ.get("FACE_EMBEDDINGS_PATH", "face_embeddings.json")
+CROPS_DIR = os.environ.get("FACE_CROPS_DIR", "enrollment_crops")
+# Extra context kept around the detected face so another detector can find it again
+CROP_PADDING = 0.5
+# Principal ids that crops from before hashed file names may have been saved under
+LEGACY_CROP_ID = re.compile(r"[A-Za-z0-9_-]{1,128}")
+
+
+def template_version(model, detector):
+    return f"{model}/{detector}"
+
+
+def parse_version(version):
+    model, detector = version.split("/", 1)
+    return model, detector
+
+
+CURRENT_VERSION = template_version(FACE_MODEL, FACE_DETECTOR)
+LEGACY_VERSION = template_version(LEGACY_MODEL, LEGACY_DETECTOR)
+
+
+def numpy_to_list(embedding):
+    if isinstance(embedding, dict):
+        # If it's a dictionary, assume it's the DeepFace output and extract 'embedding'
+        return np.array(embedding.get('embedding', [])).tolist()
+    elif isinstance(embedding, list):
+        return embedding
+    elif isinstance(embedding, np.ndarray):
+        return embedding.tolist()
+    return [] # Return empty list for unexpected types
+
+
+class FaceIndex:
+    """Unit-normalized templates of one version as a float32 matrix for vectorized cosine search."""
+
+    def __init__(self):
+        self.ids = []
+        self._rows = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def upsert(self, principal_id, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        row = self._rows.get(principal_id)
+        if row is not None:
+            self._matrix[row] = vector
+            return
+        if len(self.ids) == 0:
+            self._matrix = np.zeros((16, vector.shape[0]), dtype=np.float32)
+        elif len(self.ids) == self._matrix.shape[0]:
+            # Grow geometrically so appends stay amortized O(d)
+            grown = np.zeros((2 * self._matrix.shape[0], self._matrix.shape[1]), dtype=np.float32)
+            grown[:len(self.ids)] = self._matrix[:len(self.ids)]
+            self._matrix = grown
+        self._rows[principal_id] = len(self.ids)
+        self._matrix[len(self.ids)] = vector
+        self.ids.append(principal_id)
+
+    def extend(self, ids, matrix):
+        """Bulk-append new principals, normalizing the whole block at once."""
+        block = np.asarray(matrix, dtype=np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        block = block / np.where(norms > 0, norms, 1)
+        start = len(self.ids)
+        if start == 0:
+            self._matrix = block.copy()
+        else:
+            self._matrix = np.vstack([self._matrix[:start], block])
+        for offset, principal_id in enumerate(ids):
+            self._rows[principal_id] = start + offset
+        self.ids.extend(ids)
+
+    def remove(self, principal_id):
+        row = self._rows.pop(principal_id, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        if row != last:
+            # Move the last row into the hole
+            moved = self.ids[last]
+            self._matrix[row] = self._matrix[last]
+            self.ids[row] = moved
+            self._rows[moved] = row
+        self.ids.pop()
+
+    def search(self, embedding, k=1, skip=()):
+        """Top-k (principal_id, cosine similarity), ignoring principals in `skip`."""
+        if not self.ids:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        similarities = self._matrix[:len(self.ids)] @ (query / norm)
+        for principal_id in skip:
+            row = self._rows.get(principal_id)
+            if row is not None:
+                similarities[row] = -np.inf
+        k = min(k, len(self.ids))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(self.ids[row], float(similarities[row])) for row in top if np.isfinite(similarities[row])]
+
+
+class FaceStore:
+    """Face templates per principal, keyed by the model/detector version that produced them."""
+
+    def __init__(self, path=EMBEDDINGS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._records = {}
+        self._indexes = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                raw_embeddings = json.load(f)
+        except FileNotFoundError:
+            return self
+        records = {}
+        for principal_id, entry in raw_embeddings.items():
+            if isinstance(entry, dict) and "templates" in entry:
+                templates = {version: numpy_to_list(embedding) for version, embedding in entry["templates"].items()}
+            else:
+                # Pre-versioning format: a bare embedding list
+                templates = {LEGACY_VERSION: numpy_to_list(entry)}
+            records[principal_id] = templates
+        with self._lock:
+            self._records = records
+            self._rebuild_indexes()
+        return self
+
+    def _rebuild_indexes(self):
+        self._indexes = {}
+        for principal_id, templates in self._records.items():
+            for version, embedding in templates.items():
+                self._indexes.setdefault(version, FaceIndex()).upsert(principal_id, embedding)
+
+    def save(self):
+        # Serialize a point-in-time copy so registrations aren't blocked by the JSON dump
+        with self._save_lock:
+            payload = {
+                principal_id: {"templates": {version: numpy_to_list(embedding) for version, embedding in templates.items()}}
+                for principal_id, templates in self.snapshot().items()
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, self.path)
+
+    def snapshot(self):
+        """Consistent {principal_id: {version: embedding}} view of the store.
+
+        Only the outer dict is copied: per-principal template dicts are always
+        replaced on write, never mutated, so the copy stays frozen.
+        """
+        with self._lock:
+            return dict(self._records)
+
+    def restore(self, chunks):
+        """Replace everything with (version, ids, matrix) chunks, e.g. from snapshot.read_snapshot."""
+        records = {}
+        indexes = {}
+        for version, ids, matrix in chunks:
+            indexes.setdefault(version, FaceIndex()).extend(ids, matrix)
+            # Rows stay float32 views of the chunk, save() converts them to lists
+            for principal_id, embedding in zip(ids, matrix):
+                records.setdefault(principal_id, {})[version] = embedding
+        with self._lock:
+            self._records = records
+            self._indexes = indexes
+
+    def __contains__(self, principal_id):
+        return principal_id in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    def set_template(self, principal_id, version, embedding, keep_others=True):
+        with self._lock:
+            previous = self._records.get(principal_id, {})
+            templates = dict(previous) if keep_others else {}
+            templates[version] = numpy_to_list(embedding)
+            # Records are replaced rather than mutated so readers can iterate without the lock
+            self._records[principal_id] = templates
+            for old_version in set(previous) - set(templates):
+                self._indexes[old_version].remove(principal_id)
+            self._indexes.setdefault(version, FaceIndex()).upsert(principal_id, templates[version])
+
+    def matrix(self, version=CURRENT_VERSION):
+        """(ids, unit-normalized float32 matrix) copy of all `version` templates."""
+        with self._lock:
+            index = self._indexes.get(version)
+            if index is None:
+                return [], np.zeros((0, 0), dtype=np.float32)
+            return list(index.ids), index._matrix[:len(index.ids)].copy()
+
+    def search(self, version, embedding, k=1, skip=(), exclude_version=None):
+        """Best matching (principal_id, similarity) pairs among `version` templates.
+
+        exclude_version drops principals that already have a template for it
+        (dual-read during a migration).
+        """
+        with self._lock:
+            index = self._indexes.get(version)
+            if index is None:
+                return []
+            skip = set(skip)
+            excluded = self._indexes.get(exclude_version)
+            if excluded is not None:
+                skip.update(principal_id for principal_id in index.ids if principal_id in excluded._rows)
+            return index.search(embedding, k=k, skip=skip)
+
+    def legacy_versions(self, version=CURRENT_VERSION):
+        """Older versions that still hold the only template of some principal."""
+        with self._lock:
+            current = self._indexes.get(version)
+            current_rows = current._rows if current is not None else {}
+            return [
+                other for other, index in self._indexes.items()
+                if other != version and any(principal_id not in current_rows for principal_id in index.ids)
+            ]
+
+    def versions(self):
+        with self._lock:
+            records = list(self._records.values())
+        found = set()
+        for templates in records:
+            found.update(templates)
+        return found
+
+    def has_template(self, principal_id, version=CURRENT_VERSION):
+        return version in self._records.get(principal_id, {})
+
+    def pending(self, version=CURRENT_VERSION):
+        with self._lock:
+            return [principal_id for principal_id, templates in self._records.items() if version not in templates]
+
+    def drop_other_versions(self, version=CURRENT_VERSION):
+        """Forget older templates of principals that already have one for `version`."""
+        with self._lock:
+            for principal_id, templates in list(self._records.items()):
+                if version in templates and len(templates) > 1:
+                    self._records[principal_id] = {version: templates[version]}
+                    for old_version in templates:
+                        if old_version != version:
+                            self._indexes[old_version].remove(principal_id)
+
+
+def _inside_crops(path):
+    crops_dir = os.path.realpath(CROPS_DIR)
+    if os.path.commonpath([crops_dir, os.path.realpath(path)]) != crops_dir:
+        raise ValueError(f"Crop path {path!r} is outside {CROPS_DIR}")
+    return path
+
+
+def crop_path(principal_id):
+    """Crop file of a principal, named by a hash of its id so no id can point outside CROPS_DIR."""
+    digest = hashlib.sha256(str(principal_id).encode("utf-8")).hexdigest()
+    return _inside_crops(os.path.join(CROPS_DIR, f"{digest}.jpg"))
+
+
+def legacy_crop_path(principal_id):
+    """Where the crop was saved before file names were hashed, or None if the id can't be a file name."""
+    if not LEGACY_CROP_ID.fullmatch(str(principal_id)):
+        return None
+    return _inside_crops(os.path.join(CROPS_DIR, f"{principal_id}.jpg"))
+
+
+def face_crop(img, facial_area):
+    """Padded crop of the detected face, JPEG-encoded for save_crop."""
+    height, width = img.shape[:2]
+    x, y = facial_area.get("x", 0), facial_area.get("y", 0)
+    w, h = facial_area.get("w", width), facial_area.get("h", height)
+    pad_x, pad_y = int(w * CROP_PADDING), int(h * CROP_PADDING)
+    crop = img[max(0, y - pad_y):min(height, y + h + pad_y), max(0, x - pad_x):min(width, x + w + pad_x)]
+    if crop.size == 0:
+        crop = img
+    ok, encoded = cv2.imencode(".jpg", crop)
+    if not ok:
+        raise ValueError("Could not encode face crop")
+    return encoded.tobytes()
+
+
+def save_crop(principal_id, crop):
+    """Keep the enrolled face crop so it can be re-embedded by a future model."""
+    os.makedirs(CROPS_DIR, exist_ok=True)
+    path = crop_path(principal_id)
+    with open(path + ".tmp", "wb") as f:
+        f.write(crop)
+    os.replace(path + ".tmp", path)
+
+
+def load_crop(principal_id):
+    for path in (crop_path(principal_id), legacy_crop_path(principal_id)):
+        if path is not None and os.path.exists(path):
+            return cv2.imread(path, cv2.IMREAD_COLOR)
+    return None
@@ -0,0 +1,56 @@
+import pytest
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.testclient import TestClient
+
+import jobs
+from jobs import AdmissionMiddleware, FaceWorkerPool
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(jobs, "FACE_MAX_UPLOAD_BYTES", 1024)
+    # Same middleware as main.py, in front of a route that only reads the form
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, pool=FaceWorkerPool(workers=1, queue_depth=1), paths=["/register-face"])
+
+    @app.post("/register-face")
+    async def register_face(principal_id: str = Form(...), image: UploadFile = File(...)):
+        return {"principal_id": principal_id, "size": len(await image.read())}
+
+    return TestClient(app)
+
+
+def test_register_face_accepts_upload_within_limit(client):
+    response = client.post("/register-face", data={"principal_id": "p1"}, files={"image": ("face.jpg", b"x" * 512)})
+
+    assert response.status_code == 200
+    assert response.json() == {"principal_id": "p1", "size": 512}
+    assert response.headers["x-queue-depth"] == "0"
+
+
+def test_register_face_rejects_upload_over_limit(client):
+    response = client.post("/register-face", data={"principal_id": "p1"}, files={"image": ("face.jpg", b"x" * 4096)})
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Image upload too large"}
+
+
+def test_register_face_rejects_chunked_upload_over_limit(client):
+    boundary = "faceboundary"
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"principal_id\"\r\n\r\np1\r\n"
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"image\"; filename=\"face.jpg\"\r\n"
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + b"x" * 4096 + f"\r\n--{boundary}--\r\n".encode()
+
+    def chunks():
+        # No content-length: the limit is only found while streaming
+        for start in range(0, len(body), 256):
+            yield body[start:start + 256]
+
+    response = client.post(
+        "/register-face", content=chunks(), headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    )
+
+    assert response.status_code == 413
+    assert response.json() == {"detail": "Image upload too large"}
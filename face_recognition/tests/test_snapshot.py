@@ -0,0 +1,42 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+
+from snapshot import _CHUNK, _HEADER, _TRAILER, SNAPSHOT_FORMAT, SNAPSHOT_MAGIC, SnapshotError, iter_snapshot, read_snapshot
+
+
+def snapshot_with_meta(meta, count=1, dim=2):
+    """A snapshot of one chunk with the given raw meta bytes and a valid checksum."""
+    body = np.zeros((count, dim), dtype="<f4").tobytes()
+    crc = zlib.crc32(body, zlib.crc32(meta))
+    return io.BytesIO(
+        _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, 0)
+        + _CHUNK.pack(b"CHNK", count, dim, len(meta), crc) + meta + body
+        + _TRAILER.pack(b"DONE", 1, count)
+    )
+
+
+def test_read_snapshot_round_trips():
+    records = {"a": {"v1": [1.0, 2.0]}, "b": {"v1": [3.0, 4.0], "v2": [5.0, 6.0]}}
+    stream = io.BytesIO(b"".join(iter_snapshot(records)))
+
+    chunks = {version: (ids, matrix.tolist()) for version, ids, matrix in read_snapshot(stream)}
+
+    assert chunks == {"v1": (["a", "b"], [[1.0, 2.0], [3.0, 4.0]]), "v2": (["b"], [[5.0, 6.0]])}
+
+
+@pytest.mark.parametrize("meta", [
+    b"{not json",
+    b"\xff\xfe",
+    b"[]",
+    b'{"version": "v1"}',
+    b'{"ids": ["a"]}',
+    b'{"version": "v1", "ids": "a"}',
+    b'{"version": "v1", "ids": [["a"]]}',
+    b'{"version": ["v1"], "ids": ["a"]}',
+])
+def test_read_snapshot_rejects_corrupt_metadata(meta):
+    with pytest.raises(SnapshotError):
+        list(read_snapshot(snapshot_with_meta(meta)))
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import store
+
+
+@pytest.fixture
+def crops_dir(tmp_path, monkeypatch):
+    crops_dir = tmp_path / "crops"
+    monkeypatch.setattr(store, "CROPS_DIR", str(crops_dir))
+    return crops_dir
+
+
+@pytest.mark.parametrize("principal_id", ["../../app/x", "/tmp/x", "..", "a/../../b", "x\x00y"])
+def test_save_crop_stays_inside_crops_dir(tmp_path, crops_dir, principal_id):
+    store.save_crop(principal_id, b"jpeg")
+
+    written = [path for path in tmp_path.rglob("*") if path.is_file()]
+    assert [path.parent for path in written] == [crops_dir]
+    assert written[0].read_bytes() == b"jpeg"
+    assert store.legacy_crop_path(principal_id) is None
+
+
+def test_crop_path_is_stable_per_principal(crops_dir):
+    assert store.crop_path("aaaaa-aa") == store.crop_path("aaaaa-aa")
+    assert store.crop_path("aaaaa-aa") != store.crop_path("aaaaa-ab")
+    assert os.path.dirname(store.crop_path("aaaaa-aa")) == str(crops_dir)
+
+
+def test_load_crop_falls_back_to_legacy_name(crops_dir):
+    cv2 = pytest.importorskip("cv2")
+    import numpy as np
+
+    crops_dir.mkdir()
+    cv2.imwrite(str(crops_dir / "aaaaa-aa.jpg"), np.zeros((4, 4, 3), dtype=np.uint8))
+    assert store.load_crop("aaaaa-aa").shape == (4, 4, 3)
+    assert store.load_crop("../aaaaa-aa") is None
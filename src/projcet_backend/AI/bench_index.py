@@ -0,0 +1,103 @@
+"""Recall@k and latency of each index kind against exact sparse search.
+
+Builds synthetic tag-based job catalogs of the given sizes, vectorizes them
+the same way the recommender does, and reports per index kind the build
+time, recall@k against exact cosine search, single-query latency and the
+memory held by the index.
+
+    python bench_index.py --jobs 1000 10000 100000 --k 10
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from indexes import INDEX_KINDS, SPARSE_KINDS, make_index
+
+
+def synthetic_documents(n_jobs, n_tags, seed=0):
+    """Job documents of 2-6 tags drawn with Zipf-like popularity."""
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_tags + 1)
+    popularity /= popularity.sum()
+    sizes = rng.integers(2, 7, size=n_jobs)
+    return [
+        " ".join(f"tag{tag}" for tag in rng.choice(n_tags, size=size, replace=False, p=popularity))
+        for size in sizes
+    ]
+
+
+def percentile_ms(samples, fraction):
+    return round(1000 * float(np.percentile(samples, 100 * fraction)), 3)
+
+
+def bench(n_jobs, n_tags, k, n_queries, seed=0):
+    documents = synthetic_documents(n_jobs, n_tags, seed)
+    vectors = TfidfVectorizer(dtype=np.float32).fit_transform(documents)
+    # Few enough tags that the dense kinds can take the full vectors
+    dense = vectors.toarray()
+    rng = np.random.default_rng(seed + 1)
+    picked = rng.choice(n_jobs, size=min(n_queries, n_jobs), replace=False)
+    ids = np.arange(n_jobs, dtype="int64")
+
+    results = {}
+    truth = None
+    for kind in INDEX_KINDS:
+        inputs = vectors if kind in SPARSE_KINDS else dense
+        started = time.perf_counter()
+        index = make_index(kind, inputs.shape[1], training_vectors=None if kind in SPARSE_KINDS else dense)
+        index.add(ids, inputs)
+        build_seconds = time.perf_counter() - started
+
+        latencies = []
+        found = []
+        for row_number in picked:
+            query = inputs[row_number:row_number + 1]
+            started = time.perf_counter()
+            row = index.search(query, k)[0]
+            latencies.append(time.perf_counter() - started)
+            found.append(row)
+        if truth is None:
+            # Exact cosine search is the reference for every other kind
+            truth = found
+        # Synthetic tag sets repeat a lot, so any result scoring at least the
+        # exact k-th score counts as a hit rather than only the same ids
+        recall = np.mean([
+            sum(1 for _, score in got if score >= expected[-1][1] - 1e-5) / max(1, len(expected))
+            for got, expected in zip(found, truth)
+        ])
+        results[kind] = {
+            "built_as": index.kind,
+            "build_seconds": round(build_seconds, 3),
+            f"recall@{k}": round(float(recall), 4),
+            "p50_ms": percentile_ms(latencies, 0.5),
+            "p99_ms": percentile_ms(latencies, 0.99),
+            "index_mb": round(index.memory_bytes() / 2**20, 2),
+        }
+    return {"jobs": n_jobs, "terms": vectors.shape[1], "non_zeros": int(vectors.nnz), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recommender index kinds")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+    args = parser.parse_args()
+
+    reports = [bench(n_jobs, args.tags, args.k, args.queries) for n_jobs in args.jobs]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    for report in reports:
+        print(f"\n{report['jobs']} jobs, {report['terms']} terms, {report['non_zeros']} non-zeros")
+        print(f"{'index':<10}{'build s':>10}{'recall@' + str(args.k):>12}{'p50 ms':>10}{'p99 ms':>10}{'index MB':>10}")
+        for kind, row in report["results"].items():
+            print(f"{kind:<10}{row['build_seconds']:>10}{row[f'recall@{args.k}']:>12}{row['p50_ms']:>10}{row['p99_ms']:>10}{row['index_mb']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""BM25 free-text search over a catalog's jobs, for /search.
+
+Jobs are indexed by their full text (catalog.job_text) in an inverted
+index: per term, the numbers of the documents containing it and how often.
+Documents are numbered in the order they are indexed and a changed job is
+indexed again under a new number, so postings only ever grow at the end
+and an update touches just the changed job's terms.
+
+Top-k queries use block-max pruning. Document numbers are cut into blocks
+of BM25_BLOCK, and per block it occurs in, a term keeps its best BM25
+frequency factor there, which times the term's IDF bounds its score
+anywhere in the block. A query adds the bounds up per block and scores the
+few blocks with the best bounds, which sets a k-th best score to beat;
+then it scores only the blocks whose bound is above that, each pass in a
+single vectorized sweep.
+
+IDF is applied at query time. Factors are computed against a fixed
+reference average length, and a factor can grow at most by the ratio of
+the current average to it, so scaling by that keeps every bound valid as
+documents come and go.
+"""
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from catalog import job_text
+from indexes import TOMBSTONE_REBUILD_RATIO, kth_largest
+
+# Term frequency saturation and document length normalization
+BM25_K1 = float(os.environ.get("RECOMMENDER_BM25_K1", "1.2"))
+BM25_B = float(os.environ.get("RECOMMENDER_BM25_B", "0.75"))
+# Documents per block-max block; smaller blocks bound scores more tightly
+# but take more memory for the bounds
+BM25_BLOCK = int(os.environ.get("RECOMMENDER_BM25_BLOCK", "256"))
+# Blocks with the best bounds scored first to find the score to beat, per result
+BM25_PROBE_BLOCKS = 2
+# Bounds loosen as the average document length moves away from the one
+# they were computed against; past this share a sync renumbers everything
+LENGTH_DRIFT = 0.1
+# The index is checked for staleness this often even without a nudge
+SEARCH_REFRESH_SECONDS = float(os.environ.get("RECOMMENDER_SEARCH_REFRESH_SECONDS", "30"))
+# The vectorizer's tokens: runs of two or more word characters
+TOKEN = re.compile(r"(?u)\b\w\w+\b")
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+class InvertedIndex:
+    """Postings and block maxima of one numbering of the documents. Not locked.
+
+    Removed documents are only masked and, as in Lucene, still count towards
+    document frequencies and lengths until BM25Index builds a new numbering.
+    """
+
+    def __init__(self, reference_length=1.0):
+        # term -> (array of doc, frequency pairs, array of block, first pair
+        # row pairs, array of the best frequency factor per block)
+        self.postings = {}
+        self.reference_length = max(1.0, reference_length)
+        self.lengths = np.zeros(0, dtype="float32")
+        self.alive = np.zeros(0, dtype=bool)
+        self.job_ids = []
+        self.docs = {}
+        self.size = 0
+        self.live = 0
+        self.total_length = 0
+
+    def add(self, job_id, counts):
+        """Index a job's {term: frequency}, replacing its previous document."""
+        self.remove(job_id)
+        doc = self.size
+        if doc == len(self.alive):
+            capacity = max(1024, 2 * doc)
+            self.lengths = np.pad(self.lengths, (0, capacity - doc))
+            self.alive = np.pad(self.alive, (0, capacity - doc))
+        length = sum(counts.values())
+        self.lengths[doc] = length
+        self.alive[doc] = True
+        self.size += 1
+        self.live += 1
+        self.total_length += length
+        self.docs[job_id] = doc
+        self.job_ids.append(job_id)
+        block = doc // BM25_BLOCK
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / self.reference_length)
+        for term, frequency in counts.items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array("i"), array("i"), array("d"))
+            pairs, blocks, maxima = entry
+            factor = frequency * (BM25_K1 + 1) / (frequency + norm)
+            if not blocks or blocks[-2] != block:
+                blocks.extend((block, len(pairs) // 2))
+                maxima.append(factor)
+            elif factor > maxima[-1]:
+                maxima[-1] = factor
+            pairs.extend((doc, frequency))
+
+    def remove(self, job_id):
+        doc = self.docs.pop(job_id, None)
+        if doc is not None:
+            self.alive[doc] = False
+            self.live -= 1
+
+    def dead(self):
+        return self.size - self.live
+
+    def search(self, counts, k):
+        """Best k (job_id, BM25 score) for a query's {term: frequency}, best first."""
+        terms = [(term, weight) for term, weight in counts.items() if term in self.postings]
+        if not terms or not self.live:
+            return []
+        average_length = self.total_length / self.size
+        # Past the reference average, every length counts as shorter and scores higher
+        growth = max(1.0, average_length / self.reference_length)
+        lists = []
+        for term, weight in terms:
+            pairs, blocks, maxima = self.postings[term]
+            frequency = len(pairs) // 2
+            idf = weight * math.log(1 + (self.size - frequency + 0.5) / (frequency + 0.5))
+            pairs = np.frombuffer(pairs, dtype="int32").reshape(-1, 2)
+            blocks = np.frombuffer(blocks, dtype="int32").reshape(-1, 2)
+            bounds = idf * growth * np.frombuffer(maxima, dtype="float64")
+            starts = blocks[:, 1].astype("int64")
+            ends = np.append(starts[1:], len(pairs))
+            lists.append((idf, pairs, blocks[:, 0], starts, ends, bounds))
+
+        # Upper bound of every block any query term occurs in
+        n_blocks = (self.size - 1) // BM25_BLOCK + 1
+        block_bounds = np.zeros(n_blocks)
+        for _, _, ids, _, _, bounds in lists:
+            block_bounds[ids] += bounds
+        # The blocks with the best bounds give a k-th best score, then only
+        # blocks whose bound beats it can still hold a better document
+        order = np.argsort(-block_bounds, kind="stable")
+        probed = np.zeros(n_blocks, dtype=bool)
+        probed[order[:BM25_PROBE_BLOCKS * k]] = True
+        docs, scores = self._score_blocks(lists, probed, average_length)
+        threshold = kth_largest(scores, k) if len(scores) >= k else 0.0
+        if (block_bounds[~probed] > threshold).any():
+            docs, scores = self._score_blocks(lists, block_bounds > threshold, average_length)
+        if len(scores) > k:
+            keep = np.argpartition(-scores, k - 1)[:k]
+            docs, scores = docs[keep], scores[keep]
+        order = np.lexsort((docs, -scores))
+        return [(self.job_ids[doc], score) for doc, score in zip(docs[order].tolist(), scores[order].tolist())]
+
+    def _score_blocks(self, lists, selected, average_length):
+        """(docs, BM25 scores) of the live documents with any query term in the selected blocks."""
+        blocks = np.flatnonzero(selected)
+        # Past a quarter of the blocks, one slot per document beats mapping
+        # the selected blocks' documents to consecutive slots
+        dense = 4 * len(blocks) > len(selected)
+        if dense:
+            totals = np.zeros(self.size)
+        else:
+            slots = np.full(len(selected), -1, dtype="int64")
+            slots[blocks] = np.arange(len(blocks))
+            totals = np.zeros(len(blocks) * BM25_BLOCK)
+        for idf, pairs, ids, starts, ends, _ in lists:
+            rows = np.flatnonzero(selected[ids])
+            if not len(rows):
+                continue
+            if dense:
+                # Scoring the whole list costs less than picking out most of
+                # it; documents outside the selected blocks are dropped below
+                postings = pairs
+            else:
+                # Posting rows of the term's selected blocks, in one index array
+                lengths = ends[rows] - starts[rows]
+                offsets = np.cumsum(lengths) - lengths
+                postings = pairs[np.repeat(starts[rows] - offsets, lengths) + np.arange(lengths.sum())]
+            docs = postings[:, 0]
+            # A term lists a document once, so plain fancy-index adds are safe
+            positions = docs if dense else slots[docs // BM25_BLOCK] * BM25_BLOCK + docs % BM25_BLOCK
+            totals[positions] += self._scores(idf, postings[:, 1], self.lengths[docs], average_length)
+        hits = np.flatnonzero(totals)
+        if dense:
+            docs = hits
+            live = self.alive[docs] & selected[docs // BM25_BLOCK]
+        else:
+            docs = blocks[hits // BM25_BLOCK] * BM25_BLOCK + hits % BM25_BLOCK
+            live = self.alive[docs]
+        return docs[live], totals[hits][live]
+
+    @staticmethod
+    def _scores(idf, frequencies, lengths, average_length):
+        frequencies = np.asarray(frequencies, dtype="float64")
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * np.asarray(lengths, dtype="float64") / average_length)
+        return idf * frequencies * (BM25_K1 + 1) / (frequencies + norms)
+
+    def memory_bytes(self):
+        postings = sum(column.itemsize * len(column) for columns in self.postings.values() for column in columns)
+        return int(postings + self.lengths.nbytes + self.alive.nbytes)
+
+
+class BM25Index:
+    """An InvertedIndex of one catalog's jobs, kept in step with its JobIndex.
+
+    Like encoder.SemanticIndex, a background thread follows the catalog's
+    version and each sync only reindexes the jobs whose text changed. Once
+    removed documents pass TOMBSTONE_REBUILD_RATIO, or every job changed, a
+    fresh numbering is built on the side and swapped in; so it is when the
+    average length drifts LENGTH_DRIFT away from the bounds' reference.
+    """
+
+    def __init__(self, job_index):
+        self.job_index = job_index
+        self.lock = threading.Lock()
+        self.index = InvertedIndex()
+        self.synced_version = None
+        self.syncs = 0
+        self.rebuilds = 0
+        self.last_sync_seconds = 0.0
+        self._keys = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def mark_dirty(self):
+        self._wake.set()
+
+    def retarget(self, job_index):
+        """Follow a catalog whose JobIndex was replaced by a new generation."""
+        self.job_index = job_index
+        self.mark_dirty()
+
+    def _run(self):
+        while True:
+            if self.job_index.version != self.synced_version:
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"Search index sync failed: {e}")
+            self._wake.wait(SEARCH_REFRESH_SECONDS)
+            self._wake.clear()
+
+    def sync(self):
+        job_index = self.job_index
+        started = time.perf_counter()
+        with job_index.lock:
+            version = job_index.version
+            jobs = dict(job_index.jobs)
+        texts = {job_id: job_text(job) for job_id, job in jobs.items()}
+        keys = {job_id: hash(text) for job_id, text in texts.items()}
+        removed = [job_id for job_id in self._keys if job_id not in jobs]
+        changed = [job_id for job_id in jobs if self._keys.get(job_id) != keys[job_id]]
+
+        index = self.index
+        dead = index.dead() + len(removed) + sum(1 for job_id in changed if job_id in index.docs)
+        drifted = index.size and abs(index.total_length / index.size / index.reference_length - 1) > LENGTH_DRIFT
+        rebuild = len(changed) == len(jobs) or drifted or dead > TOMBSTONE_REBUILD_RATIO * max(1, index.size + len(changed))
+        counts = [(job_id, Counter(tokenize(texts[job_id]))) for job_id in (jobs if rebuild else changed)]
+        if rebuild:
+            # Searches keep using the current numbering until the new one is complete
+            index = InvertedIndex(sum(sum(job_counts.values()) for _, job_counts in counts) / max(1, len(counts)))
+            for job_id, job_counts in counts:
+                index.add(job_id, job_counts)
+            with self.lock:
+                self.index = index
+                self._keys = keys
+                self.synced_version = version
+            self.rebuilds += 1
+        else:
+            with self.lock:
+                for job_id in removed:
+                    index.remove(job_id)
+                    del self._keys[job_id]
+                for job_id, job_counts in counts:
+                    index.add(job_id, job_counts)
+                    self._keys[job_id] = keys[job_id]
+                self.synced_version = version
+        self.syncs += 1
+        self.last_sync_seconds = time.perf_counter() - started
+        if changed or removed:
+            print(f"Synced search index: {len(counts)} indexed, {len(removed)} removed in {self.last_sync_seconds:.2f}s")
+
+    def search(self, text, k):
+        """Best k (job_id, BM25 score) for a free-text query, best first."""
+        counts = Counter(tokenize(text))
+        with self.lock:
+            return self.index.search(counts, k)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "jobs": self.index.live,
+                "terms": len(self.index.postings),
+                "removedDocs": self.index.dead(),
+                "bytes": self.index.memory_bytes(),
+                "syncs": self.syncs,
+                "rebuilds": self.rebuilds,
+                "lastSyncSeconds": round(self.last_sync_seconds, 3),
+                "stale": self.job_index.version != self.synced_version,
+            }
@@ -0,0 +1,90 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Most recommendation responses kept, least recently used go first
+CACHE_SIZE = int(os.environ.get("RECOMMENDER_CACHE_SIZE", "10000"))
+# Seconds a cached response stays valid even if nothing changed
+CACHE_TTL = float(os.environ.get("RECOMMENDER_CACHE_TTL", "300"))
+
+
+class ResultCache:
+    """LRU cache with a TTL for recommendation responses.
+
+    Callers put the click model and profile versions in the key, so a click
+    batch retires the entries of the models that read it. Job changes are
+    narrower: an entry records the catalog version it was computed at and
+    the job ids it depends on, its query jobs and the jobs it returned, and
+    a get() finds it stale only if one of those was changed or removed
+    since (or the catalog was refitted). A new or edited job can still
+    belong in an entry that doesn't mention it; such entries keep serving
+    without it until they expire, so CACHE_TTL bounds how late it shows up.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, job_index=None):
+        """Cached value of key, unless expired or, checked against job_index, stale."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value, depends = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if depends is not None and job_index is not None and job_index.changed_since(*depends):
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version=None, job_ids=()):
+        """Cache value; with a version, as computed then from the jobs job_ids (see get)."""
+        if self.max_entries <= 0:
+            return
+        depends = None if version is None else (version, frozenset(job_ids))
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value, depends)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "ttlSeconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRatio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -0,0 +1,474 @@
+import os
+import threading
+import weakref
+
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from filters import AttributeIndex
+from indexes import DENSE_DIM, RECOMMENDER_INDEX, SPARSE_KINDS, SparseIndex, choose_kind, make_index
+
+# Share of tokens in jobs indexed since the last fit that the vocabulary has
+# never seen. Past this, IDF weights and vocabulary are stale enough to refit.
+REFIT_DRIFT_THRESHOLD = float(os.environ.get("RECOMMENDER_REFIT_DRIFT", "0.2"))
+# Filtered searches on dense or sharded kinds with at most this many matching
+# jobs score them exactly from the stored sparse vectors right here
+FILTER_EXACT_MAX = int(os.environ.get("RECOMMENDER_FILTER_EXACT_MAX", "2000"))
+
+
+def job_document(job):
+    """Text the vectorizer sees for a job: its categories, tags and required skills."""
+    parts = list(job.get("category", []) or [])
+    parts += [tag.get("jobCategoryName", "") for tag in job.get("jobTags", []) or []]
+    parts += job.get("jobRequirementSkills", []) or []
+    return " ".join(str(part) for part in parts)
+
+
+def job_error(job):
+    """Why a job can't be indexed, or None."""
+    if not isinstance(job, dict):
+        return "must be an object"
+    if not isinstance(job.get("id"), (str, int)) or isinstance(job["id"], bool):
+        return "needs an id that is a string or integer"
+    try:
+        job_document(job)
+        job_categories(job)
+    except (AttributeError, TypeError):
+        return "has malformed category, jobTags or jobRequirementSkills"
+    return None
+
+
+def check_jobs(jobs):
+    """Raise ValueError naming the first job that can't be indexed."""
+    for i, job in enumerate(jobs):
+        error = job_error(job)
+        if error is not None:
+            raise ValueError(f"Job {i} {error}")
+
+
+def job_categories(job):
+    if job.get("category"):
+        return list(job["category"])
+    return [tag.get("jobCategoryName", "") for tag in job.get("jobTags", []) or []]
+
+
+def job_text(job):
+    """Full text of a job for the semantic model and text search: title, categories, skills and description."""
+    description = job.get("jobDescription") or []
+    if isinstance(description, str):
+        description = [description]
+    parts = [job.get("title") or job.get("jobName", "")]
+    parts += job_categories(job)
+    parts += job.get("jobRequirementSkills", []) or []
+    parts += description
+    return ". ".join(str(part) for part in parts if part)
+
+
+def job_summary(job):
+    """Fields returned for a job in recommendation responses."""
+    return {
+        "id": job["id"],
+        "title": job.get("title") or job.get("jobName", ""),
+        "category": job_categories(job),
+    }
+
+
+class JobIndex:
+    """TF-IDF vectors of a job catalog in a vector index that is kept up to date in place.
+
+    The vectorizer is fitted once; jobs added later are transformed with the
+    existing vocabulary and only a full refit (when drift passes
+    REFIT_DRIFT_THRESHOLD) rebuilds the index.
+
+    Vectors are kept sparse (indices and weights per job) so memory follows
+    the number of non-zero weights. The sparse index searches them as they
+    are; dense faiss kinds get them projected to DENSE_DIM components.
+    """
+
+    def __init__(self, jobs=(), kind=RECOMMENDER_INDEX):
+        self.lock = threading.RLock()
+        # An index kind, or auto to choose one by catalog size on every build
+        self.kind = kind
+        self.jobs = {}
+        self.version = 0
+        # Version from which _changed is complete; anything computed before it is stale throughout
+        self.base_version = 0
+        # job id -> version that last added, changed or removed it, since base_version
+        self._changed = {}
+        self.fits = 0
+        self.vectorizer = None
+        self.projection = None
+        self.index = None
+        # Job attributes for filtered searches, by faiss id
+        self.filters = AttributeIndex()
+        # Term of each vocabulary column
+        self._terms = None
+        self._vectors = {}
+        self._faiss_ids = {}
+        self._job_ids = {}
+        self._next_faiss_id = 0
+        self._drift_tokens = 0
+        self._drift_unknown = 0
+        # A list while a caller wants the upsert()/remove() calls made, to replay them elsewhere
+        self.journal = None
+        for job in jobs:
+            self.jobs[job["id"]] = job
+        self.fit()
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def fit(self):
+        """Refit the vocabulary on the whole catalog and rebuild the index."""
+        with self.lock:
+            self._vectors = {}
+            self._faiss_ids = {}
+            self._job_ids = {}
+            self._next_faiss_id = 0
+            self._drift_tokens = 0
+            self._drift_unknown = 0
+            documents = [job_document(job) for job in self.jobs.values()]
+            if not any(document.strip() for document in documents):
+                self.vectorizer = None
+                self.projection = None
+                self.index = None
+                self.filters = AttributeIndex()
+                self._terms = None
+                return
+            self.vectorizer = TfidfVectorizer(dtype=np.float32)
+            vectors = self.vectorizer.fit_transform(documents)
+            self._terms = self.vectorizer.get_feature_names_out()
+            self._build_index(list(self.jobs), vectors)
+            self.fits += 1
+            self.version += 1
+            self.base_version = self.version
+            self._changed = {}
+            print(f"Fitted job index: {len(self.jobs)} jobs, {vectors.shape[1]} terms, {vectors.nnz} non-zeros, {self.index.kind} index")
+
+    def _build_index(self, job_ids, vectors):
+        kind = choose_kind(vectors.shape[0], self.kind)
+        self.projection = None
+        if kind not in SPARSE_KINDS and vectors.shape[1] > DENSE_DIM and vectors.shape[0] > DENSE_DIM:
+            # Never materialize jobs x vocabulary: faiss gets a low-rank projection instead
+            self.projection = TruncatedSVD(n_components=DENSE_DIM, random_state=0).fit(vectors)
+        dense = None if kind in SPARSE_KINDS else self._dense(vectors)
+        self.index = make_index(kind, vectors.shape[1] if dense is None else dense.shape[1], training_vectors=dense)
+        self._attach(self.index)
+        self.filters = AttributeIndex(base=self._next_faiss_id)
+        self._faiss_ids = {}
+        self._job_ids = {}
+        self._add(job_ids, vectors, dense)
+
+    def _attach(self, index):
+        """Let an index that can lose rows (a sharded one) fetch them back from here."""
+        if hasattr(index, "reload"):
+            owner = weakref.ref(self)
+            index.source = lambda index: owner() is not None and owner()._reload(index)
+
+    def _reload(self, index):
+        with self.lock:
+            faiss_ids = list(self._job_ids)
+            rows = self._index_input(self._stack([self._job_ids[faiss_id] for faiss_id in faiss_ids]))
+            index.reload(np.asarray(faiss_ids, dtype="int64"), rows)
+
+    def _dense(self, vectors):
+        if self.projection is not None:
+            return self.projection.transform(vectors).astype("float32")
+        return vectors.toarray().astype("float32")
+
+    def _index_input(self, vectors):
+        """Sparse rows in the form the current index searches."""
+        return vectors if self.index.kind in SPARSE_KINDS else self._dense(vectors)
+
+    def _rebuild_index(self):
+        """New index from the stored vectors, without touching the vocabulary."""
+        job_ids = list(self._vectors)
+        self._build_index(job_ids, self._stack(job_ids))
+
+    def _stack(self, job_ids):
+        """Stored rows of `job_ids` as one CSR matrix."""
+        rows = [self._vectors[job_id] for job_id in job_ids]
+        indptr = np.zeros(len(rows) + 1, dtype="int64")
+        np.cumsum([len(indices) for indices, _ in rows], out=indptr[1:])
+        indices = np.concatenate([indices for indices, _ in rows]) if rows else np.zeros(0, dtype="int32")
+        data = np.concatenate([data for _, data in rows]) if rows else np.zeros(0, dtype="float32")
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), len(self.vectorizer.vocabulary_)))
+
+    def _add(self, job_ids, vectors, dense=None):
+        vectors = sparse.csr_matrix(vectors, dtype="float32")
+        faiss_ids = np.arange(self._next_faiss_id, self._next_faiss_id + len(job_ids), dtype="int64")
+        self._next_faiss_id += len(job_ids)
+        # Into the index before the maps, which must list only what it holds if it reloads
+        self.index.add(faiss_ids, self._index_input(vectors) if dense is None else dense)
+        for row, (job_id, faiss_id) in enumerate(zip(job_ids, faiss_ids.tolist())):
+            start, end = vectors.indptr[row], vectors.indptr[row + 1]
+            self._faiss_ids[job_id] = faiss_id
+            self._job_ids[faiss_id] = job_id
+            self._vectors[job_id] = (vectors.indices[start:end].copy(), vectors.data[start:end].copy())
+        jobs = [self.jobs[job_id] for job_id in job_ids]
+        self.filters.add(faiss_ids, jobs, [job_categories(job) for job in jobs])
+
+    def _remove(self, job_ids):
+        job_ids = [job_id for job_id in job_ids if job_id in self._faiss_ids]
+        faiss_ids = [self._faiss_ids[job_id] for job_id in job_ids]
+        self.index.remove(faiss_ids)
+        for job_id, faiss_id in zip(job_ids, faiss_ids):
+            del self._faiss_ids[job_id], self._vectors[job_id], self._job_ids[faiss_id]
+        self.filters.remove(faiss_ids)
+
+    def drift(self):
+        if self._drift_tokens == 0:
+            return 0.0
+        return self._drift_unknown / self._drift_tokens
+
+    def upsert(self, jobs):
+        """Add new jobs and replace changed ones without refitting the vocabulary.
+
+        Raises ValueError, changing nothing, if any job can't be indexed.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        check_jobs(jobs)
+        with self.lock:
+            if self.journal is not None:
+                self.journal.append({"upsert": jobs})
+            for job in jobs:
+                self.jobs[job["id"]] = job
+            if self.vectorizer is None:
+                self.fit()
+                return
+
+            documents = [job_document(job) for job in jobs]
+            analyzer = self.vectorizer.build_analyzer()
+            vocabulary = self.vectorizer.vocabulary_
+            for document in documents:
+                tokens = analyzer(document)
+                self._drift_tokens += len(tokens)
+                self._drift_unknown += sum(1 for token in tokens if token not in vocabulary)
+            if self.drift() > REFIT_DRIFT_THRESHOLD:
+                print(f"Vocabulary drift {self.drift():.2f} passed {REFIT_DRIFT_THRESHOLD}, refitting")
+                self.fit()
+                return
+
+            job_ids = [job["id"] for job in jobs]
+            self._remove(job_ids)
+            self._add(job_ids, self.vectorizer.transform(documents))
+            if self.index.needs_rebuild():
+                self._rebuild_index()
+            self.version += 1
+            self._changed.update(dict.fromkeys(job_ids, self.version))
+
+    def remove(self, job_ids):
+        job_ids = list(job_ids)
+        if any(not isinstance(job_id, (str, int)) or isinstance(job_id, bool) for job_id in job_ids):
+            raise ValueError("Job ids must be strings or integers")
+        with self.lock:
+            job_ids = [job_id for job_id in job_ids if job_id in self.jobs]
+            if not job_ids:
+                return
+            if self.journal is not None:
+                self.journal.append({"remove": job_ids})
+            for job_id in job_ids:
+                del self.jobs[job_id]
+            if self.index is not None:
+                self._remove(job_ids)
+                if self.index.needs_rebuild() and self._vectors:
+                    self._rebuild_index()
+            self.version += 1
+            self._changed.update(dict.fromkeys(job_ids, self.version))
+
+    def changed_since(self, version, job_ids):
+        """Whether anything computed at `version` from `job_ids` may be out of date.
+
+        True if one of them was added, changed or removed after it, or the
+        index was refitted or restored since. Jobs added or edited elsewhere
+        in the catalog don't count, though they may now belong in a result.
+        Read without the lock: a change still being made counts once its
+        version is set.
+        """
+        if version < self.base_version or version > self.version:
+            return True
+        changed = self._changed
+        return any(changed.get(job_id, version) > version for job_id in job_ids)
+
+    def replay(self, changes, version):
+        """Repeat journalled upsert()/remove() calls made on an identical index, ending at its version."""
+        with self.lock:
+            for change in changes:
+                if "upsert" in change:
+                    self.upsert(change["upsert"])
+                else:
+                    self.remove(change["remove"])
+            self.version = version
+
+    def vectors(self, job_ids):
+        """(found job ids, their stored vectors as one sparse matrix); unknown ids are skipped."""
+        with self.lock:
+            found = [job_id for job_id in job_ids if job_id in self._vectors]
+            if not found:
+                return [], None
+            return found, self._stack(found)
+
+    def encode(self, documents):
+        """Sparse vectors for free-text queries in the catalog's vocabulary."""
+        with self.lock:
+            return self.vectorizer.transform(documents)
+
+    def term_weights(self, job_ids):
+        """{job_id: {term: TF-IDF weight}} for the jobs that have a vector.
+
+        Terms, unlike column numbers, stay meaningful across refits.
+        """
+        with self.lock:
+            return {
+                job_id: dict(zip(self._terms[self._vectors[job_id][0]].tolist(), self._vectors[job_id][1].tolist()))
+                for job_id in job_ids if job_id in self._vectors
+            }
+
+    def encode_terms(self, weights):
+        """One unit-length query row from {term: weight}; terms outside the vocabulary are dropped."""
+        with self.lock:
+            vocabulary = self.vectorizer.vocabulary_ if self.vectorizer is not None else {}
+            columns = [vocabulary[term] for term in weights if term in vocabulary]
+            data = np.array([weights[term] for term in weights if term in vocabulary], dtype="float32")
+            norm = np.linalg.norm(data)
+            if norm > 0:
+                data /= norm
+            return sparse.csr_matrix((data, columns, [0, len(columns)]), shape=(1, len(vocabulary)))
+
+    def search(self, query_vectors, k, filters=None):
+        """Nearest jobs per query row as lists of (job_id, cosine similarity), best first.
+
+        With filters (see filters.parse_filters) only matching jobs are
+        searched, so a selective filter makes the search cheaper.
+        """
+        with self.lock:
+            if self.index is None:
+                return [[] for _ in range(query_vectors.shape[0])]
+            index, queries, ids = self.index, self._index_input(query_vectors), None
+            if filters:
+                ids = self.filters.ids(filters)
+                if index.kind != "sparse" and len(ids) <= FILTER_EXACT_MAX:
+                    # Few enough matches to score exactly from the stored vectors
+                    index = SparseIndex(query_vectors.shape[1])
+                    index.add(ids, self._stack([self._job_ids[faiss_id] for faiss_id in ids.tolist()]))
+                    queries, ids = query_vectors, None
+            return [
+                [(self._job_ids[faiss_id], score) for faiss_id, score in row]
+                for row in index.search(queries, k, ids=ids)
+            ]
+
+    def matching(self, job_ids, filters):
+        """The jobs among `job_ids` that pass the filters, in the same order."""
+        with self.lock:
+            matches = self.filters.mask(filters)
+            base = self.filters.base
+            return [
+                job_id for job_id in job_ids
+                if job_id in self._faiss_ids and matches[self._faiss_ids[job_id] - base]
+            ]
+
+    def snapshot(self):
+        """Consistent copy of everything needed to restore() this index without refitting.
+
+        "index" holds the serialized faiss index, or None for the sparse
+        kinds, whose index is just the stored rows.
+        """
+        with self.lock:
+            job_ids = list(self.jobs)
+            state = {
+                "version": self.version,
+                "fits": self.fits,
+                "drift_tokens": self._drift_tokens,
+                "drift_unknown": self._drift_unknown,
+                "next_faiss_id": self._next_faiss_id,
+                "jobs": [self.jobs[job_id] for job_id in job_ids],
+                "vocabulary": None,
+            }
+            if self.vectorizer is None:
+                return state
+            vocabulary = [None] * len(self.vectorizer.vocabulary_)
+            for term, column in self.vectorizer.vocabulary_.items():
+                vocabulary[column] = term
+            state.update({
+                "vocabulary": vocabulary,
+                "idf": self.vectorizer.idf_,
+                "rows": self._stack(job_ids),
+                "faiss_ids": np.array([self._faiss_ids[job_id] for job_id in job_ids], dtype="int64"),
+                "projection": self.projection.components_ if self.projection is not None else None,
+                "index_kind": self.index.kind,
+                "index": None if self.index.kind in SPARSE_KINDS else self.index.serialize(),
+                "tombstones": sorted(getattr(self.index, "tombstones", ())),
+            })
+            return state
+
+    def restore(self, state, index=None):
+        """Replace everything with a snapshot() (as read back by persist.py).
+
+        `index` is the already loaded VectorIndex for dense kinds; the sparse
+        kinds' index is rebuilt from the rows.
+        """
+        with self.lock:
+            self.jobs = {job["id"]: job for job in state["jobs"]}
+            self.version = state["version"]
+            self.base_version = self.version
+            self._changed = {}
+            self.fits = state["fits"]
+            self._drift_tokens = state["drift_tokens"]
+            self._drift_unknown = state["drift_unknown"]
+            self._next_faiss_id = state["next_faiss_id"]
+            self._vectors = {}
+            self._faiss_ids = {}
+            self._job_ids = {}
+            if state["vocabulary"] is None:
+                self.vectorizer = None
+                self.projection = None
+                self.index = None
+                self.filters = AttributeIndex()
+                self._terms = None
+                return
+            self.vectorizer = TfidfVectorizer(dtype=np.float32)
+            self.vectorizer.vocabulary_ = {term: column for column, term in enumerate(state["vocabulary"])}
+            self._terms = np.array(state["vocabulary"], dtype=object)
+            self.vectorizer.idf_ = np.asarray(state["idf"])
+            self.projection = None
+            if state["projection"] is not None:
+                self.projection = TruncatedSVD(n_components=state["projection"].shape[0])
+                self.projection.components_ = np.asarray(state["projection"])
+            rows = state["rows"]
+            faiss_ids = np.asarray(state["faiss_ids"], dtype="int64")
+            # Per-job views into the (memory-mapped) row arrays, no copies
+            bounds = np.asarray(rows.indptr[1:-1])
+            self._vectors = dict(zip(self.jobs, zip(
+                np.split(np.asarray(rows.indices), bounds),
+                np.split(np.asarray(rows.data), bounds),
+            )))
+            self._faiss_ids = dict(zip(self.jobs, faiss_ids.tolist()))
+            self._job_ids = dict(zip(faiss_ids.tolist(), self.jobs))
+            if index is None:
+                kind = state.get("index_kind")
+                index = make_index(kind if kind in SPARSE_KINDS else "sparse", rows.shape[1])
+                index.add(faiss_ids, rows)
+            self.index = index
+            self._attach(index)
+            self.filters = AttributeIndex(base=int(faiss_ids.min()) if len(faiss_ids) else 0)
+            jobs = list(self.jobs.values())
+            self.filters.add(faiss_ids, jobs, [job_categories(job) for job in jobs])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "jobs": len(self.jobs),
+                "version": self.version,
+                "fits": self.fits,
+                "terms": len(self.vectorizer.vocabulary_) if self.vectorizer is not None else 0,
+                "index": self.index.kind if self.index is not None else None,
+                "nonZeros": int(sum(len(indices) for indices, _ in self._vectors.values())),
+                "indexBytes": self.index.memory_bytes() if self.index is not None else 0,
+                "filterBytes": self.filters.memory_bytes(),
+                "projected": self.projection is not None,
+                "drift": round(self.drift(), 4),
+            }
@@ -0,0 +1,282 @@
+"""Click events buffered in memory, and trending jobs from a count-min sketch.
+
+/events takes click events without touching the disk: ClickBuffer merges
+them per (user, job) in memory, and every CLICK_FLUSH_SECONDS writes one
+compact aggregate batch per catalog to the click log. Every worker then
+feeds its co-click, profile and trending models from those aggregates, not
+the raw events.
+
+A user's clicks on a job merge into one with their counters summed. Its
+`at` is the single time whose decayed weight equals the clicks' combined
+decayed weight under the profiles' half-life, so profiles come out the
+same as from the separate clicks, and co-click counts and popularity only
+ever looked at the counter sum.
+
+TrendingJobs counts clicks with exponential decay in a count-min sketch,
+which stays a fixed size however many jobs are clicked, and keeps the
+heaviest jobs by sketch estimate as the trending list.
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+
+import numpy as np
+
+from profiles import PROFILE_HALF_LIFE_DAYS, REANCHOR_HALF_LIVES
+
+# Seconds between flushes of buffered events to the click log
+CLICK_FLUSH_SECONDS = float(os.environ.get("RECOMMENDER_CLICK_FLUSH_SECONDS", "5"))
+# Buffered events that trigger a flush before the interval is up
+CLICK_BUFFER_MAX = int(os.environ.get("RECOMMENDER_CLICK_BUFFER_MAX", "10000"))
+# Hours after which a click counts half as much towards trending
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("RECOMMENDER_TRENDING_HALF_LIFE_HOURS", "24"))
+# Jobs kept in the trending list, and the most a request gets
+TRENDING_MAX = int(os.environ.get("RECOMMENDER_TRENDING_MAX", "100"))
+# Counters per sketch row and rows; estimates overshoot by at most about
+# e / width of all clicks, with probability 1 - e^-depth
+SKETCH_WIDTH = int(os.environ.get("RECOMMENDER_SKETCH_WIDTH", "2048"))
+SKETCH_DEPTH = 4
+
+
+def merged_at(at, counter, other_at, other_counter, half_life):
+    """Time at which counter + other_counter clicks weigh what the two groups did, decayed by half_life."""
+    latest = max(at, other_at)
+    weight = counter * 2.0 ** ((at - latest) / half_life) + other_counter * 2.0 ** ((other_at - latest) / half_life)
+    return latest + half_life * math.log2(weight / (counter + other_counter))
+
+
+class ClickBuffer:
+    """Click events per catalog, merged per (user, job) until write(name, clicks) flushes them.
+
+    Events stay in memory until flushed, so a worker that dies without
+    exiting loses at most CLICK_FLUSH_SECONDS of them.
+    """
+
+    def __init__(self, write, interval=CLICK_FLUSH_SECONDS, max_events=CLICK_BUFFER_MAX,
+                 half_life_days=PROFILE_HALF_LIFE_DAYS):
+        self.write = write
+        self.interval = interval
+        self.max_events = max_events
+        self.half_life = half_life_days * 86400
+        self.lock = threading.Lock()
+        # catalog -> {(user id, job id): merged click}, ordered by latest event
+        self._pending = {}
+        self._events = 0
+        self.received = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush_all()
+
+    def add(self, name, clicks):
+        """Buffer {userId, jobId, counter, at} clicks; `at` is set by the caller."""
+        with self.lock:
+            self._merge(name, clicks)
+            self._events += len(clicks)
+            self.received += len(clicks)
+            if self._events >= self.max_events:
+                self._wake.set()
+
+    def _merge(self, name, clicks):
+        pending = self._pending.setdefault(name, {})
+        for click in clicks:
+            key = (click["userId"], click["jobId"])
+            counter = float(click.get("counter", 1) or 1)
+            merged = pending.pop(key, None)
+            if merged is not None:
+                at = merged_at(merged["at"], merged["counter"], float(click["at"]), counter, self.half_life)
+                click = {**merged, "counter": merged["counter"] + counter, "at": at}
+            else:
+                click = {"userId": key[0], "jobId": key[1], "counter": counter, "at": float(click["at"])}
+            # Re-inserted so replays see the pair where its latest event was
+            pending[key] = click
+
+    def flush(self, name):
+        with self.lock:
+            pending = self._pending.pop(name, None)
+        if not pending:
+            return 0
+        clicks = list(pending.values())
+        try:
+            self.write(name, clicks)
+        except Exception:
+            # Kept for the next flush, ahead of anything buffered since
+            with self.lock:
+                later = self._pending.pop(name, {})
+                self._pending[name] = pending
+                self._merge(name, later.values())
+            raise
+        with self.lock:
+            self._events = sum(len(pending) for pending in self._pending.values())
+            self.flushed += len(clicks)
+        return len(clicks)
+
+    def flush_all(self):
+        started = time.perf_counter()
+        flushed = 0
+        for name in list(self._pending):
+            try:
+                flushed += self.flush(name)
+            except Exception as e:
+                print(f"Flushing click events for '{name}' failed: {e}")
+        if flushed:
+            self.flushes += 1
+            self.last_flush_seconds = time.perf_counter() - started
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": sum(len(pending) for pending in self._pending.values()),
+                "received": self.received,
+                "flushed": self.flushed,
+                "flushes": self.flushes,
+                "lastFlushSeconds": round(self.last_flush_seconds, 3),
+                "flushSeconds": self.interval,
+            }
+
+
+class CountMinSketch:
+    """Conservative-update count-min sketch of float weights by hashable key."""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype="float64")
+        self._rows = np.arange(depth)
+
+    def columns(self, keys):
+        """Counter column of each key in every row, shape (len(keys), depth)."""
+        hashes = np.array([
+            np.frombuffer(hashlib.blake2b(repr(key).encode("utf-8"), digest_size=8).digest(), dtype="<u4")
+            for key in keys
+        ], dtype="uint64").reshape(len(keys), 2)
+        # Double hashing: row r uses h1 + r * h2
+        columns = hashes[:, :1] + self._rows.astype("uint64") * (hashes[:, 1:] | np.uint64(1))
+        return (columns % np.uint64(self.width)).astype("int64")
+
+    def estimate(self, columns):
+        return self.table[self._rows, columns].min(axis=1)
+
+    def add(self, columns, weights):
+        """Add weights[i] to the key at columns[i], raising only the counters that are lowest."""
+        for key_columns, weight in zip(columns, weights):
+            counters = self.table[self._rows, key_columns]
+            np.maximum(counters, counters.min() + weight, out=counters)
+            self.table[self._rows, key_columns] = counters
+
+    def scale(self, factor):
+        self.table *= factor
+
+    def memory_bytes(self):
+        return int(self.table.nbytes)
+
+
+class TrendingJobs:
+    """Clicks per job decaying with a half-life, and the most clicked jobs lately.
+
+    Weights grow as 2^((at - anchor) / half_life) like UserProfiles, so old
+    counts never need decaying until the anchor moves. Each batch updates
+    the sketch, then re-estimates the kept jobs and the batch's jobs and
+    keeps the TRENDING_MAX heaviest.
+    """
+
+    def __init__(self, half_life_hours=TRENDING_HALF_LIFE_HOURS, capacity=TRENDING_MAX, width=SKETCH_WIDTH):
+        self.lock = threading.Lock()
+        self.half_life = half_life_hours * 3600
+        self.capacity = capacity
+        self.sketch = CountMinSketch(width)
+        self.anchor = time.time()
+        self.version = 0
+        self.clicks = 0.0
+        # job id -> (sketch columns, estimated weight), heaviest TRENDING_MAX
+        self._top = {}
+
+    def _growth(self, at):
+        exponent = (at - self.anchor) / self.half_life
+        if exponent > REANCHOR_HALF_LIVES:
+            scale = 2.0 ** -exponent
+            self.sketch.scale(scale)
+            self._top = {job_id: (columns, weight * scale) for job_id, (columns, weight) in self._top.items()}
+            self.anchor = at
+            exponent = 0.0
+        return 2.0 ** exponent
+
+    def add_clicks(self, clicks):
+        """Fold {jobId, counter, at} clicks into the sketch and the trending list."""
+        now = time.time()
+        with self.lock:
+            weights = {}
+            for click in clicks:
+                counter = float(click.get("counter", 1) or 1)
+                self.clicks += counter
+                weight = counter * self._growth(float(click.get("at") or now))
+                weights[click["jobId"]] = weights.get(click["jobId"], 0.0) + weight
+            if not weights:
+                return
+            job_ids = list(weights)
+            columns = self.sketch.columns(job_ids)
+            self.sketch.add(columns, [weights[job_id] for job_id in job_ids])
+
+            candidates = {job_id: entry[0] for job_id, entry in self._top.items()}
+            candidates.update(zip(job_ids, columns))
+            job_ids = list(candidates)
+            estimates = self.sketch.estimate(np.array([candidates[job_id] for job_id in job_ids]))
+            order = np.argsort(-estimates, kind="stable")[:self.capacity]
+            self._top = {job_ids[i]: (candidates[job_ids[i]], float(estimates[i])) for i in order.tolist()}
+            self.version += 1
+
+    def snapshot(self):
+        """State restore() rebuilds the sketch and trending list from, as plain values and a numpy array."""
+        with self.lock:
+            return {
+                "table": self.sketch.table.copy(),
+                "anchor": self.anchor,
+                "clicks": self.clicks,
+                "top": [[job_id, weight] for job_id, (_, weight) in self._top.items()],
+            }
+
+    def restore(self, state):
+        """Replace the sketch and trending list with a snapshot() of them."""
+        with self.lock:
+            table = np.asarray(state["table"], dtype="float64")
+            # Sized as saved, so counts keep their columns whatever the width is set to now
+            self.sketch = CountMinSketch(table.shape[1], table.shape[0])
+            self.sketch.table[:] = table
+            self.anchor = state["anchor"]
+            self.clicks = state["clicks"]
+            job_ids = [job_id for job_id, _ in state["top"]]
+            columns = self.sketch.columns(job_ids) if job_ids else []
+            self._top = {job_id: (columns[i], weight) for i, (job_id, weight) in enumerate(state["top"])}
+            self.version += 1
+
+    def top(self, k, now=None):
+        """Up to k (job_id, decayed clicks as of now) pairs, most first."""
+        with self.lock:
+            decay = 2.0 ** ((self.anchor - (now or time.time())) / self.half_life)
+            ranked = sorted(self._top.items(), key=lambda item: -item[1][1])[:k]
+            return [(job_id, weight * decay) for job_id, (_, weight) in ranked]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "clicks": round(self.clicks, 1),
+                "tracked": len(self._top),
+                "sketchBytes": self.sketch.memory_bytes(),
+                "halfLifeHours": round(self.half_life / 3600, 2),
+                "version": self.version,
+            }
@@ -0,0 +1,181 @@
+import os
+import threading
+
+import numpy as np
+from scipy import sparse
+
+# Neighbours kept per job, so serving a co-click recommendation is one lookup
+COCLICK_TOP_K = int(os.environ.get("RECOMMENDER_COCLICK_TOP_K", "50"))
+# Users needed on a job pair before it counts as co-clicked
+COCLICK_MIN_SUPPORT = int(os.environ.get("RECOMMENDER_COCLICK_MIN_SUPPORT", "1"))
+# Most recent distinct jobs remembered per user. Each new click pairs with
+# all of them, so this bounds the work a single click can cause.
+COCLICK_USER_HISTORY = int(os.environ.get("RECOMMENDER_COCLICK_USER_HISTORY", "200"))
+
+
+class CoClickModel:
+    """Item-item similarity from users clicking the same jobs.
+
+    co_counts[i, j] is the number of users who clicked both jobs i and j, and
+    the similarity is that count over sqrt(users(i) * users(j)), i.e. cosine
+    between the jobs' user columns. Click batches only add the new pairs, and
+    only jobs whose scores could have changed get their top-K recomputed.
+    """
+
+    def __init__(self, top_k=COCLICK_TOP_K, min_support=COCLICK_MIN_SUPPORT, user_history=COCLICK_USER_HISTORY):
+        self.lock = threading.Lock()
+        self.top_k = top_k
+        self.min_support = min_support
+        self.user_history = user_history
+        self.version = 0
+        self.co_counts = sparse.csr_matrix((0, 0), dtype="float32")
+        # Distinct users per job and total clicks per job (popularity)
+        self.users = np.zeros(0, dtype="float32")
+        self.clicks = np.zeros(0, dtype="float32")
+        self._rows = {}
+        self._job_ids = []
+        # user id -> {job id: None}, insertion ordered oldest first
+        self._history = {}
+        self._neighbours = {}
+
+    def __len__(self):
+        return len(self._job_ids)
+
+    def _row(self, job_id):
+        row = self._rows.get(job_id)
+        if row is None:
+            row = len(self._job_ids)
+            self._rows[job_id] = row
+            self._job_ids.append(job_id)
+        return row
+
+    def add_clicks(self, clicks):
+        """Fold a batch of {userId, jobId, counter} clicks into the model.
+
+        Returns the number of jobs whose neighbours were recomputed.
+        """
+        with self.lock:
+            pair_rows, pair_cols = [], []
+            new_users = []
+            clicked = {}
+            for click in clicks:
+                user_id, job_id = click["userId"], click["jobId"]
+                row = self._row(job_id)
+                clicked[row] = clicked.get(row, 0) + float(click.get("counter", 1) or 1)
+                history = self._history.setdefault(user_id, {})
+                if job_id in history:
+                    # Only a user's first click on a job adds co-click pairs
+                    history[job_id] = history.pop(job_id)
+                    continue
+                for other in history:
+                    other_row = self._rows[other]
+                    pair_rows += [row, other_row]
+                    pair_cols += [other_row, row]
+                history[job_id] = None
+                new_users.append(row)
+                if len(history) > self.user_history:
+                    del history[next(iter(history))]
+
+            if not clicked:
+                return 0
+            n_jobs = len(self._job_ids)
+            self.users = np.pad(self.users, (0, n_jobs - len(self.users)))
+            self.clicks = np.pad(self.clicks, (0, n_jobs - len(self.clicks)))
+            np.add.at(self.users, np.asarray(new_users, dtype="int64"), 1)
+            for row, count in clicked.items():
+                self.clicks[row] += count
+
+            co_counts = self.co_counts
+            co_counts.resize((n_jobs, n_jobs))
+            if pair_rows:
+                delta = sparse.csr_matrix(
+                    (np.ones(len(pair_rows), dtype="float32"), (pair_rows, pair_cols)),
+                    shape=(n_jobs, n_jobs),
+                )
+                co_counts = co_counts + delta
+            self.co_counts = co_counts
+
+            # A job's user count is in the denominator of every score it takes
+            # part in, so its co-clicked jobs need their rankings refreshed too
+            touched = np.asarray(sorted(clicked), dtype="int64")
+            affected = np.union1d(touched, self.co_counts[touched].indices)
+            self._refresh(affected)
+            self.version += 1
+            return len(affected)
+
+    def _refresh(self, rows):
+        block = self.co_counts[rows].tocsr()
+        block.data[block.data < self.min_support] = 0
+        block.eliminate_zeros()
+        # Row i, column j: co_counts / sqrt(users_i * users_j)
+        inverse_sqrt = 1 / np.sqrt(np.maximum(self.users, 1))
+        block = sparse.diags(inverse_sqrt[rows]) @ block @ sparse.diags(inverse_sqrt)
+        block = block.tocsr()
+        for offset, row in enumerate(rows.tolist()):
+            start, end = block.indptr[offset], block.indptr[offset + 1]
+            columns, scores = block.indices[start:end], block.data[start:end]
+            if len(scores) > self.top_k:
+                top = np.argpartition(-scores, self.top_k - 1)[:self.top_k]
+                columns, scores = columns[top], scores[top]
+            order = np.argsort(-scores)
+            job_id = self._job_ids[row]
+            if len(order):
+                self._neighbours[job_id] = [(self._job_ids[column], float(scores[i])) for column, i in zip(columns[order].tolist(), order)]
+            else:
+                self._neighbours.pop(job_id, None)
+
+    def snapshot(self):
+        """State restore() rebuilds the model from, as plain values and numpy arrays."""
+        with self.lock:
+            co_counts = self.co_counts.tocsr()
+            return {
+                "job_ids": list(self._job_ids),
+                "users": self.users.copy(),
+                "clicks": self.clicks.copy(),
+                "co_counts_indptr": co_counts.indptr.copy(),
+                "co_counts_indices": co_counts.indices.copy(),
+                "co_counts_data": co_counts.data.copy(),
+                "history": [[user_id, list(history)] for user_id, history in self._history.items()],
+            }
+
+    def restore(self, state):
+        """Replace the model with a snapshot() of one, recomputing every job's neighbours."""
+        with self.lock:
+            self._job_ids = list(state["job_ids"])
+            self._rows = {job_id: row for row, job_id in enumerate(self._job_ids)}
+            n_jobs = len(self._job_ids)
+            self.users = np.asarray(state["users"], dtype="float32")
+            self.clicks = np.asarray(state["clicks"], dtype="float32")
+            self.co_counts = sparse.csr_matrix(
+                (state["co_counts_data"], state["co_counts_indices"], state["co_counts_indptr"]),
+                shape=(n_jobs, n_jobs), dtype="float32",
+            )
+            self._history = {user_id: dict.fromkeys(job_ids) for user_id, job_ids in state["history"]}
+            self._neighbours = {}
+            if n_jobs:
+                self._refresh(np.arange(n_jobs))
+            # Moves on from whatever this process had, so nothing cached from it matches
+            self.version += 1
+
+    def neighbours(self, job_id, k=None):
+        """Precomputed (job_id, similarity) co-click neighbours, best first."""
+        found = self._neighbours.get(job_id, [])
+        return found if k is None else found[:k]
+
+    def popularity_scores(self):
+        """{job_id: clicks on a log scale in [0, 1]} for every clicked job."""
+        with self.lock:
+            if not len(self.clicks) or self.clicks.max() <= 0:
+                return {}
+            scores = np.log1p(self.clicks) / np.log1p(self.clicks.max())
+            return dict(zip(self._job_ids, scores.tolist()))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "jobs": len(self._job_ids),
+                "users": len(self._history),
+                "pairs": int(self.co_counts.nnz),
+                "withNeighbours": len(self._neighbours),
+                "version": self.version,
+            }
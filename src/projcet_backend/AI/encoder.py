@@ -0,0 +1,302 @@
+"""Optional sentence-embedding model for jobs and queries.
+
+Set RECOMMENDER_ENCODER_MODEL to a sentence-transformers model, for example
+all-MiniLM-L6-v2, and `pip install sentence-transformers` to enable the
+"semantic" model of /getRecommendation. It matches jobs by meaning
+("React developer" and "Frontend Developer") where TF-IDF only matches
+shared words. Unset, nothing here is loaded.
+
+Job embeddings are cached on disk by a hash of the text they were computed
+from, so a job is encoded once per version across restarts and worker
+processes, and a refresh only encodes the jobs that are new or changed.
+
+    <RECOMMENDER_EMBEDDING_CACHE>/<model>/
+        keys.u64      8-byte content hash per embedding
+        vectors.f32   float32 embeddings, same order
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from catalog import job_text
+from indexes import SPARSE_KINDS, choose_kind, make_index
+from persist import DATA_DIR, locked
+
+ENCODER_MODEL = os.environ.get("RECOMMENDER_ENCODER_MODEL", "")
+# Sentences per forward pass; larger batches keep the CPU busier, up to memory
+ENCODER_BATCH = int(os.environ.get("RECOMMENDER_ENCODER_BATCH", "64"))
+# CPU threads for the model, 0 leaves torch's default
+ENCODER_THREADS = int(os.environ.get("RECOMMENDER_ENCODER_THREADS", "0"))
+# Documents per encode call; each chunk is cached as soon as it is done
+ENCODER_CHUNK = 16 * ENCODER_BATCH
+# Outside the catalogs' namespace: catalog names can't start with a dot
+EMBEDDING_CACHE_DIR = os.environ.get("RECOMMENDER_EMBEDDING_CACHE", os.path.join(DATA_DIR, ".embeddings"))
+# Embeddings are checked for staleness this often even without a nudge
+SEMANTIC_REFRESH_SECONDS = float(os.environ.get("RECOMMENDER_SEMANTIC_REFRESH_SECONDS", "30"))
+
+
+def content_keys(documents):
+    return np.array([
+        int.from_bytes(hashlib.blake2b(document.encode("utf-8"), digest_size=8).digest(), "little")
+        for document in documents
+    ], dtype="uint64")
+
+
+class EmbeddingCache:
+    """Embeddings by content hash in two append-only files shared by every process.
+
+    Lookups are a binary search over the sorted keys, and the vectors stay
+    memory-mapped. Appends are made under locked(directory, "append").
+    """
+
+    def __init__(self, directory, dim):
+        self.directory = directory
+        self.dim = dim
+        self.keys_path = os.path.join(directory, "keys.u64")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self._count = 0
+        self._sorted = np.zeros(0, dtype="uint64")
+        self._order = np.zeros(0, dtype="int64")
+        self._vectors = np.zeros((0, dim), dtype="float32")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return self._count
+
+    def _complete_rows(self):
+        """Rows present in both files; a crash mid-append can leave one file longer."""
+        try:
+            return min(os.path.getsize(self.keys_path) // 8, os.path.getsize(self.vectors_path) // (4 * self.dim))
+        except OSError:
+            return 0
+
+    def refresh(self):
+        """Pick up embeddings appended since the last look, by this process or another."""
+        with self._lock:
+            count = self._complete_rows()
+            if count == self._count:
+                return
+            keys = np.fromfile(self.keys_path, dtype="<u8", count=count)
+            self._order = np.argsort(keys, kind="stable")
+            self._sorted = keys[self._order]
+            self._vectors = np.memmap(self.vectors_path, dtype="float32", mode="r", shape=(count, self.dim))
+            self._count = count
+
+    def lookup(self, keys):
+        """Row of each key, -1 where it isn't cached."""
+        with self._lock:
+            if not self._count:
+                return np.full(len(keys), -1, dtype="int64")
+            positions = np.minimum(np.searchsorted(self._sorted, keys), self._count - 1)
+            return np.where(self._sorted[positions] == keys, self._order[positions], -1)
+
+    def vectors(self, rows):
+        with self._lock:
+            return np.asarray(self._vectors[rows], dtype="float32")
+
+    def append(self, keys, vectors):
+        """Callers hold locked(directory, "append")."""
+        count = self._complete_rows()
+        for path, size in ((self.keys_path, 8 * count), (self.vectors_path, 4 * self.dim * count)):
+            with open(path, "ab") as f:
+                f.truncate(size)
+        with open(self.keys_path, "ab") as f:
+            f.write(np.asarray(keys, dtype="<u8").tobytes())
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        self.refresh()
+
+
+class JobEncoder:
+    """A sentence-transformers model on CPU in front of an EmbeddingCache."""
+
+    def __init__(self, model_name=ENCODER_MODEL, cache_dir=EMBEDDING_CACHE_DIR, batch_size=ENCODER_BATCH):
+        from sentence_transformers import SentenceTransformer
+
+        if ENCODER_THREADS:
+            import torch
+            torch.set_num_threads(ENCODER_THREADS)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.cache = EmbeddingCache(os.path.join(cache_dir, re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)), self.dim)
+        self.cache.refresh()
+        self.encoded = 0
+        self.encode_seconds = 0.0
+
+    def _encode(self, texts):
+        return self.model.encode(
+            list(texts), batch_size=self.batch_size, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False,
+        ).astype("float32")
+
+    def encode_queries(self, texts):
+        """Unit-length embeddings of free-text queries, not cached."""
+        return self._encode(texts)
+
+    def encode_documents(self, documents):
+        """Unit-length embeddings of job documents, encoding only those not cached yet."""
+        keys = content_keys(documents)
+        rows = self.cache.lookup(keys)
+        if (rows < 0).any():
+            self.cache.refresh()
+            rows = self.cache.lookup(keys)
+        if (rows < 0).any():
+            # One process encodes at a time; the others then find its results cached
+            with locked(self.cache.directory, "append"):
+                self.cache.refresh()
+                rows = self.cache.lookup(keys)
+                missing = {}
+                for position in np.flatnonzero(rows < 0).tolist():
+                    missing.setdefault(int(keys[position]), documents[position])
+                missing_keys = list(missing)
+                for start in range(0, len(missing_keys), ENCODER_CHUNK):
+                    chunk = missing_keys[start:start + ENCODER_CHUNK]
+                    started = time.perf_counter()
+                    vectors = self._encode([missing[key] for key in chunk])
+                    self.encode_seconds += time.perf_counter() - started
+                    self.cache.append(np.array(chunk, dtype="uint64"), vectors)
+                    self.encoded += len(chunk)
+                rows = self.cache.lookup(keys)
+        return self.cache.vectors(rows)
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "dim": self.dim,
+            "cached": len(self.cache),
+            "encoded": self.encoded,
+            "encodeSeconds": round(self.encode_seconds, 3),
+            "docsPerSecond": round(self.encoded / self.encode_seconds, 1) if self.encode_seconds else None,
+        }
+
+
+class SemanticIndex:
+    """Embeddings of one catalog's jobs in a faiss index, kept in step with its JobIndex.
+
+    A background thread follows the catalog's version. Each sync works out
+    which jobs' documents changed since the last one, gets embeddings for
+    those only (usually from the cache) and updates the index in place.
+    """
+
+    def __init__(self, encoder, job_index):
+        self.encoder = encoder
+        self.job_index = job_index
+        self.lock = threading.RLock()
+        self.index = None
+        self.synced_version = None
+        self.syncs = 0
+        self.last_sync_seconds = 0.0
+        self._keys = {}
+        self._faiss_ids = {}
+        self._job_ids = {}
+        self._next_faiss_id = 0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def mark_dirty(self):
+        self._wake.set()
+
+    def retarget(self, job_index):
+        """Follow a catalog whose JobIndex was replaced by a new generation."""
+        self.job_index = job_index
+        self.mark_dirty()
+
+    def _run(self):
+        while True:
+            if self.job_index.version != self.synced_version:
+                try:
+                    self.sync()
+                except Exception as e:
+                    print(f"Semantic index sync failed: {e}")
+            self._wake.wait(SEMANTIC_REFRESH_SECONDS)
+            self._wake.clear()
+
+    def sync(self):
+        job_index = self.job_index
+        started = time.perf_counter()
+        with job_index.lock:
+            version = job_index.version
+            jobs = dict(job_index.jobs)
+        documents = {job_id: job_text(job) for job_id, job in jobs.items()}
+        keys = dict(zip(documents, content_keys(list(documents.values())).tolist()))
+        removed = [job_id for job_id in self._keys if job_id not in jobs]
+        changed = [job_id for job_id in jobs if self._keys.get(job_id) != keys[job_id]]
+
+        # A new index when there is none, too many deletions piled up, or every job changed
+        rebuild = self.index is None or self.index.needs_rebuild() or len(changed) == len(jobs)
+        if rebuild:
+            changed, removed = list(jobs), []
+        # Encoding can take a while: searches keep using the current index meanwhile
+        vectors = self.encoder.encode_documents([documents[job_id] for job_id in changed]) if changed else None
+
+        with self.lock:
+            if rebuild:
+                kind = choose_kind(len(jobs))
+                # Embeddings are dense already, the sparse kinds don't apply
+                kind = "flat-ip" if kind in SPARSE_KINDS else kind
+                self.index = make_index(kind, self.encoder.dim, training_vectors=vectors) if changed else None
+                self._keys, self._faiss_ids, self._job_ids = {}, {}, {}
+            self._remove(removed + [job_id for job_id in changed if job_id in self._faiss_ids])
+            if changed:
+                faiss_ids = np.arange(self._next_faiss_id, self._next_faiss_id + len(changed), dtype="int64")
+                self._next_faiss_id += len(changed)
+                for job_id, faiss_id in zip(changed, faiss_ids.tolist()):
+                    self._keys[job_id] = keys[job_id]
+                    self._faiss_ids[job_id] = faiss_id
+                    self._job_ids[faiss_id] = job_id
+                self.index.add(faiss_ids, vectors)
+            self.synced_version = version
+        self.syncs += 1
+        self.last_sync_seconds = time.perf_counter() - started
+        if changed or removed:
+            print(f"Synced semantic index: {len(changed)} encoded or cached, {len(removed)} removed in {self.last_sync_seconds:.2f}s")
+
+    def _remove(self, job_ids):
+        faiss_ids = [self._faiss_ids.pop(job_id) for job_id in job_ids if job_id in self._faiss_ids]
+        for faiss_id in faiss_ids:
+            del self._keys[self._job_ids.pop(faiss_id)]
+        if faiss_ids and self.index is not None:
+            self.index.remove(faiss_ids)
+
+    def vectors(self, job_ids):
+        """(found job ids, their embeddings), read back from the cache."""
+        with self.lock:
+            found = [job_id for job_id in job_ids if job_id in self._keys]
+            keys = np.array([self._keys[job_id] for job_id in found], dtype="uint64")
+        if not found:
+            return [], None
+        return found, self.encoder.cache.vectors(self.encoder.cache.lookup(keys))
+
+    def search(self, query_vectors, k):
+        """Nearest jobs per query row as lists of (job_id, cosine similarity), best first."""
+        with self.lock:
+            if self.index is None:
+                return [[] for _ in range(len(query_vectors))]
+            return [
+                [(self._job_ids[faiss_id], score) for faiss_id, score in row]
+                for row in self.index.search(query_vectors, k)
+            ]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "jobs": len(self._keys),
+                "index": self.index.kind if self.index is not None else None,
+                "syncs": self.syncs,
+                "lastSyncSeconds": round(self.last_sync_seconds, 3),
+                "stale": self.job_index.version != self.synced_version,
+                "encoder": self.encoder.stats(),
+            }
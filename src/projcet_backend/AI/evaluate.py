@@ -0,0 +1,249 @@
+"""Offline quality and latency of the recommender on synthetic catalogs and click logs.
+
+Generates canister-shaped job catalogs whose tags follow per-project-type
+Zipf distributions, and users who mostly click jobs of one or two project
+types, favouring the popular ones. Every click but each user's last is
+replayed into the co-click model; the last one is held out. A user's
+previous click is then the query, and the held-out job the answer.
+
+Per catalog size and index kind the report has build time, index memory,
+and for every model recall@k, NDCG@k, coverage (queries with any result)
+and per-query p50/p99 latency. Runs with the same arguments and seed are
+directly comparable.
+
+    python evaluate.py --jobs 1000 10000 100000 --k 10 --out report.json
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from bench_index import percentile_ms
+from catalog import JobIndex
+from cofilter import CoClickModel
+from indexes import INDEX_KINDS
+from ranker import HybridRanker
+
+MODELS = ("content", "coclick", "hybrid")
+PROJECT_TYPES = 20
+STATUSES = ("Open", "Open", "Open", "Ongoing", "Finished")
+# Share of a job's tags drawn from its project type's own tags rather than the global mix
+TYPE_TAG_SHARE = 0.8
+# Share of a user's clicks on their main project type
+MAIN_TYPE_SHARE = 0.8
+
+
+def zipf_weights(n, exponent=1.0):
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    return weights / weights.sum()
+
+
+def synthetic_jobs(n_jobs, n_tags, seed=0):
+    """Canister-style jobs with 2-6 tags each, mostly from their project type's Zipf-ranked tags."""
+    rng = np.random.default_rng(seed)
+    types = rng.choice(PROJECT_TYPES, size=n_jobs, p=zipf_weights(PROJECT_TYPES, 0.8))
+    type_tags = np.stack([rng.permutation(n_tags)[:30] for _ in range(PROJECT_TYPES)])
+    sizes = rng.integers(2, 7, size=n_jobs)
+    slot_jobs = np.repeat(np.arange(n_jobs), sizes)
+    from_type = rng.random(len(slot_jobs)) < TYPE_TAG_SHARE
+    tags = np.where(
+        from_type,
+        type_tags[types[slot_jobs], rng.choice(type_tags.shape[1], size=len(slot_jobs), p=zipf_weights(type_tags.shape[1]))],
+        rng.choice(n_tags, size=len(slot_jobs), p=zipf_weights(n_tags)),
+    )
+    bounds = np.concatenate([[0], np.cumsum(sizes)]).tolist()
+    tags = tags.tolist()
+    salaries = np.round(rng.lognormal(6, 1, size=n_jobs), 2).tolist()
+    statuses = rng.choice(len(STATUSES), size=n_jobs).tolist()
+    return [
+        {
+            "id": str(i),
+            "jobName": f"Type {types[i]} job {i}",
+            "jobTags": [{"id": str(tag), "jobCategoryName": f"tag{tag}"} for tag in dict.fromkeys(tags[bounds[i]:bounds[i + 1]])],
+            "jobProjectType": "one-time" if i % 3 else "ongoing",
+            "jobSalary": salaries[i],
+            "jobStatus": STATUSES[statuses[i]],
+            "jobRequirementSkills": [],
+            "createdAt": i,
+            "updatedAt": i,
+        }
+        for i in range(n_jobs)
+    ], types
+
+
+def synthetic_clicks(types, n_users, seed=0):
+    """Time-ordered {userId, jobId, counter} clicks; users favour one project type and its popular jobs."""
+    rng = np.random.default_rng(seed + 1)
+    # Jobs of each type in popularity order
+    by_type = [rng.permutation(np.flatnonzero(types == t)) for t in range(PROJECT_TYPES)]
+    populated = [t for t in range(PROJECT_TYPES) if len(by_type[t])]
+    main_types = rng.choice(populated, size=n_users, p=zipf_weights(len(populated), 0.8))
+    lengths = np.minimum(1 + rng.geometric(0.15, size=n_users), 50)
+    users = np.repeat(np.arange(n_users), lengths)
+    click_types = np.where(
+        rng.random(len(users)) < MAIN_TYPE_SHARE,
+        main_types[users],
+        rng.choice(populated, size=len(users)),
+    )
+    ranks = rng.zipf(1.3, size=len(users)) - 1
+    job_rows = [int(by_type[t][rank % len(by_type[t])]) for t, rank in zip(click_types.tolist(), ranks.tolist())]
+    counters = rng.integers(1, 4, size=len(users)).tolist()
+    # Users click at random times, so batches interleave them
+    order = np.argsort(rng.random(len(users)), kind="stable")
+    clicks = [
+        {"userId": f"user{users[i]}", "jobId": str(job_rows[i]), "counter": counters[i]}
+        for i in order.tolist()
+    ]
+    return clicks
+
+
+def split_clicks(clicks):
+    """(training clicks, [(query job, held-out job)]) holding out each user's last click.
+
+    The query is the user's click just before it; users whose last two
+    clicks are the same job have nothing to predict and keep all their clicks.
+    """
+    last = {}
+    previous = {}
+    for position, click in enumerate(clicks):
+        user = click["userId"]
+        if user in last:
+            previous[user] = last[user]
+        last[user] = position
+    held_out = set()
+    cases = []
+    for user, position in last.items():
+        if user not in previous or clicks[previous[user]]["jobId"] == clicks[position]["jobId"]:
+            continue
+        held_out.add(position)
+        cases.append((clicks[previous[user]]["jobId"], clicks[position]["jobId"]))
+    training = [click for position, click in enumerate(clicks) if position not in held_out]
+    return training, cases
+
+
+def score_cases(recommend, cases, k):
+    """recall@k, NDCG@k, coverage and latency of `recommend(query job, k)` over the cases."""
+    hits = []
+    gains = []
+    answered = 0
+    latencies = []
+    for query, expected in cases:
+        started = time.perf_counter()
+        row = recommend(query, k + 1)
+        latencies.append(time.perf_counter() - started)
+        ranked = [job_id for job_id, _ in row if job_id != query][:k]
+        answered += bool(ranked)
+        rank = ranked.index(expected) if expected in ranked else None
+        hits.append(rank is not None)
+        gains.append(0.0 if rank is None else 1 / np.log2(rank + 2))
+    return {
+        f"recall@{k}": round(float(np.mean(hits)), 4),
+        f"ndcg@{k}": round(float(np.mean(gains)), 4),
+        "coverage": round(answered / max(1, len(cases)), 4),
+        "p50_ms": percentile_ms(latencies, 0.5),
+        "p99_ms": percentile_ms(latencies, 0.99),
+    }
+
+
+def content_recommender(job_index):
+    def recommend(query, k):
+        found, vectors = job_index.vectors([query])
+        return job_index.search(vectors, k)[0] if found else []
+    return recommend
+
+
+def evaluate(n_jobs, n_tags, n_users, k, n_queries, kinds, models, batch_size, seed=0):
+    jobs, types = synthetic_jobs(n_jobs, n_tags, seed)
+    clicks = synthetic_clicks(types, n_users, seed)
+    training, cases = split_clicks(clicks)
+    rng = np.random.default_rng(seed + 2)
+    if len(cases) > n_queries:
+        cases = [cases[i] for i in sorted(rng.choice(len(cases), size=n_queries, replace=False))]
+
+    started = time.perf_counter()
+    coclick = CoClickModel()
+    for start in range(0, len(training), batch_size):
+        coclick.add_clicks(training[start:start + batch_size])
+    replay_seconds = time.perf_counter() - started
+
+    backends = {}
+    for kind in kinds:
+        started = time.perf_counter()
+        job_index = JobIndex(jobs, kind=kind)
+        build_seconds = time.perf_counter() - started
+        stats = job_index.stats()
+        backend = {
+            "built_as": stats["index"],
+            "build_seconds": round(build_seconds, 3),
+            "index_mb": round(stats["indexBytes"] / 2**20, 2),
+            "projected": stats["projected"],
+            "models": {},
+        }
+        if "content" in models:
+            backend["models"]["content"] = score_cases(content_recommender(job_index), cases, k)
+        if "coclick" in models:
+            backend["models"]["coclick"] = score_cases(coclick.neighbours, cases, k)
+        if "hybrid" in models:
+            ranker = HybridRanker(job_index, coclick)
+            started = time.perf_counter()
+            ranker.rebuild()
+            backend["tables_seconds"] = round(time.perf_counter() - started, 3)
+            backend["models"]["hybrid"] = score_cases(ranker.rank, cases, k)
+        backends[kind] = backend
+
+    return {
+        "jobs": n_jobs,
+        "users": n_users,
+        "clicks": len(clicks),
+        "training_clicks": len(training),
+        "queries": len(cases),
+        "replay_seconds": round(replay_seconds, 3),
+        "backends": backends,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate recommender quality and latency offline")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--tags", type=int, default=300)
+    parser.add_argument("--users", type=int, help="default: one per 5 jobs, at least 200")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--kinds", nargs="+", choices=INDEX_KINDS, default=list(INDEX_KINDS))
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=list(MODELS))
+    parser.add_argument("--batch", type=int, default=1000, help="clicks per replayed /clicks batch")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="also write the JSON report to this file")
+    parser.add_argument("--json", action="store_true", help="print the raw report as JSON")
+    args = parser.parse_args()
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("out", "json")},
+        "catalogs": [
+            evaluate(
+                n_jobs, args.tags, args.users or max(200, n_jobs // 5), args.k, args.queries,
+                args.kinds, args.models, args.batch, args.seed,
+            )
+            for n_jobs in args.jobs
+        ],
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    k = args.k
+    for catalog in report["catalogs"]:
+        print(f"\n{catalog['jobs']} jobs, {catalog['users']} users, {catalog['training_clicks']} clicks replayed "
+              f"in {catalog['replay_seconds']}s, {catalog['queries']} held-out queries")
+        print(f"{'index':<10}{'model':<10}{'build s':>10}{'index MB':>10}{'recall@' + str(k):>12}{'ndcg@' + str(k):>10}{'p50 ms':>10}{'p99 ms':>10}")
+        for kind, backend in catalog["backends"].items():
+            for model, row in backend["models"].items():
+                print(f"{kind:<10}{model:<10}{backend['build_seconds']:>10}{backend['index_mb']:>10}"
+                      f"{row[f'recall@{k}']:>12}{row[f'ndcg@{k}']:>10}{row['p50_ms']:>10}{row['p99_ms']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from array import array
+
+import numpy as np
+
+# Single-valued job fields filterable by exact value, with the filter key
+# requests use for each. Values are compared case-insensitively.
+VALUE_FIELDS = {"status": "jobStatus", "projectType": "jobProjectType"}
+FILTER_KEYS = (*VALUE_FIELDS, "tags", "salaryMin", "salaryMax")
+
+
+def normalized_value(value):
+    return str(value).strip().lower()
+
+
+def parse_filters(raw):
+    """Validated filters from a request body, or None when there are none.
+
+    {"status": "Open" or [...], "projectType": ..., "tags": [...],
+    "salaryMin": 100, "salaryMax": 500}. Several values for a field match
+    any of them; different fields must all match. Raises ValueError.
+    """
+    if raw is None:
+        return None
+    if not isinstance(raw, dict):
+        raise ValueError("filters must be an object")
+    unknown = set(raw) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filters {', '.join(sorted(unknown))}, expected {', '.join(FILTER_KEYS)}")
+    filters = {}
+    for key in (*VALUE_FIELDS, "tags"):
+        if key in raw:
+            values = raw[key] if isinstance(raw[key], list) else [raw[key]]
+            filters[key] = frozenset(normalized_value(value) for value in values)
+    for key in ("salaryMin", "salaryMax"):
+        if raw.get(key) is not None:
+            try:
+                filters[key] = float(raw[key])
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} must be a number")
+    return filters or None
+
+
+class AttributeIndex:
+    """Bitmaps and inverted lists over job attributes, addressed by faiss id.
+
+    Status and project type have few values, so each value gets a bitmap;
+    tags are many, so each gets an inverted list of rows; salary is one
+    float column compared in a single vectorized pass. A filter becomes one
+    bitmap of matching rows, and a row is a faiss id minus `base`.
+
+    Not locked: JobIndex changes and reads it under its own lock. Removed
+    rows are only cleared from `alive`; the index is built again together
+    with the vector index, which compacts both.
+    """
+
+    def __init__(self, base=0):
+        self.base = base
+        self.size = 0
+        self.alive = np.zeros(0, dtype=bool)
+        self.salary = np.zeros(0, dtype="float32")
+        self.values = {field: {} for field in VALUE_FIELDS}
+        self.tags = {}
+
+    def _reserve(self, size):
+        capacity = len(self.alive)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 1024)
+        self.alive = np.pad(self.alive, (0, capacity - len(self.alive)))
+        self.salary = np.pad(self.salary, (0, capacity - len(self.salary)), constant_values=np.nan)
+        for bitmaps in self.values.values():
+            for value, bitmap in bitmaps.items():
+                bitmaps[value] = np.pad(bitmap, (0, capacity - len(bitmap)))
+
+    def add(self, faiss_ids, jobs, tag_lists):
+        """Index jobs under their faiss ids, with each job's tags from tag_lists."""
+        rows = np.asarray(faiss_ids, dtype="int64") - self.base
+        if not len(rows):
+            return
+        self._reserve(int(rows.max()) + 1)
+        self.size = max(self.size, int(rows.max()) + 1)
+        self.alive[rows] = True
+        capacity = len(self.alive)
+        for row, job, tags in zip(rows.tolist(), jobs, tag_lists):
+            try:
+                self.salary[row] = float(job.get("jobSalary"))
+            except (TypeError, ValueError):
+                self.salary[row] = np.nan
+            for key, field in VALUE_FIELDS.items():
+                if job.get(field) is not None:
+                    bitmaps = self.values[key]
+                    value = normalized_value(job[field])
+                    if value not in bitmaps:
+                        bitmaps[value] = np.zeros(capacity, dtype=bool)
+                    bitmaps[value][row] = True
+            for tag in set(normalized_value(tag) for tag in tags):
+                self.tags.setdefault(tag, array("q")).append(row)
+
+    def remove(self, faiss_ids):
+        rows = np.asarray(faiss_ids, dtype="int64") - self.base
+        self.alive[rows[(rows >= 0) & (rows < self.size)]] = False
+
+    def mask(self, filters):
+        """Bitmap of the rows matching every filter."""
+        matches = self.alive[:self.size].copy()
+        for key in VALUE_FIELDS:
+            if key in filters:
+                bitmaps = self.values[key]
+                field = np.zeros(self.size, dtype=bool)
+                for value in filters[key]:
+                    if value in bitmaps:
+                        field |= bitmaps[value][:self.size]
+                matches &= field
+        if "tags" in filters:
+            tagged = np.zeros(self.size, dtype=bool)
+            for tag in filters["tags"]:
+                if tag in self.tags:
+                    tagged[np.frombuffer(self.tags[tag], dtype="int64")] = True
+            matches &= tagged
+        salary = self.salary[:self.size]
+        if "salaryMin" in filters:
+            matches &= salary >= filters["salaryMin"]
+        if "salaryMax" in filters:
+            matches &= salary <= filters["salaryMax"]
+        return matches
+
+    def ids(self, filters):
+        """Sorted faiss ids of the live jobs matching every filter."""
+        return np.flatnonzero(self.mask(filters)) + self.base
+
+    def memory_bytes(self):
+        bitmaps = sum(bitmap.nbytes for bitmaps in self.values.values() for bitmap in bitmaps.values())
+        lists = sum(rows.itemsize * len(rows) for rows in self.tags.values())
+        return int(self.alive.nbytes + self.salary.nbytes + bitmaps + lists)
+
+    def stats(self):
+        return {
+            **{key: len(bitmaps) for key, bitmaps in self.values.items()},
+            "tags": len(self.tags),
+            "bytes": self.memory_bytes(),
+        }
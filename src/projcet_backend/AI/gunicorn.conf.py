@@ -0,0 +1,62 @@
+"""Production server for the recommender: gunicorn -c gunicorn.conf.py
+
+Run from this directory. `kill -HUP <master pid>` starts fresh workers on the
+current code and catalog generations and lets the old ones finish their
+requests before exiting, so a reload drops nothing. `python main.py` is the
+debug server for development only.
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+
+bind = f"{os.environ.get('RECOMMENDER_HOST', '0.0.0.0')}:{os.environ.get('RECOMMENDER_PORT', '5001')}"
+workers = int(os.environ.get("RECOMMENDER_WORKERS", str(min(4, multiprocessing.cpu_count()))))
+# Workers read it back to split the cores between their index shards
+os.environ["RECOMMENDER_WORKERS"] = str(workers)
+# Threads per worker; searches spend most of their time in numpy/faiss with the GIL released
+worker_class = "gthread"
+threads = int(os.environ.get("RECOMMENDER_THREADS", "4"))
+# A worker with a request running longer than this is killed and replaced.
+# gthread workers heartbeat from their main loop, not the request threads,
+# so gunicorn's own timeout never sees a stuck request; request_watchdog does.
+timeout = int(os.environ.get("RECOMMENDER_REQUEST_TIMEOUT", "30"))
+graceful_timeout = 30
+keepalive = 5
+wsgi_app = "main:app"
+# Each worker loads the catalogs itself. Arrays and faiss indexes are
+# memory-mapped from the data directory, so the page cache holds one copy for
+# all of them, and a HUP re-imports the code instead of forking stale state.
+preload_app = False
+
+
+# Request thread -> monotonic time its current request started, in this worker
+request_starts = {}
+
+
+def pre_request(worker, req):
+    request_starts[threading.get_ident()] = time.monotonic()
+
+
+def post_request(worker, req, environ, resp):
+    request_starts.pop(threading.get_ident(), None)
+
+
+def request_watchdog(worker):
+    while True:
+        time.sleep(1)
+        started = min(request_starts.values(), default=None)
+        if started is not None and time.monotonic() - started > worker.cfg.timeout:
+            worker.log.critical(f"Request running for over {worker.cfg.timeout}s, restarting worker {os.getpid()}")
+            # A stuck thread can't be stopped, and would keep a normal exit waiting on it
+            os._exit(1)
+
+
+def post_worker_init(worker):
+    import main
+    main.start_background()
+    # Buffered /events would be lost with the worker otherwise. worker_exit
+    # can't do this: it runs in the master, after the worker is gone.
+    atexit.register(main.click_buffer.flush_all)
+    threading.Thread(target=request_watchdog, args=(worker,), daemon=True).start()
@@ -0,0 +1,307 @@
+import math
+import os
+
+import faiss
+import numpy as np
+from scipy import sparse
+
+# Which index backs a catalog: sparse (exact cosine on the sparse TF-IDF
+# matrix), sharded (the same, split across shard processes, see shards.py),
+# flat-l2 (the original exact L2 scan), flat-ip (exact cosine), hnsw, ivf,
+# or auto to pick by catalog size. auto never shards.
+RECOMMENDER_INDEX = os.environ.get("RECOMMENDER_INDEX", "auto")
+# auto switches from exact sparse search to IVF at this catalog size. On tag-style
+# TF-IDF vectors (bench_index.py) sparse search is ~2.5ms p50 at 100k jobs and
+# holds only the non-zero weights, while IVF needs a dense (projected) copy of
+# every vector and a long training pass. HNSW loses recall badly on the many
+# duplicate vectors there, so auto only uses it when RECOMMENDER_HNSW_MIN_JOBS
+# is set.
+IVF_MIN_JOBS = int(os.environ.get("RECOMMENDER_IVF_MIN_JOBS", "250000"))
+HNSW_MIN_JOBS = int(os.environ.get("RECOMMENDER_HNSW_MIN_JOBS", "0"))
+HNSW_M = int(os.environ.get("RECOMMENDER_HNSW_M", "32"))
+HNSW_EF_SEARCH = int(os.environ.get("RECOMMENDER_HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.environ.get("RECOMMENDER_IVF_NPROBE", "16"))
+# Rebuild an index once this share of its entries are deleted-but-present
+TOMBSTONE_REBUILD_RATIO = 0.2
+# A filtered sparse search scores only the matching rows when they are less
+# than this share of the index, and scores everything then masks otherwise
+SUBSET_SLICE_RATIO = 0.25
+
+# Dense faiss kinds see TF-IDF vectors projected down to this many dimensions
+# (TruncatedSVD) once the vocabulary is larger than that
+DENSE_DIM = int(os.environ.get("RECOMMENDER_DENSE_DIM", "128"))
+
+INDEX_KINDS = ("sparse", "sharded", "flat-l2", "flat-ip", "hnsw", "ivf")
+# Kinds that search the sparse rows as they are, without a dense projection
+SPARSE_KINDS = ("sparse", "sharded")
+
+
+def choose_kind(n_jobs, kind=RECOMMENDER_INDEX):
+    if kind != "auto":
+        return kind
+    if HNSW_MIN_JOBS and HNSW_MIN_JOBS <= n_jobs < IVF_MIN_JOBS:
+        return "hnsw"
+    if n_jobs >= IVF_MIN_JOBS:
+        return "ivf"
+    return "sparse"
+
+
+def normalized(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def kth_largest(values, k):
+    return np.partition(values, len(values) - k)[len(values) - k]
+
+
+def make_index(kind, dim, training_vectors=None):
+    if kind == "sparse":
+        return SparseIndex(dim)
+    if kind == "sharded":
+        from shards import ShardedIndex
+        return ShardedIndex(dim)
+    return VectorIndex(kind, dim, training_vectors=training_vectors)
+
+
+class SparseIndex:
+    """Exact cosine search straight on L2-normalized sparse rows.
+
+    Memory is the CSR matrix itself, so it grows with the number of non-zero
+    TF-IDF weights rather than jobs x vocabulary. Deleted rows are masked
+    until needs_rebuild() asks for a compaction.
+    """
+
+    kind = "sparse"
+
+    def __init__(self, dim):
+        self.dim = dim
+        self._matrix = sparse.csr_matrix((0, dim), dtype="float32")
+        self._ids = np.zeros(0, dtype="int64")
+        self._alive = np.zeros(0, dtype=bool)
+        self._rows = {}
+        self._id_order = None
+
+    @property
+    def ntotal(self):
+        return len(self._rows)
+
+    def add(self, ids, rows):
+        ids = np.asarray(ids, dtype="int64")
+        start = self._matrix.shape[0]
+        if start == 0:
+            # No copy, so rows loaded memory-mapped stay that way
+            self._matrix = sparse.csr_matrix(rows, dtype="float32", copy=False)
+        else:
+            self._matrix = sparse.vstack([self._matrix, sparse.csr_matrix(rows, dtype="float32")], format="csr")
+        self._ids = np.concatenate([self._ids, ids])
+        self._alive = np.concatenate([self._alive, np.ones(len(ids), dtype=bool)])
+        self._id_order = None
+        for offset, faiss_id in enumerate(ids.tolist()):
+            self._rows[faiss_id] = start + offset
+
+    def remove(self, ids):
+        for faiss_id in ids:
+            row = self._rows.pop(int(faiss_id), None)
+            if row is not None:
+                self._alive[row] = False
+
+    def needs_rebuild(self):
+        dead = len(self._alive) - len(self._rows)
+        return dead > TOMBSTONE_REBUILD_RATIO * max(1, len(self._alive))
+
+    def memory_bytes(self):
+        return int(self._matrix.data.nbytes + self._matrix.indices.nbytes + self._matrix.indptr.nbytes)
+
+    def _rows_of(self, ids):
+        """Live rows holding `ids`, found with a binary search over the ids."""
+        if not len(self._ids):
+            return np.zeros(0, dtype="int64")
+        if self._id_order is None:
+            # Ids are added in increasing order except in restored catalogs,
+            # and usually without gaps, where the row is just an offset
+            ordered = bool(np.all(self._ids[1:] > self._ids[:-1]))
+            if ordered and self._ids[-1] - self._ids[0] == len(self._ids) - 1:
+                self._id_order = "contiguous"
+            else:
+                order = None if ordered else np.argsort(self._ids, kind="stable")
+                self._id_order = (self._ids if ordered else self._ids[order], order)
+        if isinstance(self._id_order, str):
+            rows = ids - self._ids[0]
+            rows = rows[(rows >= 0) & (rows < len(self._ids))]
+        else:
+            sorted_ids, order = self._id_order
+            positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+            rows = positions[sorted_ids[positions] == ids]
+            if order is not None:
+                rows = order[rows]
+        return rows[self._alive[rows]]
+
+    def search(self, queries, k, ids=None):
+        """Per query row, up to k (id, cosine similarity) pairs among jobs sharing a term.
+
+        `ids` restricts the results to those ids.
+        """
+        matrix, row_ids, alive = self._matrix, self._ids, self._alive
+        live = len(self._rows)
+        if ids is not None:
+            rows = self._rows_of(np.asarray(ids, dtype="int64"))
+            live = len(rows)
+            if live < SUBSET_SLICE_RATIO * len(row_ids):
+                matrix, row_ids, alive = matrix[rows], row_ids[rows], np.ones(live, dtype=bool)
+            else:
+                alive = np.zeros(len(row_ids), dtype=bool)
+                alive[rows] = True
+        # Share of rows that may be returned: the best few candidates are
+        # checked first, enough to expect k survivors twice over
+        share = live / max(1, len(row_ids))
+        # (queries x jobs) stays sparse: only jobs sharing a term with the query get a score
+        scores = sparse.csr_matrix(queries, dtype="float32") @ matrix.T
+        scores = scores.tocsr()
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            columns = scores.indices[start:end]
+            values = scores.data[start:end]
+            fetch = int(2 * k / max(share, 1e-9)) + 1
+            while True:
+                # Everything scoring at least the fetch-th best, ties included
+                top = np.flatnonzero(values >= kth_largest(values, fetch)) if fetch < len(values) else np.arange(len(values))
+                top = top[alive[columns[top]]]
+                if len(top) >= k or fetch >= len(values):
+                    break
+                fetch *= 4
+            columns, values = columns[top], values[top]
+            if len(values) > k:
+                keep = values >= kth_largest(values, k)
+                columns, values = columns[keep], values[keep]
+            # Best first and ties by id, so the top k don't depend on row order
+            # and shards (see shards.py) pick exactly what one index would
+            order = np.lexsort((row_ids[columns], -values))[:k]
+            results.append(list(zip(row_ids[columns[order]].tolist(), values[order].tolist())))
+        return results
+
+
+class VectorIndex:
+    """A faiss index over unit vectors that reports cosine similarity for every kind.
+
+    HNSW can't delete entries, so removed ids are kept as tombstones that
+    searches skip until needs_rebuild() asks for a fresh index.
+    """
+
+    def __init__(self, kind, dim, training_vectors=None):
+        if kind not in INDEX_KINDS or kind in SPARSE_KINDS:
+            dense_kinds = [kind for kind in INDEX_KINDS if kind not in SPARSE_KINDS]
+            raise ValueError(f"Unknown dense index kind '{kind}', expected one of {dense_kinds}")
+        if kind == "ivf":
+            n_train = 0 if training_vectors is None else len(training_vectors)
+            nlist = max(1, min(int(4 * math.sqrt(max(n_train, 1))), n_train // 39))
+            if nlist < 2:
+                # Too few jobs to train meaningful clusters
+                kind = "flat-ip"
+        self.kind = kind
+        self.dim = dim
+        self.tombstones = set()
+        self._mapped_from = None
+        if kind == "flat-l2":
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        elif kind == "flat-ip":
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        elif kind == "hnsw":
+            hnsw = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            hnsw.hnsw.efSearch = HNSW_EF_SEARCH
+            self.index = faiss.IndexIDMap2(hnsw)
+        else:
+            quantizer = faiss.IndexFlatIP(dim)
+            self.index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            self.index.train(normalized(training_vectors))
+            self.index.nprobe = IVF_NPROBE
+            self._quantizer = quantizer
+
+    @classmethod
+    def read(cls, path, kind, tombstones=()):
+        """Load an index written by serialize(). IVF lists stay memory-mapped until the first change."""
+        vector_index = cls.__new__(cls)
+        vector_index.kind = kind
+        vector_index.tombstones = set(tombstones)
+        vector_index.index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        vector_index.dim = vector_index.index.d
+        vector_index._mapped_from = path if kind == "ivf" else None
+        vector_index._tune()
+        return vector_index
+
+    def _tune(self):
+        if self.kind == "ivf":
+            self.index.nprobe = IVF_NPROBE
+        elif self.kind == "hnsw":
+            faiss.downcast_index(self.index.index).hnsw.efSearch = HNSW_EF_SEARCH
+
+    def _writable(self):
+        # Memory-mapped inverted lists are read-only, load a private copy to change them
+        if self._mapped_from is not None:
+            self.index = faiss.read_index(self._mapped_from)
+            self._mapped_from = None
+            self._tune()
+
+    def serialize(self):
+        self._writable()
+        return faiss.serialize_index(self.index)
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal - len(self.tombstones)
+
+    def add(self, ids, vectors):
+        self._writable()
+        ids = np.asarray(ids, dtype="int64")
+        self.tombstones.difference_update(ids.tolist())
+        self.index.add_with_ids(normalized(vectors), ids)
+
+    def remove(self, ids):
+        if not len(ids):
+            return
+        if self.kind == "hnsw":
+            self.tombstones.update(int(faiss_id) for faiss_id in ids)
+        else:
+            self._writable()
+            self.index.remove_ids(np.asarray(ids, dtype="int64"))
+
+    def needs_rebuild(self):
+        return len(self.tombstones) > TOMBSTONE_REBUILD_RATIO * max(1, self.index.ntotal)
+
+    def memory_bytes(self):
+        return int(self.index.ntotal * self.dim * 4)
+
+    def _search_params(self, selector):
+        if self.kind == "ivf":
+            return faiss.SearchParametersIVF(sel=selector, nprobe=IVF_NPROBE)
+        if self.kind == "hnsw":
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=HNSW_EF_SEARCH)
+        return faiss.SearchParameters(sel=selector)
+
+    def search(self, queries, k, ids=None):
+        """Per query row, up to k (faiss id, cosine similarity) pairs, best first.
+
+        `ids` restricts the results to those ids, skipping every other
+        entry inside faiss rather than filtering what it returns.
+        """
+        if self.ntotal == 0 or (ids is not None and not len(ids)):
+            return [[] for _ in range(len(queries))]
+        fetch = min(k + len(self.tombstones), self.index.ntotal)
+        params = None
+        if ids is not None:
+            selector = faiss.IDSelectorBatch(np.asarray(ids, dtype="int64"))
+            params = self._search_params(selector)
+        scores, ids = self.index.search(normalized(queries), fetch, params=params)
+        if self.kind == "flat-l2":
+            # Squared L2 between unit vectors is 2 - 2cos
+            scores = 1 - scores / 2
+        results = []
+        for id_row, score_row in zip(ids.tolist(), scores.tolist()):
+            row = [
+                (faiss_id, score) for faiss_id, score in zip(id_row, score_row)
+                if faiss_id != -1 and faiss_id not in self.tombstones
+            ]
+            results.append(row[:k])
+        return results
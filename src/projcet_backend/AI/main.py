@@ -59,64 +59,749 @@
 #     })
 
 
-import faiss
-import numpy as np
+import base64
+import binascii
+import hashlib
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from sklearn.feature_extraction.text import TfidfVectorizer
+
+from bm25 import BM25Index
+from cache import ResultCache
+from catalog import JobIndex, job_error, job_summary
+from clickstream import TRENDING_MAX, ClickBuffer, TrendingJobs
+from cofilter import CoClickModel
+from encoder import ENCODER_MODEL, JobEncoder, SemanticIndex
+from filters import parse_filters
+from persist import (
+    DATA_DIR, CATALOG_NAME, ClickLog, GenerationWatcher, JsonLog,
+    compaction_due, load_catalogs, locked, save_catalog, save_changes,
+)
+from profiles import UserProfiles
+from ranker import DEFAULT_DIVERSITY, SIGNALS, HybridRanker, mmr, mmr_candidates
+from refresher import CatalogRefresher
+from typeahead import KINDS as TYPEAHEAD_KINDS, TYPEAHEAD_MAX, Typeahead
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "https://localhost:3000"}})
 
+SAMPLE_JOBS = [
+    {"id": 1, "title": "Frontend Developer", "category": ["Design","IT"]},
+    {"id": 2, "title": "Backend Developer", "category": ["Management","IT"]},
+    {"id": 3, "title": "Data Scientist", "category": ["IT"]},
+    {"id": 4, "title": "Graphic Designer", "category": ["Management","Design", "IT"]},
+    {"id": 5, "title": "UI/UX Designer", "category": ["Design"]},
+]
+
+DEFAULT_CATALOG = "default"
+DEFAULT_TOP_K = 5
+MAX_TOP_K = 100
+# Minimum cosine similarity for a recommendation, 0.25 is the old L2 cutoff of 1.5
+MIN_SCORE = 0.25
+# content: TF-IDF neighbours, coclick: jobs clicked by the same users,
+# hybrid: both plus popularity, blended from precomputed candidate tables,
+# semantic: sentence-embedding neighbours (needs RECOMMENDER_ENCODER_MODEL)
+MODELS = ("content", "coclick", "hybrid", "semantic")
+# Results a first page ranks past its k, to tell whether there is a next page
+PAGE_LOOKAHEAD = 1
+# Results ranked at once when a cursor continues past what was ranked, then
+# served k at a time through cursors
+PAGE_DEPTH = int(os.environ.get("RECOMMENDER_PAGE_DEPTH", "100"))
+# Request fields a cursor carries, enough to rank the list again if it expired
+CURSOR_FIELDS = ("catalog", "jobId", "userId", "skills", "text", "k", "model", "minScore", "diversity", "weights", "filters")
+
+# Restored from disk when saved before, otherwise fitted once at startup.
+# Later changes arrive through /jobs and the canister refresher.
+catalogs, positions = load_catalogs()
+if DEFAULT_CATALOG not in catalogs:
+    catalogs[DEFAULT_CATALOG] = JobIndex(SAMPLE_JOBS)
+# Co-click model per catalog, fed by /clicks through the shared click log
+coclicks = {name: CoClickModel() for name in catalogs}
+# Decayed per-user profile vectors per catalog, fed by the same clicks
+profiles = {name: UserProfiles() for name in catalogs}
+# Decayed click counts per catalog for /trending, fed by the same clicks
+trending = {name: TrendingJobs() for name in catalogs}
+# Candidate tables per catalog, rebuilt in the background after /jobs and /clicks
+rankers = {name: HybridRanker(catalogs[name], coclicks[name]) for name in catalogs}
+# Embeddings per catalog for the semantic model, only when an encoder is configured
+encoder = JobEncoder() if ENCODER_MODEL else None
+semantics = {name: SemanticIndex(encoder, catalogs[name]) for name in catalogs} if encoder else {}
+# BM25 inverted index per catalog for /search, following the catalog in the background
+search_indexes = {name: BM25Index(catalogs[name]) for name in catalogs}
+# Category and skill names per catalog for /typeahead, plus categories created through it
+category_log = JsonLog("categories.log")
+typeaheads = {name: Typeahead(name, catalogs[name], category_log) for name in catalogs}
+# Successful /getRecommendation responses and the ranked lists cursors page
+# through, keyed by what they were computed from
+result_cache = ResultCache()
+background_started = False
+
+def install_catalog(name, job_index):
+    """Swap in a fully built JobIndex. Requests that already hold the old one finish on it."""
+    old = catalogs.get(name)
+    if old is not None and job_index.version <= old.version:
+        # Keep versions increasing so cached results of the old generation never match
+        job_index.version = old.version + 1
+    # Its change tracking starts here, so results of any earlier generation are stale
+    job_index.base_version = job_index.version
+    coclicks.setdefault(name, CoClickModel())
+    profiles.setdefault(name, UserProfiles())
+    trending.setdefault(name, TrendingJobs())
+    if name in rankers:
+        rankers[name].retarget(job_index)
+    else:
+        rankers[name] = HybridRanker(job_index, coclicks[name])
+        if background_started:
+            rankers[name].start()
+    if name in search_indexes:
+        search_indexes[name].retarget(job_index)
+    else:
+        search_indexes[name] = BM25Index(job_index)
+        if background_started:
+            search_indexes[name].start()
+    if name in typeaheads:
+        typeaheads[name].retarget(job_index)
+    else:
+        typeaheads[name] = Typeahead(name, job_index, category_log)
+        if background_started:
+            typeaheads[name].start()
+    if encoder is not None:
+        if name in semantics:
+            semantics[name].retarget(job_index)
+        else:
+            semantics[name] = SemanticIndex(encoder, job_index)
+            if background_started:
+                semantics[name].start()
+    catalogs[name] = job_index
+
+def is_id(value):
+    """Job and user ids are JSON strings or integers; anything else can't be looked up."""
+    return isinstance(value, (str, int)) and not isinstance(value, bool)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def click_error(click):
+    """Why a {userId, jobId, counter, at} click can't be used, or None."""
+    if not isinstance(click, dict) or not is_id(click.get("userId")) or not is_id(click.get("jobId")):
+        return "needs a userId and jobId, each a string or integer"
+    if click.get("counter") is not None and not (is_number(click["counter"]) and click["counter"] > 0):
+        return "counter must be a positive number"
+    if click.get("at") is not None and not is_number(click["at"]):
+        return "at must be a unix timestamp"
+    return None
+
+def apply_clicks(name, clicks):
+    # Logs written before clicks were checked can hold bad ones; they are
+    # skipped so they can't take the rest of their batch down with them
+    clicks = [click for click in clicks if click_error(click) is None]
+    coclicks.setdefault(name, CoClickModel()).add_clicks(clicks)
+    trending.setdefault(name, TrendingJobs()).add_clicks(clicks)
+    if name in catalogs:
+        profiles.setdefault(name, UserProfiles()).add_clicks(catalogs[name], clicks)
+    if name in rankers:
+        rankers[name].mark_dirty()
+
+def restore_clicks(name, states):
+    """Replace a catalog's click models with a snapshot of them; the log after it is applied next."""
+    coclicks.setdefault(name, CoClickModel()).restore(states["coclick"])
+    trending.setdefault(name, TrendingJobs()).restore(states["trending"])
+    profiles.setdefault(name, UserProfiles()).restore(states["profiles"])
+    if name in rankers:
+        rankers[name].mark_dirty()
+
+def snapshot_clicks(name):
+    """Under locked(), after logging a batch: replace a long click log with a snapshot of the models."""
+    if not click_log.snapshot_due(name):
+        return
+    # Nobody can log while the lock is held, so this applies the log to its end
+    watcher.sync(name)
+    click_log.save_snapshot(name, {
+        "coclick": coclicks[name].snapshot(),
+        "trending": trending[name].snapshot(),
+        "profiles": profiles[name].snapshot(),
+    })
+    print(f"Saved click snapshot of '{name}'")
+
+def catalog_changed(name):
+    """Nudge everything that follows a catalog after its JobIndex changed in place."""
+    rankers[name].mark_dirty()
+    search_indexes[name].mark_dirty()
+    typeaheads[name].mark_dirty()
+    if name in semantics:
+        semantics[name].mark_dirty()
+
+click_log = ClickLog()
+# Installs generations, changes and clicks that other worker processes saved
+watcher = GenerationWatcher(catalogs, positions, install_catalog, catalog_changed, apply_clicks, restore_clicks, click_log)
+
+def log_clicks(name, clicks):
+    """Append a click batch to the catalog's log, then apply it along with any other worker's."""
+    with locked():
+        watcher.sync(name)
+        if name not in catalogs:
+            print(f"Dropping {len(clicks)} clicks for unknown catalog '{name}'")
+            return
+        click_log.append(name, clicks)
+        snapshot_clicks(name)
+    watcher.sync(name)
+
+# Events from /events, merged in memory and logged as one batch per flush
+click_buffer = ClickBuffer(log_clicks)
+
+@contextmanager
+def updating(name):
+    """Change a catalog on top of its latest saved generation, and save the result.
+
+    Holds the data directory lock throughout, so changes made by different
+    worker processes apply one after the other instead of overwriting each other.
+    Changes made to the JobIndex in place are saved as its journal of
+    upsert()/remove() calls; a replaced catalog, or one whose change log is
+    due for compaction, is saved as a whole new generation.
+    """
+    with locked():
+        watcher.sync(name)
+        before = catalogs.get(name)
+        version = before.version if before is not None else None
+        if before is not None:
+            before.journal = []
+        try:
+            yield
+        finally:
+            journal = before.journal if before is not None else None
+            if before is not None:
+                before.journal = None
+        job_index = catalogs.get(name)
+        if job_index is None or (job_index is before and job_index.version == version):
+            return
+        if CATALOG_NAME.match(name):
+            directory = os.path.join(DATA_DIR, name)
+            position = watcher.position(name)
+            if job_index is before and position is not None and not compaction_due(directory, position[0]):
+                watcher.saved(name, (position[0], save_changes(directory, position[0], journal, job_index.version)))
+            else:
+                watcher.saved(name, save_catalog(directory, job_index.snapshot()))
+        catalog_changed(name)
+
+# Keeps the refresh catalog in sync with the canister's jobs in the background
+refresher = CatalogRefresher(catalogs, install_catalog, updating)
+
+def start_background():
+    """Start the threads every serving process needs (the dev server below, or gunicorn.conf.py per worker)."""
+    global background_started
+    background_started = True
+    for ranker in list(rankers.values()):
+        ranker.start()
+    for search_index in list(search_indexes.values()):
+        search_index.start()
+    for typeahead in list(typeaheads.values()):
+        typeahead.start()
+    for semantic in list(semantics.values()):
+        semantic.start()
+    watcher.start()
+    refresher.start()
+    click_buffer.start()
+
+@app.route('/jobs', methods=['POST'])
+def upsertJobs():
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    name = data.get('catalog', DEFAULT_CATALOG)
+    jobs = data.get('jobs', [])
+    removed = data.get('removed', [])
+    if not isinstance(jobs, list) or not isinstance(removed, list):
+        return {"error": "jobs and removed must be lists"}, 400
+    # Checked before the index is touched, so a bad job can't leave it half-updated
+    for i, job in enumerate(jobs):
+        error = job_error(job)
+        if error is not None:
+            return {"error": f"Job {i} {error}"}, 400
+    if not all(is_id(job_id) for job_id in removed):
+        return {"error": "removed must be a list of strings or integers"}, 400
+    if name not in catalogs and not CATALOG_NAME.match(name):
+        return jsonify({"error": "Catalog names are up to 64 letters, digits, '.', '_' or '-'"}), 400
+
+    with updating(name):
+        if name not in catalogs:
+            install_catalog(name, JobIndex(jobs))
+        else:
+            catalogs[name].upsert(jobs)
+        catalogs[name].remove(removed)
+    return jsonify({"message": "Success", "catalog": name, **catalogs[name].stats()})
+
+@app.route('/clicks', methods=['POST'])
+def addClicks():
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    name = data.get('catalog', DEFAULT_CATALOG)
+    # listUserClickeds is what the first version of this service was sent
+    clicks = data.get('clicks', data.get('listUserClickeds', []))
+    if not isinstance(clicks, list):
+        return {"error": "clicks must be a list"}, 400
+    # Checked before logging: every worker replays whatever is in the log
+    for i, click in enumerate(clicks):
+        error = click_error(click)
+        if error is not None:
+            return {"error": f"Click {i} {error}"}, 400
+    # Stamped before logging, so every worker replays them with the same age
+    now = time.time()
+    clicks = [{**click, "at": click.get("at", now)} for click in clicks]
+
+    with locked():
+        watcher.sync(name)
+        if name not in catalogs:
+            return {"error": f"Unknown catalog '{name}'"}, 404
+        click_log.append(name, clicks)
+        snapshot_clicks(name)
+    # Applies the batch just logged, along with any other worker's
+    watcher.sync(name)
+    return jsonify({"message": "Success", "catalog": name, **coclicks[name].stats()})
+
+@app.route('/events', methods=['POST'])
+def addEvents():
+    """Like /clicks, but buffered: the events reach the models after the next flush."""
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    name = data.get('catalog', DEFAULT_CATALOG)
+    events = data.get('events', data.get('clicks', []))
+    if not isinstance(events, list):
+        return {"error": "events must be a list"}, 400
+    # Checked before buffering: a bad one would fail the whole flush it lands in
+    for i, event in enumerate(events):
+        error = click_error(event)
+        if error is not None:
+            return {"error": f"Event {i} {error}"}, 400
+    if name not in catalogs:
+        return {"error": f"Unknown catalog '{name}'"}, 404
+    now = time.time()
+    click_buffer.add(name, [{**event, "at": now if event.get("at") is None else event["at"]} for event in events])
+    return jsonify({"message": "Accepted", "catalog": name, "accepted": len(events)}), 202
+
+@app.route('/trending', methods=['GET'])
+def trendingJobs():
+    name = request.args.get('catalog', DEFAULT_CATALOG)
+    job_index = catalogs.get(name)
+    if job_index is None:
+        return {"error": f"Unknown catalog '{name}'"}, 404
+    try:
+        k = max(1, min(int(request.args.get('k', DEFAULT_TOP_K)), TRENDING_MAX))
+    except ValueError:
+        return {"error": "k must be a number"}, 400
+
+    jobs = []
+    # Jobs removed from the catalog stay in the sketch until they fade
+    for job_id, clicks in trending[name].top(TRENDING_MAX):
+        job = job_index.jobs.get(job_id)
+        if job is not None:
+            jobs.append({**job_summary(job), "clicks": round(clicks, 3)})
+    return {"catalog": name, "jobs": jobs[:k]}
+
+@app.route('/stats', methods=['GET'])
+def indexStats():
+    return jsonify({
+        name: {
+            **job_index.stats(),
+            "coclick": coclicks[name].stats(),
+            "profiles": profiles[name].stats(),
+            "trending": trending[name].stats(),
+            "ranker": rankers[name].stats(),
+            "search": search_indexes[name].stats(),
+            "typeahead": typeaheads[name].stats(),
+            **({"semantic": semantics[name].stats()} if name in semantics else {}),
+        }
+        for name, job_index in catalogs.items()
+    })
+
+@app.route('/stats/cache', methods=['GET'])
+def cacheStats():
+    return jsonify(result_cache.stats())
+
+@app.route('/stats/events', methods=['GET'])
+def eventStats():
+    return jsonify(click_buffer.stats())
+
+@app.route('/stats/refresh', methods=['GET'])
+def refreshStats():
+    return jsonify(refresher.stats())
+
+@app.route('/search', methods=['POST'])
+def searchJobs():
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    name = data.get('catalog', DEFAULT_CATALOG)
+    job_index = catalogs.get(name)
+    if job_index is None:
+        return {"error": f"Unknown catalog '{name}'"}, 404
+    query = str(data.get('query') or '').strip()
+    if not query:
+        return {"error": "Provide a query"}, 400
+    try:
+        k = max(1, min(int(data.get('k', DEFAULT_TOP_K)), MAX_TOP_K))
+    except (TypeError, ValueError):
+        return {"error": "k must be a number"}, 400
+
+    results = []
+    for job_id, score in search_indexes[name].search(query, k):
+        job = job_index.jobs.get(job_id)
+        if job is not None:
+            results.append({**job_summary(job), "score": score})
+    return {"catalog": name, "catalogVersion": job_index.version, "query": query, "results": results}
+
+@app.route('/typeahead', methods=['GET'])
+def suggestNames():
+    name = request.args.get('catalog', DEFAULT_CATALOG)
+    if name not in typeaheads:
+        return {"error": f"Unknown catalog '{name}'"}, 404
+    kind = request.args.get('kind') or None
+    if kind is not None and kind not in TYPEAHEAD_KINDS:
+        return {"error": f"kind must be one of {', '.join(TYPEAHEAD_KINDS)}"}, 400
+    try:
+        k = max(1, min(int(request.args.get('k', DEFAULT_TOP_K)), TYPEAHEAD_MAX))
+    except ValueError:
+        return {"error": "k must be a number"}, 400
+
+    prefix = request.args.get('q', '')
+    suggestions = typeaheads[name].suggest(prefix, k, kind)
+    return {
+        "catalog": name,
+        "prefix": prefix,
+        "suggestions": [{"name": suggestion, "popularity": popularity} for suggestion, popularity in suggestions],
+    }
+
+@app.route('/typeahead/categories', methods=['POST'])
+def addCategories():
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    name = data.get('catalog', DEFAULT_CATALOG)
+    categories = data.get('categories', [])
+    if not isinstance(categories, list):
+        return {"error": "categories must be a list of names"}, 400
+    categories = [str(category).strip() for category in categories]
+    if not categories or not all(categories):
+        return {"error": "Provide one or more category names"}, 400
+    if not CATALOG_NAME.match(name):
+        return {"error": f"Unknown catalog '{name}'"}, 404
+
+    with locked():
+        watcher.sync(name)
+        if name not in catalogs:
+            return {"error": f"Unknown catalog '{name}'"}, 404
+        category_log.append(name, categories)
+    # Other workers pick the names up from the log on their next sync
+    typeaheads[name].mark_dirty()
+    return jsonify({"message": "Success", "catalog": name, "categories": categories})
+
+def cache_key(name, job_index, model, data):
+    """Request plus the versions of the click data the model reads.
+
+    A click batch retires the catalog's entries for the models that read
+    it, e.g. it leaves cached content results alone. Job changes are
+    checked per entry instead, see cache_version().
+    """
+    if model == "hybrid":
+        versions = ((rankers[name].built_versions or (None, None))[1],)
+    elif model == "coclick":
+        versions = (coclicks[name].version,)
+    else:
+        versions = ()
+    if "userId" in data:
+        versions += (profiles[name].version,)
+    return name, model, versions, json.dumps(data, sort_keys=True, default=str)
+
+def cache_version(name, job_index, model):
+    """Catalog version the model's results reflect, to cache them under; read before computing them."""
+    if model == "hybrid":
+        # The candidate tables, which may lag the catalog
+        return (rankers[name].built_versions or (-1, None))[0]
+    if model == "semantic" and semantics[name].synced_version is not None:
+        return semantics[name].synced_version
+    return job_index.version
+
+def neighbours_for(name, job_index, model, query_ids, k, weights=None, filters=None):
+    """{job id: [(job id, score), ...]} for the query jobs that exist in the catalog."""
+    if model == "hybrid":
+        # Filters can only narrow the precomputed candidates, so all of them are fetched
+        fetch = rankers[name].candidates if filters else k + 1
+        ranked = {query_id: rankers[name].rank(query_id, fetch, weights) for query_id in query_ids}
+        found = {query_id: row for query_id, row in ranked.items() if row is not None}
+    elif model == "coclick":
+        found = {
+            query_id: coclicks[name].neighbours(query_id)
+            for query_id in query_ids if query_id in job_index.jobs
+        }
+    elif model == "semantic":
+        found_ids, query_vectors = semantics[name].vectors(query_ids)
+        found = dict(zip(found_ids, semantics[name].search(query_vectors, semantic_fetch(k, filters)) if found_ids else []))
+    else:
+        # Every query job goes through a single index.search call, over the filtered jobs only
+        found_ids, query_vectors = job_index.vectors(query_ids)
+        rows = job_index.search(query_vectors, k + 1, filters) if found_ids else []
+        return dict(zip(found_ids, rows))
+    if filters:
+        allowed = set(job_index.matching({job_id for row in found.values() for job_id, _ in row}, filters))
+        found = {query_id: [pair for pair in row if pair[0] in allowed] for query_id, row in found.items()}
+    return found
+
+def semantic_fetch(k, filters):
+    """Neighbours to ask the semantic index for; filters apply afterwards, so it over-fetches."""
+    return k + 1 if not filters else min(MAX_TOP_K * 10, 10 * (k + 1))
+
+def recommendations_for(job_index, neighbours, exclude_id, k, min_score):
+    recommendations = []
+    for job_id, score in neighbours:
+        if job_id == exclude_id:
+            continue
+        if score > min_score:
+            job = job_index.jobs.get(job_id)
+            if job is not None:
+                recommendations.append({**job_summary(job), "score": float(score)})
+        if len(recommendations) == k:
+            break
+    return recommendations
+
 @app.route('/getRecommendation', methods=['POST'])
 def getRecomendationListJob():
-    jobs = [
-        {"id": 1, "title": "Frontend Developer", "category": ["Design","IT"]},
-        {"id": 2, "title": "Backend Developer", "category": ["Management","IT"]},
-        {"id": 3, "title": "Data Scientist", "category": ["IT"]},
-        {"id": 4, "title": "Graphic Designer", "category": ["Management","Design", "IT"]},
-        {"id": 5, "title": "UI/UX Designer", "category": ["Design"]},
-    ]
-
-    if len(jobs) == 0:
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return {"error": "Request body must be a JSON object"}, 400
+    list_id, offset = None, 0
+    if 'cursor' in data:
+        try:
+            list_id, offset, query = decode_cursor(data['cursor'])
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        # The next page of the cursor's query, optionally with a new page size
+        data = {**query, **({"k": data["k"]} if "k" in data else {})}
+    name = data.get('catalog', DEFAULT_CATALOG)
+    job_index = catalogs.get(name)
+    if job_index is None:
+        return {"error": f"Unknown catalog '{name}'"}, 404
+    if len(job_index) == 0:
         return {"error": "No jobs available for recommendation"}, 400
+    if 'jobId' in data and not is_id(data['jobId']):
+        return {"error": "jobId must be a string or integer"}, 400
+    if 'jobIds' in data and (not isinstance(data['jobIds'], list) or not all(is_id(job_id) for job_id in data['jobIds'])):
+        return {"error": "jobIds must be a list of strings or integers"}, 400
+    if 'userId' in data and not is_id(data['userId']):
+        return {"error": "userId must be a string or integer"}, 400
 
-    documents = [" ".join(job["category"]) for job in jobs]
+    try:
+        k = max(1, min(int(data.get('k', DEFAULT_TOP_K)), MAX_TOP_K))
+        min_score = float(data.get('minScore', MIN_SCORE))
+        diversity = float(data.get('diversity', DEFAULT_DIVERSITY))
+    except (TypeError, ValueError):
+        return {"error": "k, minScore and diversity must be numbers"}, 400
+    if not 0 <= diversity <= 1:
+        return {"error": "diversity must be between 0 and 1"}, 400
+    # Job queries default to the blended ranking, free text can only use content
+    model = data.get('model') or ('hybrid' if 'jobId' in data or 'jobIds' in data else 'content')
+    if model not in MODELS:
+        return {"error": f"model must be one of {', '.join(MODELS)}"}, 400
+    if model == "semantic" and name not in semantics:
+        return {"error": "The semantic model needs RECOMMENDER_ENCODER_MODEL set"}, 400
+    weights = data.get('weights')
+    if weights is not None:
+        try:
+            weights = {signal: float(weights[signal]) for signal in SIGNALS if signal in weights}
+        except (TypeError, ValueError):
+            return {"error": f"weights must map {', '.join(SIGNALS)} to numbers"}, 400
+        if any(weight < 0 for weight in weights.values()):
+            return {"error": "weights can't be negative"}, 400
+    try:
+        filters = parse_filters(data.get('filters'))
+    except ValueError as e:
+        return {"error": str(e)}, 400
 
-    vectorizer = TfidfVectorizer()
-    job_vectors = vectorizer.fit_transform(documents).toarray().astype("float32")
+    if 'jobIds' in data:
+        # Resolved parameters, so an explicit default and a missing field share an entry
+        key = cache_key(name, job_index, model, {**data, "k": k, "minScore": min_score, "diversity": diversity, "weights": weights, "model": model})
+        cached = result_cache.get(key, job_index)
+        if cached is not None:
+            return cached
+        version = cache_version(name, job_index, model)
+        result = recommend(name, job_index, data, model, k, min_score, weights, filters, diversity)
+        if not isinstance(result, tuple):
+            returned = [item["id"] for row in result["results"] for item in row.get("recommendations", ())]
+            result_cache.put(key, result, version, data['jobIds'] + returned)
+        return result
 
-    d = job_vectors.shape[1]  
-    index = faiss.IndexFlatL2(d)
-    index.add(job_vectors)
+    # A cursor whose list expired, or was ranked by another worker, ranks it
+    # again from the query it carries and continues at the same offset
+    continuing = list_id is not None
+    ranked = result_cache.get(list_id, job_index) if continuing else None
+    if ranked is None:
+        # Every page of the list, of any size, shares it, so k is left out
+        key = cache_key(name, job_index, model, {**data, "k": None, "minScore": min_score, "diversity": diversity, "weights": weights, "model": model})
+        list_id = base64.urlsafe_b64encode(hashlib.blake2b(repr(key).encode("utf-8"), digest_size=12).digest()).decode("ascii")
+        ranked = result_cache.get(list_id, job_index)
+    # A first page ranks only just past k; continuing beyond the ranked part
+    # of the list ranks all of it, up to PAGE_DEPTH results
+    limit = max(k, PAGE_DEPTH)
+    needed = min(offset + k + PAGE_LOOKAHEAD, limit)
+    if ranked is None or (len(ranked["ranked"]) < needed and not ranked["complete"]):
+        depth = limit if continuing else needed
+        version = cache_version(name, job_index, model)
+        result = recommend(name, job_index, data, model, depth, min_score, weights, filters, diversity)
+        if isinstance(result, tuple):
+            return result
+        # Pages already served keep their order, so the deeper ranking can't repeat or skip jobs
+        served = ranked["ranked"][:offset] if ranked is not None else []
+        seen = {job_id for job_id, _ in served}
+        ranked = {
+            "info": {field: value for field, value in result.items() if field != "recommendations"},
+            "ranked": served + [
+                (recommendation["id"], recommendation["score"])
+                for recommendation in result["recommendations"] if recommendation["id"] not in seen
+            ],
+            # Fewer results than asked for means there are no more to rank
+            "complete": depth == limit or len(result["recommendations"]) < depth,
+        }
+        query_ids = [data['jobId']] if 'jobId' in data else []
+        result_cache.put(list_id, ranked, version, query_ids + [job_id for job_id, _ in ranked["ranked"]])
+    return page_of(job_index, ranked, list_id, offset, k, {**data, "k": k})
 
-    print(f"Total jobs in index: {index.ntotal}")
+def encode_cursor(list_id, offset, data):
+    query = {field: data[field] for field in CURSOR_FIELDS if field in data}
+    state = json.dumps({"l": list_id, "o": offset, "q": query}, separators=(",", ":"), default=str)
+    return base64.urlsafe_b64encode(state.encode("utf-8")).decode("ascii").rstrip("=")
 
-    query_job_id = 1  
-    query_vector = job_vectors[query_job_id - 1].reshape(1, -1)
+def decode_cursor(cursor):
+    """(ranked list id, offset, query fields) of a cursor. Raises ValueError."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        list_id, offset, query = str(state["l"]), int(state["o"]), state["q"]
+    except (TypeError, ValueError, KeyError, binascii.Error):
+        raise ValueError("Invalid cursor")
+    if offset < 0 or not isinstance(query, dict):
+        raise ValueError("Invalid cursor")
+    return list_id, offset, query
 
-    k = len(jobs)  
-    distances, indices = index.search(query_vector, k)
+def page_of(job_index, ranked, list_id, offset, k, data):
+    """k recommendations of a ranked list from offset, with a cursor to the next page if there is one."""
+    rows = ranked["ranked"][offset:offset + k]
+    page = {
+        **ranked["info"],
+        "recommendations": [
+            {**job_summary(job_index.jobs[job_id]), "score": score}
+            for job_id, score in rows if job_id in job_index.jobs
+        ],
+        "offset": offset,
+    }
+    if offset + k < len(ranked["ranked"]):
+        page["cursor"] = encode_cursor(list_id, offset + k, data)
+    return page
 
-    recommendations = []
-    for i, idx in enumerate(indices[0]):
-        if idx == -1 or idx + 1 == query_job_id:  
-            continue
-        if distances[0][i] < 1.5:
-            recommendations.append({
-                "id": jobs[idx]["id"],
-                "title": jobs[idx]["title"],
-                "category": jobs[idx]["category"],
-                "distance": float(distances[0][i])
+def diversify(name, job_index, model, recommendations, k, diversity):
+    """Re-rank over-fetched recommendations by MMR, or just cut them to k."""
+    if not diversity or len(recommendations) <= 1:
+        return recommendations[:k]
+    source = semantics[name] if model == "semantic" else job_index
+    found, vectors = source.vectors([recommendation["id"] for recommendation in recommendations])
+    if len(found) != len(recommendations):
+        # A job changed or left the catalog since it was ranked
+        return recommendations[:k]
+    order = mmr([recommendation["score"] for recommendation in recommendations], vectors, k, diversity)
+    return [recommendations[i] for i in order]
+
+def recommend(name, job_index, data, model, k, min_score, weights, filters, diversity):
+    catalog_info = {"catalog": name, "catalogVersion": job_index.version, "model": model}
+    # Diversified requests rank more candidates than they return
+    fetch = mmr_candidates(k) if diversity else k
+
+    if 'jobIds' in data:
+        found = neighbours_for(name, job_index, model, data['jobIds'], fetch, weights, filters)
+        results = []
+        for query_id in data['jobIds']:
+            if query_id not in found:
+                results.append({"query_job_id": query_id, "error": "Unknown job"})
+                continue
+            results.append({
+                "query_job_id": query_id,
+                "recommendations": diversify(
+                    name, job_index, model,
+                    recommendations_for(job_index, found[query_id], query_id, fetch, min_score), k, diversity,
+                ),
             })
+        return {**catalog_info, "results": results}
+
+    if 'jobId' in data:
+        query_job_id = data['jobId']
+        found = neighbours_for(name, job_index, model, [query_job_id], fetch, weights, filters)
+        if query_job_id not in found:
+            return {"error": f"Unknown job '{query_job_id}'"}, 404
+        neighbours = found[query_job_id]
+        query = {"query_job": job_index.jobs[query_job_id]}
+    elif model not in ("content", "semantic"):
+        return {"error": f"The {model} model needs a jobId or jobIds"}, 400
+    elif 'userId' in data and model == "content":
+        user_id = data['userId']
+        profile = profiles[name].profile(user_id)
+        if not profile:
+            return {"error": f"No clicks from user '{user_id}' on jobs in this catalog"}, 404
+        # One search with the profile vector; jobs the user already clicked are left out
+        seen = set(profiles[name].seen(user_id))
+        query_job_id = None
+        neighbours = job_index.search(job_index.encode_terms(profile), fetch + len(seen), filters)[0]
+        neighbours = [(job_id, score) for job_id, score in neighbours if job_id not in seen]
+        query = {"query_user": user_id}
+    elif data.get('skills') or data.get('text'):
+        skills = data.get('skills') or []
+        text = " ".join([data.get('text', '')] + [str(skill) for skill in skills])
+        query_job_id = None
+        if model == "semantic":
+            neighbours = semantics[name].search(encoder.encode_queries([text]), semantic_fetch(fetch, filters))[0]
+            if filters:
+                allowed = set(job_index.matching([job_id for job_id, _ in neighbours], filters))
+                neighbours = [pair for pair in neighbours if pair[0] in allowed]
+        else:
+            neighbours = job_index.search(job_index.encode([text]), fetch + 1, filters)[0]
+        query = {"query_text": text.strip()}
+    else:
+        return {"error": "Provide jobId, jobIds, userId, or skills/text"}, 400
+
+    recommendations = diversify(
+        name, job_index, model,
+        recommendations_for(job_index, neighbours, query_job_id, fetch, min_score), k, diversity,
+    )
 
     if len(recommendations) == 0:
         return {"error": "no similar jobs found"}, 400
     
     return {
-        "query_job": jobs[query_job_id - 1],
+        **catalog_info,
+        **query,
         "recommendations": recommendations
     }
 
 if __name__ == '__main__':
+    # Development only; production runs `gunicorn -c gunicorn.conf.py`
+    start_background()
     app.run(port=5001, debug=True, use_reloader=True)
\ No newline at end of file
@@ -0,0 +1,597 @@
+"""On-disk generations of the recommender's catalogs, shared by worker processes.
+
+Each catalog lives in its own directory:
+
+    <RECOMMENDER_DATA_DIR>/<catalog>/
+        CURRENT          name of the live generation, replaced atomically
+        clicks.log       click batches as JSON lines, until the first click snapshot
+        clicks-<n>/      click models as of snapshot n, see ClickLog
+            clicks.log      click batches logged since, as JSON lines
+            manifest.json   a crc32 per file
+            <model>.json, <model>.<field>.npy  each model's snapshot()
+        categories.log   category names created for typeahead, as JSON lines
+        gen-<n>/
+            changes.log     upsert/remove calls made since, as JSON lines
+            manifest.json   counters, index kind, config and a crc32 per file
+            jobs.json       raw jobs, in row order
+            vocabulary.json terms in column order
+            idf.npy
+            rows_indptr.npy, rows_indices.npy, rows_data.npy  sparse TF-IDF rows
+            faiss_ids.npy
+            projection.npy  TruncatedSVD components (projected dense kinds)
+            index.faiss     faiss.write_index output (dense kinds)
+
+A generation is written to gen-<n>.tmp, renamed into place and only then
+named in CURRENT, so a crash mid-save leaves the previous one live. Arrays
+are memory-mapped on load. A generation that fails its checksums, or was
+written with different index settings, is refitted from its jobs.json, or
+dropped if even that is damaged.
+
+Every change is saved as it happens, under locked(), by whichever process
+made it; the others pick it up through their GenerationWatcher. An update
+only appends the JobIndex.upsert()/remove() calls it made to the current
+generation's changes.log, and loading replays them on top of the
+generation. Once the log outgrows RECOMMENDER_COMPACT_RATIO of the
+generation's jobs, the next update writes a whole new generation instead,
+as does replacing a catalog outright.
+
+Click batches are logged the same way. Once a catalog's click log passes
+RECOMMENDER_CLICK_SNAPSHOT_BYTES, the process logging the next batch
+saves its click models, which have every batch applied, as a new
+snapshot with an empty log, and deletes the old log and snapshot.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import zlib
+
+import numpy as np
+from scipy import sparse
+
+import indexes
+from catalog import JobIndex
+from indexes import VectorIndex
+
+DATA_DIR = os.environ.get("RECOMMENDER_DATA_DIR", "recommender_data")
+# Seconds between checks for generations and clicks written by other processes
+WATCH_INTERVAL = float(os.environ.get("RECOMMENDER_WATCH_INTERVAL", "2"))
+PERSIST_FORMAT = 1
+# Catalog names double as directory names
+CATALOG_NAME = re.compile(r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,63}$")
+
+ARRAYS = ("idf", "rows_indptr", "rows_indices", "rows_data", "faiss_ids", "projection")
+# Change log size, relative to the generation's jobs.json, at which the
+# next update writes a new generation; replaying it costs about as much
+COMPACT_RATIO = float(os.environ.get("RECOMMENDER_COMPACT_RATIO", "0.5"))
+# Logs smaller than this are always replayed rather than compacted
+COMPACT_MIN_BYTES = 1 << 20
+# Click log size at which the next batch logged folds it into a snapshot of
+# the click models, so the log doesn't grow forever or get replayed from the start
+CLICK_SNAPSHOT_BYTES = int(os.environ.get("RECOMMENDER_CLICK_SNAPSHOT_BYTES", str(16 << 20)))
+
+
+class PersistError(Exception):
+    pass
+
+
+def index_config():
+    """Settings that decide how an index is built; a generation saved under others is stale."""
+    return {
+        "index": indexes.RECOMMENDER_INDEX,
+        "ivfMinJobs": indexes.IVF_MIN_JOBS,
+        "hnswMinJobs": indexes.HNSW_MIN_JOBS,
+        "denseDim": indexes.DENSE_DIM,
+    }
+
+
+def _crc32(path):
+    crc = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+def _write(path, write):
+    with open(path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_json(path, value):
+    _write(path, lambda f: f.write(json.dumps(value).encode("utf-8")))
+
+
+def save_catalog(directory, state):
+    """Write a JobIndex.snapshot() as a new generation and make it current; returns its position."""
+    os.makedirs(directory, exist_ok=True)
+    generations = [int(entry[4:]) for entry in os.listdir(directory) if re.fullmatch(r"gen-\d+", entry)]
+    generation = f"gen-{max(generations, default=0) + 1}"
+    tmp_path = os.path.join(directory, generation + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    _write_json(os.path.join(tmp_path, "jobs.json"), state["jobs"])
+    files = ["jobs.json"]
+    if state["vocabulary"] is not None:
+        _write_json(os.path.join(tmp_path, "vocabulary.json"), state["vocabulary"])
+        files.append("vocabulary.json")
+        rows = state["rows"]
+        arrays = {
+            "idf": state["idf"],
+            "rows_indptr": rows.indptr,
+            "rows_indices": rows.indices,
+            "rows_data": rows.data,
+            "faiss_ids": state["faiss_ids"],
+            "projection": state["projection"],
+        }
+        for name, array in arrays.items():
+            if array is not None:
+                _write(os.path.join(tmp_path, name + ".npy"), lambda f, array=array: np.save(f, np.asarray(array)))
+                files.append(name + ".npy")
+        if state["index"] is not None:
+            _write(os.path.join(tmp_path, "index.faiss"), lambda f: f.write(state["index"].tobytes()))
+            files.append("index.faiss")
+
+    manifest = {
+        "format": PERSIST_FORMAT,
+        "config": index_config(),
+        "version": state["version"],
+        "fits": state["fits"],
+        "drift_tokens": state["drift_tokens"],
+        "drift_unknown": state["drift_unknown"],
+        "next_faiss_id": state["next_faiss_id"],
+        "index_kind": state.get("index_kind"),
+        "shape": list(state["rows"].shape) if state["vocabulary"] is not None else None,
+        "tombstones": state.get("tombstones", []),
+        "files": {name: _crc32(os.path.join(tmp_path, name)) for name in files},
+    }
+    _write_json(os.path.join(tmp_path, "manifest.json"), manifest)
+    os.replace(tmp_path, os.path.join(directory, generation))
+
+    current_tmp = os.path.join(directory, "CURRENT.tmp")
+    _write(current_tmp, lambda f: f.write(generation.encode("utf-8")))
+    os.replace(current_tmp, os.path.join(directory, "CURRENT"))
+
+    # Older generations may still be memory-mapped; unlinking them is fine on POSIX
+    for entry in os.listdir(directory):
+        if entry.startswith("gen-") and entry != generation:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return generation, 0
+
+
+def _complete_length(path):
+    """Bytes of `path` up to its last newline; a crash can leave a partial line after it."""
+    try:
+        with open(path, "rb") as f:
+            size = f.seek(0, os.SEEK_END)
+            position = size
+            while position > 0:
+                step = min(position, 1 << 16)
+                f.seek(position - step)
+                block = f.read(step)
+                if b"\n" in block:
+                    return position - step + block.rindex(b"\n") + 1
+                position -= step
+            return 0
+    except FileNotFoundError:
+        return 0
+
+
+def save_changes(directory, generation, changes, version):
+    """Append one update's journalled JobIndex calls to the generation's change log.
+
+    Callers hold locked(). Returns the log's new length, the position of a
+    process that has applied everything in it.
+    """
+    path = os.path.join(directory, generation, "changes.log")
+    line = json.dumps({"version": version, "changes": changes}) + "\n"
+    with open(path, "ab") as f:
+        # Cut a line left half-written by a crash, or the next one would be glued to it
+        f.truncate(_complete_length(path))
+        f.write(line.encode("utf-8"))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def read_changes(directory, generation, offset):
+    """(entries, new offset) of the complete change log lines after `offset`."""
+    try:
+        with open(os.path.join(directory, generation, "changes.log"), "rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+    end = data.rfind(b"\n") + 1
+    return [json.loads(line) for line in data[:end].splitlines() if line.strip()], offset + end
+
+
+def compaction_due(directory, generation):
+    """Whether the generation's change log has grown enough to write a new generation instead."""
+    path = os.path.join(directory, generation)
+    try:
+        logged = os.path.getsize(os.path.join(path, "changes.log"))
+        jobs = os.path.getsize(os.path.join(path, "jobs.json"))
+    except OSError:
+        return False
+    return logged > max(COMPACT_MIN_BYTES, COMPACT_RATIO * jobs)
+
+
+def replay_changes(job_index, entries):
+    for entry in entries:
+        job_index.replay(entry["changes"], entry["version"])
+
+
+def load_catalog(directory):
+    """(JobIndex, (generation, change log offset)) for the current generation in `directory`.
+
+    Raises PersistError if nothing is usable.
+    """
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            generation = f.read().strip()
+        path = os.path.join(directory, generation)
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise PersistError(f"No readable generation in {directory}: {e}")
+
+    damaged = [
+        name for name, crc in manifest.get("files", {}).items()
+        if not os.path.exists(os.path.join(path, name)) or _crc32(os.path.join(path, name)) != crc
+    ]
+    if "jobs.json" in damaged or "jobs.json" not in manifest.get("files", {}):
+        raise PersistError(f"Jobs of {path} are missing or corrupt")
+    with open(os.path.join(path, "jobs.json")) as f:
+        jobs = json.load(f)
+
+    entries, offset = read_changes(directory, generation, 0)
+    if damaged or manifest.get("format") != PERSIST_FORMAT or manifest.get("config") != index_config():
+        reason = f"checksum mismatch in {', '.join(damaged)}" if damaged else "saved with other index settings"
+        print(f"Refitting {path}: {reason}")
+        job_index = JobIndex(jobs)
+        job_index.version = manifest.get("version", job_index.version)
+        replay_changes(job_index, entries)
+        return job_index, (generation, offset)
+
+    state = {key: manifest[key] for key in ("version", "fits", "drift_tokens", "drift_unknown", "next_faiss_id")}
+    state["jobs"] = jobs
+    state["vocabulary"] = None
+    if "vocabulary.json" in manifest["files"]:
+        with open(os.path.join(path, "vocabulary.json")) as f:
+            state["vocabulary"] = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")
+            if name + ".npy" in manifest["files"] else None
+            for name in ARRAYS
+        }
+        state["idf"] = arrays["idf"]
+        state["faiss_ids"] = arrays["faiss_ids"]
+        state["projection"] = arrays["projection"]
+        state["rows"] = sparse.csr_matrix(
+            (arrays["rows_data"], arrays["rows_indices"], arrays["rows_indptr"]),
+            shape=tuple(manifest["shape"]),
+            copy=False,
+        )
+    index = None
+    if "index.faiss" in manifest["files"]:
+        index = VectorIndex.read(os.path.join(path, "index.faiss"), manifest["index_kind"], manifest["tombstones"])
+
+    job_index = JobIndex()
+    job_index.restore(state, index=index)
+    replay_changes(job_index, entries)
+    return job_index, (generation, offset)
+
+
+def load_catalogs(data_dir=DATA_DIR):
+    """({catalog name: JobIndex}, {catalog name: (generation, offset) loaded}) for every catalog under data_dir."""
+    catalogs = {}
+    positions = {}
+    if not os.path.isdir(data_dir):
+        return catalogs, positions
+    for name in sorted(os.listdir(data_dir)):
+        if not CATALOG_NAME.match(name) or current_generation(os.path.join(data_dir, name)) is None:
+            continue
+        try:
+            catalogs[name], positions[name] = load_catalog(os.path.join(data_dir, name))
+        except PersistError as e:
+            print(f"Skipping saved catalog '{name}': {e}")
+            continue
+        print(f"Loaded catalog '{name}': {catalogs[name].stats()}")
+    return catalogs, positions
+
+
+def current_generation(directory):
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def click_snapshot(directory):
+    """Number of the latest click snapshot in a catalog directory, 0 before the first."""
+    try:
+        entries = os.listdir(directory)
+    except OSError:
+        return 0
+    return max((int(entry[7:]) for entry in entries if re.fullmatch(r"clicks-\d+", entry)), default=0)
+
+
+def save_clicks(directory, states):
+    """Write click model snapshot()s, {model: state}, as the next click snapshot; returns its number.
+
+    Callers hold locked() and have applied every batch logged so far. The
+    snapshot starts with an empty log, and the logs and snapshot before it
+    are deleted.
+    """
+    number = click_snapshot(directory) + 1
+    snapshot = f"clicks-{number}"
+    tmp_path = os.path.join(directory, snapshot + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    files = []
+    for model, state in states.items():
+        values = {}
+        for field, value in state.items():
+            if isinstance(value, np.ndarray):
+                _write(os.path.join(tmp_path, f"{model}.{field}.npy"), lambda f, value=value: np.save(f, value))
+                files.append(f"{model}.{field}.npy")
+            else:
+                values[field] = value
+        _write_json(os.path.join(tmp_path, model + ".json"), values)
+        files.append(model + ".json")
+    manifest = {
+        "format": PERSIST_FORMAT,
+        "files": {name: _crc32(os.path.join(tmp_path, name)) for name in files},
+    }
+    _write_json(os.path.join(tmp_path, "manifest.json"), manifest)
+    os.replace(tmp_path, os.path.join(directory, snapshot))
+
+    # Readers still on an older log find this snapshot and start over from it
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(directory, "clicks.log"))
+    for entry in os.listdir(directory):
+        if re.fullmatch(r"clicks-\d+", entry) and entry != snapshot:
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+    return number
+
+
+def load_clicks(directory, number):
+    """{model: state} saved as click snapshot `number`; raises PersistError if it is gone or damaged."""
+    path = os.path.join(directory, f"clicks-{number}")
+    states = {}
+    try:
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("format") != PERSIST_FORMAT:
+            raise PersistError(f"{path} has format {manifest.get('format')}")
+        for name, crc in manifest["files"].items():
+            file_path = os.path.join(path, name)
+            if _crc32(file_path) != crc:
+                raise PersistError(f"checksum mismatch in {file_path}")
+            if name.endswith(".npy"):
+                model, field = name[:-4].split(".", 1)
+                states.setdefault(model, {})[field] = np.load(file_path)
+            else:
+                with open(file_path) as f:
+                    states.setdefault(name[:-5], {}).update(json.load(f))
+    except (OSError, ValueError, KeyError) as e:
+        raise PersistError(f"Can't read {path}: {e}")
+    return states
+
+
+@contextlib.contextmanager
+def locked(data_dir=DATA_DIR, name="catalogs"):
+    """Exclusive lock shared by every process (and thread) using data_dir."""
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, f".{name}.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def try_lock(name, data_dir=DATA_DIR):
+    """The open lock file if `name` was free, else None. The lock lasts until the file is closed."""
+    os.makedirs(data_dir, exist_ok=True)
+    f = open(os.path.join(data_dir, f".{name}.lock"), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class JsonLog:
+    """Append-only JSON-lines log per catalog, read by every worker process."""
+
+    def __init__(self, filename, data_dir=DATA_DIR):
+        self.filename = filename
+        self.data_dir = data_dir
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.data_dir, name, self.filename)
+
+    def append(self, name, entry):
+        """Callers hold locked(), so lines from different processes never interleave."""
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        with open(self.path(name), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def read_new(self, name):
+        """Entries appended since the last call."""
+        with self._lock:
+            offset = self._offsets.get(name, 0)
+            try:
+                with open(self.path(name), "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return []
+            # A line still being written is picked up next time
+            end = data.rfind(b"\n") + 1
+            self._offsets[name] = offset + end
+        entries = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError as e:
+                print(f"Skipping unreadable line in {self.path(name)}: {e}")
+        return entries
+
+
+class ClickLog(JsonLog):
+    """Click batches per catalog, logged after its latest click snapshot.
+
+    Before the first snapshot the log is the catalog's clicks.log; after,
+    it is the clicks.log in clicks-<n>/, whose snapshot holds the click
+    models as of every batch logged before it.
+    """
+
+    def __init__(self, data_dir=DATA_DIR):
+        super().__init__("clicks.log", data_dir)
+        # catalog -> number of the snapshot whose log is being read
+        self._snapshots = {}
+
+    def path(self, name):
+        number = self._snapshots.get(name, 0)
+        if not number:
+            return super().path(name)
+        return os.path.join(self.data_dir, name, f"clicks-{number}", self.filename)
+
+    def snapshot_due(self, name):
+        try:
+            return os.path.getsize(self.path(name)) > CLICK_SNAPSHOT_BYTES
+        except OSError:
+            return False
+
+    def save_snapshot(self, name, states):
+        """Under locked(), with every batch applied: save the models' states in place of the log."""
+        number = save_clicks(os.path.join(self.data_dir, name), states)
+        with self._lock:
+            self._snapshots[name] = number
+            self._offsets[name] = 0
+
+    def read_snapshot(self, name):
+        """{model: state} of a snapshot newer than the log being read, whose log is read from then on; else None."""
+        directory = os.path.join(self.data_dir, name)
+        number = click_snapshot(directory)
+        with self._lock:
+            if number == self._snapshots.get(name, 0):
+                return None
+        try:
+            states = load_clicks(directory, number)
+        except PersistError as e:
+            if click_snapshot(directory) != number:
+                # Replaced while being read; the next sync loads the newer one
+                return None
+            print(f"Skipping click snapshot {number} of '{name}': {e}")
+            states = None
+        with self._lock:
+            self._snapshots[name] = number
+            self._offsets[name] = 0
+        return states
+
+
+class GenerationWatcher:
+    """Keeps this process in step with what other worker processes wrote to data_dir.
+
+    A catalog whose CURRENT generation moved is loaded and handed to
+    install(name, job_index). Otherwise changes new in the generation's log
+    are replayed on the installed JobIndex and changed(name) is called.
+    A new click snapshot goes to restore_clicks(name, states), and click
+    batches new in its log go to add_clicks(name, clicks).
+    """
+
+    def __init__(self, catalogs, positions, install, changed, add_clicks, restore_clicks, click_log,
+                 data_dir=DATA_DIR, interval=WATCH_INTERVAL):
+        self.catalogs = catalogs
+        self.install = install
+        self.changed = changed
+        self.add_clicks = add_clicks
+        self.restore_clicks = restore_clicks
+        self.click_log = click_log
+        self.data_dir = data_dir
+        self.interval = interval
+        # (generation, change log offset) each catalog was loaded up to, from load_catalogs()
+        self.positions = dict(positions)
+        self._lock = threading.Lock()
+        # A restored snapshot must not land between reading a batch and applying it
+        self._clicks_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.sync_all()
+            except Exception as e:
+                print(f"Syncing from {self.data_dir} failed: {e}")
+            time.sleep(self.interval)
+
+    def position(self, name):
+        with self._lock:
+            return self.positions.get(name)
+
+    def saved(self, name, position):
+        """Record a generation or change this process wrote itself, as (generation, offset)."""
+        with self._lock:
+            self.positions[name] = position
+
+    def sync(self, name):
+        directory = os.path.join(self.data_dir, name)
+        with self._lock:
+            generation = current_generation(directory)
+            position = self.positions.get(name)
+            if generation is not None and (position is None or generation != position[0]):
+                try:
+                    job_index, position = load_catalog(directory)
+                except PersistError as e:
+                    print(f"Not installing catalog '{name}' {generation}: {e}")
+                else:
+                    self.positions[name] = position
+                    self.install(name, job_index)
+                    print(f"Installed catalog '{name}' {generation}")
+            elif generation is not None and name in self.catalogs:
+                entries, offset = read_changes(directory, generation, position[1])
+                if entries:
+                    replay_changes(self.catalogs[name], entries)
+                    self.changed(name)
+                self.positions[name] = (generation, offset)
+        with self._clicks_lock:
+            states = self.click_log.read_snapshot(name)
+            if states is not None:
+                self.restore_clicks(name, states)
+            for clicks in self.click_log.read_new(name):
+                # The offset has moved past these already, so one bad batch must not cost the others
+                try:
+                    self.add_clicks(name, clicks)
+                except Exception as e:
+                    print(f"Skipping click batch for '{name}': {e}")
+
+    def sync_all(self):
+        names = set(self.catalogs)
+        if os.path.isdir(self.data_dir):
+            names.update(name for name in os.listdir(self.data_dir) if CATALOG_NAME.match(name))
+        for name in sorted(names):
+            self.sync(name)
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+# Days after which a click counts half as much towards a user's profile
+PROFILE_HALF_LIFE_DAYS = float(os.environ.get("RECOMMENDER_PROFILE_HALF_LIFE_DAYS", "14"))
+# Heaviest terms kept per profile; the tail is pruned once it grows to twice this
+PROFILE_MAX_TERMS = int(os.environ.get("RECOMMENDER_PROFILE_MAX_TERMS", "256"))
+# Most recently clicked jobs remembered per user, left out of their recommendations
+PROFILE_SEEN_JOBS = int(os.environ.get("RECOMMENDER_PROFILE_SEEN_JOBS", "200"))
+# Half-lives between the anchor and a click before all weights are rescaled
+REANCHOR_HALF_LIVES = 60
+
+
+class UserProfiles:
+    """Per-user TF-IDF profile: clicked jobs' vectors weighted by counter, decaying over time.
+
+    A click at time t adds counter * 2^((t - anchor) / half_life) times the
+    job's vector. Searches normalize the profile, so growing every new click
+    is the same as shrinking all older ones, and a click only touches its
+    job's terms instead of the whole profile. Profiles are kept by term
+    rather than vocabulary column, so they survive catalog refits.
+    """
+
+    def __init__(self, half_life_days=PROFILE_HALF_LIFE_DAYS, max_terms=PROFILE_MAX_TERMS, seen_jobs=PROFILE_SEEN_JOBS):
+        self.lock = threading.Lock()
+        self.half_life = half_life_days * 86400
+        self.max_terms = max_terms
+        self.seen_jobs = seen_jobs
+        self.version = 0
+        self.anchor = time.time()
+        self._profiles = {}
+        # user id -> {job id: None}, insertion ordered oldest first
+        self._seen = {}
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def _growth(self, at):
+        exponent = (at - self.anchor) / self.half_life
+        if exponent > REANCHOR_HALF_LIVES:
+            # Keep weights within float range: move the anchor up to this click
+            scale = 2.0 ** -exponent
+            for profile in self._profiles.values():
+                for term in profile:
+                    profile[term] *= scale
+            self.anchor = at
+            exponent = 0.0
+        return 2.0 ** exponent
+
+    def add_clicks(self, job_index, clicks):
+        """Fold {userId, jobId, counter, at} clicks into their users' profiles.
+
+        `at` is the click's unix time, defaulting to now. Clicks on jobs the
+        catalog doesn't have are skipped. Returns the number of profiles changed.
+        """
+        vectors = job_index.term_weights({click["jobId"] for click in clicks})
+        now = time.time()
+        changed = set()
+        with self.lock:
+            for click in clicks:
+                terms = vectors.get(click["jobId"])
+                if terms is None:
+                    continue
+                user_id = click["userId"]
+                weight = float(click.get("counter", 1) or 1) * self._growth(float(click.get("at") or now))
+                profile = self._profiles.setdefault(user_id, {})
+                for term, value in terms.items():
+                    profile[term] = profile.get(term, 0.0) + weight * value
+                if len(profile) > 2 * self.max_terms:
+                    kept = sorted(profile.items(), key=lambda item: -item[1])[:self.max_terms]
+                    self._profiles[user_id] = dict(kept)
+                seen = self._seen.setdefault(user_id, {})
+                seen.pop(click["jobId"], None)
+                seen[click["jobId"]] = None
+                if len(seen) > self.seen_jobs:
+                    del seen[next(iter(seen))]
+                changed.add(user_id)
+            if changed:
+                self.version += 1
+        return len(changed)
+
+    def snapshot(self):
+        """State restore() rebuilds the profiles from, as plain values."""
+        with self.lock:
+            return {
+                "anchor": self.anchor,
+                "profiles": [[user_id, dict(profile)] for user_id, profile in self._profiles.items()],
+                "seen": [[user_id, list(seen)] for user_id, seen in self._seen.items()],
+            }
+
+    def restore(self, state):
+        """Replace every profile with a snapshot() of them."""
+        with self.lock:
+            self.anchor = state["anchor"]
+            self._profiles = {user_id: dict(profile) for user_id, profile in state["profiles"]}
+            self._seen = {user_id: dict.fromkeys(job_ids) for user_id, job_ids in state["seen"]}
+            self.version += 1
+
+    def profile(self, user_id):
+        """{term: weight} of a user's profile, or None if they haven't clicked anything indexed."""
+        with self.lock:
+            profile = self._profiles.get(user_id)
+            return dict(profile) if profile is not None else None
+
+    def seen(self, user_id):
+        """Jobs the user clicked recently, most recent last."""
+        with self.lock:
+            return list(self._seen.get(user_id, ()))
+
+    def stats(self):
+        with self.lock:
+            terms = sum(len(profile) for profile in self._profiles.values())
+            return {
+                "users": len(self._profiles),
+                "averageTerms": round(terms / len(self._profiles), 1) if self._profiles else 0.0,
+                "halfLifeDays": round(self.half_life / 86400, 2),
+                "version": self.version,
+            }
+
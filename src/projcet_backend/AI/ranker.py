@@ -0,0 +1,222 @@
+import os
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+SIGNALS = ("content", "coclick", "popularity")
+# Default blend of the signals; requests can pass their own weights
+DEFAULT_WEIGHTS = {
+    "content": float(os.environ.get("RECOMMENDER_WEIGHT_CONTENT", "0.6")),
+    "coclick": float(os.environ.get("RECOMMENDER_WEIGHT_COCLICK", "0.3")),
+    "popularity": float(os.environ.get("RECOMMENDER_WEIGHT_POPULARITY", "0.1")),
+}
+# Candidates materialized per job, the most a hybrid request can page through
+RANKER_CANDIDATES = int(os.environ.get("RECOMMENDER_CANDIDATES", "100"))
+# Tables are checked for staleness this often even without a /jobs or /clicks nudge
+RANKER_REFRESH_SECONDS = float(os.environ.get("RECOMMENDER_REFRESH_SECONDS", "30"))
+# Minimum gap between rebuilds, so a burst of updates costs one rebuild
+RANKER_MIN_INTERVAL = float(os.environ.get("RECOMMENDER_MIN_REBUILD_INTERVAL", "2"))
+# Query jobs per index.search call while rebuilding
+RANKER_BATCH = 512
+# Default weight of diversity against relevance when re-ranking, 0 is off
+DEFAULT_DIVERSITY = float(os.environ.get("RECOMMENDER_DIVERSITY", "0"))
+# Candidates a diversified request over-fetches per result, and the most it
+# ever re-ranks. The pairwise similarities cost candidates^2, so this cap is
+# what keeps re-ranking under a millisecond at k = 50.
+MMR_OVERFETCH = int(os.environ.get("RECOMMENDER_MMR_OVERFETCH", "4"))
+MMR_MAX_CANDIDATES = int(os.environ.get("RECOMMENDER_MMR_MAX_CANDIDATES", "200"))
+
+
+class CandidateTable:
+    """One job's candidates with each raw signal, sorted by the default blend."""
+
+    __slots__ = ("job_ids", "signals", "available", "scores")
+
+    def __init__(self, job_ids, signals, available, weights):
+        self.available = available
+        scores = blend(signals, available, weights)
+        order = np.argsort(-scores, kind="stable")
+        self.job_ids = [job_ids[i] for i in order]
+        self.signals = signals[order]
+        self.scores = scores[order]
+
+
+def blend(signals, available, weights):
+    """Weighted average of the signals the query job actually has.
+
+    A job nobody has clicked yet is ranked on content alone instead of having
+    its scores scaled down by the unused co-click and popularity weights.
+    """
+    w = np.array([weights.get(signal, 0.0) for signal in SIGNALS], dtype="float32") * available
+    if w.sum() <= 0:
+        return np.zeros(len(signals), dtype="float32")
+    return signals @ (w / w.sum())
+
+
+def mmr_candidates(k):
+    """How many candidates to fetch for a diversified top-k."""
+    return max(k, min(MMR_OVERFETCH * k, MMR_MAX_CANDIDATES))
+
+
+def mmr(relevance, vectors, k, diversity):
+    """Positions of up to k candidates in maximal-marginal-relevance order.
+
+    Each pick maximizes (1 - diversity) * relevance - diversity * its highest
+    cosine similarity to the candidates already picked. `vectors` are the
+    candidates' unit vectors (sparse or dense): all pairwise similarities
+    come from one product, and each pick is one vectorized pass.
+    """
+    similarity = vectors @ vectors.T
+    similarity = similarity.toarray() if sparse.issparse(similarity) else np.asarray(similarity)
+    relevance = np.asarray(relevance, dtype="float32")
+    gain = (1 - diversity) * relevance
+    redundancy = np.zeros(len(relevance), dtype="float32")
+    picked = np.zeros(len(relevance), dtype=bool)
+    order = []
+    for _ in range(min(k, len(relevance))):
+        scores = gain - diversity * redundancy
+        scores[picked] = -np.inf
+        pick = int(np.argmax(scores))
+        order.append(pick)
+        picked[pick] = True
+        np.maximum(redundancy, similarity[pick], out=redundancy)
+    return order
+
+
+class HybridRanker:
+    """Blends content neighbours, co-click neighbours and popularity from precomputed tables.
+
+    A background thread rebuilds every job's CandidateTable whenever the
+    catalog or click model version moves, so a request is a dict lookup and
+    a slice (or an O(candidates) re-blend for custom weights). Content
+    neighbours only change with the catalog, so they are searched once per
+    catalog version; a click batch just re-blends them with the new
+    co-click neighbours and popularity.
+    """
+
+    def __init__(self, job_index, coclick, weights=None, candidates=RANKER_CANDIDATES):
+        self.job_index = job_index
+        self.coclick = coclick
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.candidates = candidates
+        self.tables = {}
+        self.built_versions = None
+        # job id -> content neighbours row, for the JobIndex and version they were searched on
+        self._content = {}
+        self._content_of = (None, None)
+        self.builds = 0
+        self.content_builds = 0
+        self.last_build_seconds = 0.0
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def mark_dirty(self):
+        """Ask the background thread for a rebuild soon."""
+        self._wake.set()
+
+    def retarget(self, job_index):
+        """Follow a catalog whose JobIndex was replaced by a new generation."""
+        self.job_index = job_index
+        self.mark_dirty()
+
+    def versions(self):
+        return self.job_index.version, self.coclick.version
+
+    def _run(self):
+        while True:
+            self._wake.wait(RANKER_REFRESH_SECONDS)
+            self._wake.clear()
+            if self.versions() != self.built_versions:
+                try:
+                    self.rebuild()
+                except Exception as e:
+                    print(f"Candidate table rebuild failed: {e}")
+            time.sleep(RANKER_MIN_INTERVAL)
+
+    def content_rows(self):
+        """Content neighbours of every job, searched again only when the catalog changed."""
+        job_index = self.job_index
+        with job_index.lock:
+            version = job_index.version
+            job_ids = list(job_index.jobs)
+        if self._content_of == (job_index, version):
+            return self._content
+        content = {}
+        for start in range(0, len(job_ids), RANKER_BATCH):
+            batch = job_ids[start:start + RANKER_BATCH]
+            found, vectors = job_index.vectors(batch)
+            rows = job_index.search(vectors, self.candidates + 1) if found else []
+            content.update(zip(found, rows))
+        self._content = content
+        self._content_of = (job_index, version)
+        self.content_builds += 1
+        return content
+
+    def rebuild(self):
+        """Recompute every job's table and swap them in at once."""
+        versions = self.versions()
+        started = time.perf_counter()
+        content = self.content_rows()
+        with self.job_index.lock:
+            job_ids = list(self.job_index.jobs)
+        popularity = self.coclick.popularity_scores()
+        tables = {job_id: self._table(job_id, content.get(job_id, []), popularity) for job_id in job_ids}
+        self.tables = tables
+        self.built_versions = versions
+        self.builds += 1
+        self.last_build_seconds = time.perf_counter() - started
+        print(f"Rebuilt candidate tables for {len(tables)} jobs in {self.last_build_seconds:.2f}s")
+
+    def _table(self, job_id, content_row, popularity):
+        coclick_row = self.coclick.neighbours(job_id, self.candidates)
+        rows = {}
+        for column, neighbours in enumerate((content_row, coclick_row)):
+            for other, score in neighbours:
+                if other != job_id:
+                    rows.setdefault(other, [0.0, 0.0, 0.0])[column] = score
+        job_ids = list(rows)
+        signals = np.array([rows[other] for other in job_ids], dtype="float32").reshape(-1, len(SIGNALS))
+        signals[:, 2] = [popularity.get(other, 0.0) for other in job_ids]
+        available = np.array([bool(content_row), bool(coclick_row), bool(popularity)], dtype="float32")
+        return CandidateTable(job_ids, signals, available, self.weights)
+
+    def rank(self, job_id, k, weights=None):
+        """Top-k (job_id, blended score) for a job, or None if it isn't in the catalog."""
+        if job_id not in self.job_index.jobs:
+            return None
+        table = self.tables.get(job_id)
+        if table is None:
+            # Added since the last rebuild: build just this table on the spot
+            found, vectors = self.job_index.vectors([job_id])
+            if not found:
+                return None
+            content_row = self.job_index.search(vectors, self.candidates + 1)[0]
+            table = self._table(job_id, content_row, self.coclick.popularity_scores())
+            self.tables[job_id] = table
+        if weights is None:
+            return list(zip(table.job_ids[:k], table.scores[:k].tolist()))
+        scores = blend(table.signals, table.available, dict(self.weights, **weights))
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(table.job_ids[i], float(scores[i])) for i in top]
+
+    def stats(self):
+        return {
+            "tables": len(self.tables),
+            "builds": self.builds,
+            "contentBuilds": self.content_builds,
+            "lastBuildSeconds": round(self.last_build_seconds, 3),
+            "stale": self.versions() != self.built_versions,
+            "weights": self.weights,
+        }
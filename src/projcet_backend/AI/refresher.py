@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+
+import requests
+
+from catalog import JobIndex, check_jobs
+from persist import try_lock
+
+BACKEND_CANISTER_ID = os.environ.get("BACKEND_CANISTER_ID", "kke3h-myaaa-aaaal-qsssq-cai")
+# Where the live job list comes from; empty disables the refresher
+JOBS_URL = os.environ.get("RECOMMENDER_JOBS_URL", f"https://{BACKEND_CANISTER_ID}.raw.icp0.io/getAllJobs")
+# Catalog the canister's jobs are loaded into
+REFRESH_CATALOG = os.environ.get("RECOMMENDER_REFRESH_CATALOG", "default")
+# Seconds between pulls, 0 disables the refresher
+REFRESH_INTERVAL = float(os.environ.get("RECOMMENDER_REFRESH_INTERVAL", "300"))
+REFRESH_TIMEOUT = 15
+# Past this share of the catalog changing, a fresh index is built on the side
+# and swapped in instead of updating the live one job by job
+REBUILD_FRACTION = float(os.environ.get("RECOMMENDER_REBUILD_FRACTION", "0.3"))
+
+
+def diff_jobs(current, fetched):
+    """(jobs to upsert, ids to remove) turning `current` ({id: job}) into the `fetched` list."""
+    fetched_ids = set()
+    changed = []
+    for job in fetched:
+        fetched_ids.add(job["id"])
+        existing = current.get(job["id"])
+        if existing is None:
+            changed.append(job)
+        elif job.get("updatedAt") is not None:
+            if existing.get("updatedAt") != job["updatedAt"]:
+                changed.append(job)
+        elif existing != job:
+            changed.append(job)
+    removed = [job_id for job_id in current if job_id not in fetched_ids]
+    return changed, removed
+
+
+class CatalogRefresher:
+    """Pulls the canister's /getAllJobs on a schedule and applies the difference to a catalog.
+
+    Everything happens on a background thread, so requests never wait on the
+    canister. Small diffs go through JobIndex.upsert/remove, which apply under
+    the index lock; large ones build a whole new JobIndex next to the live one
+    and hand it to `install(name, job_index)` to swap in. Changes are made
+    inside `updating(name)`, which saves them for the other workers.
+
+    Only one process polls: the one holding the "refresher" lock in the
+    data directory. The others keep trying in case it goes away.
+    """
+
+    def __init__(self, catalogs, install, updating, name=REFRESH_CATALOG, url=JOBS_URL, interval=REFRESH_INTERVAL):
+        self.catalogs = catalogs
+        self.install = install
+        self.updating = updating
+        self.name = name
+        self.url = url
+        self.interval = interval
+        self.refreshes = 0
+        self.failures = 0
+        self.swaps = 0
+        self.last_refresh_at = None
+        self.last_error = None
+        self.last_diff = {"upserted": 0, "removed": 0}
+        self._leader = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.url and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            if self._leader is None:
+                self._leader = try_lock("refresher")
+            if self._leader is None:
+                time.sleep(self.interval)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                self.failures += 1
+                self.last_error = str(e)
+                print(f"Refreshing catalog '{self.name}' from {self.url} failed: {e}")
+            time.sleep(self.interval)
+
+    def fetch(self):
+        resp = requests.get(self.url, timeout=REFRESH_TIMEOUT)
+        resp.raise_for_status()
+        jobs = resp.json()
+        if not isinstance(jobs, list):
+            raise ValueError("expected a JSON list of jobs")
+        check_jobs(jobs)
+        return jobs
+
+    def refresh(self):
+        jobs = self.fetch()
+        with self.updating(self.name):
+            current = self.catalogs.get(self.name)
+            if current is None:
+                changed, removed = jobs, []
+            else:
+                with current.lock:
+                    snapshot = dict(current.jobs)
+                changed, removed = diff_jobs(snapshot, jobs)
+
+            if current is None or len(changed) + len(removed) > REBUILD_FRACTION * max(1, len(current)):
+                self.install(self.name, JobIndex(jobs))
+                self.swaps += 1
+            elif changed or removed:
+                current.upsert(changed)
+                current.remove(removed)
+
+        self.refreshes += 1
+        self.last_refresh_at = time.time()
+        self.last_error = None
+        self.last_diff = {"upserted": len(changed), "removed": len(removed)}
+        if changed or removed:
+            print(f"Refreshed catalog '{self.name}': {len(changed)} upserted, {len(removed)} removed")
+
+    def stats(self):
+        return {
+            "enabled": self._thread is not None,
+            "leader": self._leader is not None,
+            "catalog": self.name,
+            "url": self.url,
+            "intervalSeconds": self.interval,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "swaps": self.swaps,
+            "lastRefreshAt": self.last_refresh_at,
+            "lastError": self.last_error,
+            "lastDiff": self.last_diff,
+        }
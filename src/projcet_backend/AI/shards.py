@@ -0,0 +1,340 @@
+"""Sharded sparse index: a catalog's rows split by hash across local processes.
+
+RECOMMENDER_INDEX=sharded moves only the scoring matrix, the index's own
+copy of the rows, into RECOMMENDER_SHARDS shard processes. Each holds a
+SparseIndex over the rows whose faiss id hashes to it. Everything else
+JobIndex owns stays in the serving process, which coordinates: the
+vocabulary, the filters, and every stored vector, which vectors(), MMR
+and index rebuilds read. The serving process therefore shrinks by the
+index's indexBytes and no more; the rows are held twice with or without
+shards, and every worker has shards of its own. What sharding buys is
+searches scored on several cores, not a smaller catalog footprint.
+
+A search sends the query vectors to every shard at once, each scores its
+rows in parallel on its own core, and the per-shard top k are merged. Shards
+score the coordinator's vectors exactly as one SparseIndex would and break
+ties by id the same way, so the merged results are identical to an
+unsharded sparse index over all the rows.
+
+Shards are `python shards.py <fd>` children talking over a socket pair,
+started on first use and shared by every sharded index in the process.
+They exit when the coordinator goes away. Requests carry an id, so any
+number of request threads can have them in flight on a shard at once; the
+shard works through them in the order they arrived. A shard that dies is
+started again empty, and each index refills it from its owner's rows
+before its next call.
+"""
+import itertools
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from multiprocessing.connection import Connection
+
+import numpy as np
+from scipy import sparse
+
+from indexes import TOMBSTONE_REBUILD_RATIO, SparseIndex
+
+# Serving processes on the machine, each starting its own shards; gunicorn.conf.py sets it
+WORKERS = max(1, int(os.environ.get("RECOMMENDER_WORKERS", "1")))
+# Shard processes per serving process, one core each; by default the
+# machine's cores are split between the serving processes
+SHARDS = int(os.environ.get("RECOMMENDER_SHARDS", "0")) or max(1, (os.cpu_count() or 1) // WORKERS)
+
+
+def shard_of(ids, n_shards):
+    """Shard of each faiss id, by a multiplicative hash so runs of ids spread evenly."""
+    mixed = np.asarray(ids, dtype="uint64") * np.uint64(0x9E3779B97F4A7C15)
+    return ((mixed >> np.uint64(32)) % np.uint64(n_shards)).astype("int64")
+
+
+class ShardPool:
+    """The shard processes, and requests to them pipelined over one connection each.
+
+    Requests are sent tagged with an id under their shard's send lock, and
+    a reader thread per shard hands each reply to whoever is waiting on
+    that id, so concurrent calls never wait on each other's round trips.
+
+    A shard process that exits fails the requests in flight on it and is
+    started again, empty, with its epoch bumped; ShardedIndex sees the new
+    epoch and has its owner send that shard's rows again.
+    """
+
+    def __init__(self, n_shards=SHARDS):
+        self._connections = [None] * n_shards
+        self._processes = [None] * n_shards
+        self._send_locks = [threading.Lock() for _ in range(n_shards)]
+        # Times each shard's process was started
+        self.epochs = [0] * n_shards
+        self.restarts = 0
+        self._dropped = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        # request id -> (shard, Future of its (status, reply))
+        self._pending = {}
+        for shard in range(n_shards):
+            self._spawn(shard)
+        print(f"Started {n_shards} index shard processes")
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _spawn(self, shard):
+        parent, child = socket.socketpair()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(child.fileno())],
+            pass_fds=(child.fileno(),),
+        )
+        child.close()
+        connection = Connection(parent.detach())
+        with self._lock:
+            self._processes[shard] = process
+            self._connections[shard] = connection
+            self.epochs[shard] += 1
+        threading.Thread(target=self._read, args=(shard, connection), daemon=True).start()
+
+    def drop(self, handle):
+        """Forget an index; sent along with the next call, as this may run inside one."""
+        self._dropped.append(handle)
+
+    def call(self, requests):
+        """Send requests[i], an (op, handle, args) tuple or None, to shard i all at once, then collect the replies."""
+        while self._dropped:
+            try:
+                handle = self._dropped.pop()
+            except IndexError:
+                break
+            # Nobody waits for these; their replies are discarded
+            for shard in range(len(self)):
+                self._send(shard, ("drop", handle, ()), reply=False)
+        futures = [
+            self._send(shard, request) if request is not None else None
+            for shard, request in enumerate(requests)
+        ]
+        replies = []
+        errors = []
+        for shard, future in enumerate(futures):
+            if future is None:
+                replies.append(None)
+                continue
+            status, reply = future.result()
+            if status == "error":
+                errors.append(f"shard {shard}: {reply}")
+            replies.append(reply)
+        if errors:
+            raise RuntimeError(f"Index shards failed: {'; '.join(errors)}")
+        return replies
+
+    def _send(self, shard, request, reply=True):
+        """Future of the shard's (status, reply) to `request`, or None if `reply` is False."""
+        request_id = next(self._ids)
+        future = Future() if reply else None
+        with self._lock:
+            # Taken with the registration, so an exit either fails this request or is already past
+            connection = self._connections[shard]
+            if future is not None:
+                self._pending[request_id] = (shard, future)
+        try:
+            with self._send_locks[shard]:
+                connection.send((request_id, *request))
+        except Exception as e:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            if not isinstance(e, OSError):
+                raise
+            # The reader sees the shard exit and fails everything else in flight
+            if future is not None and not future.done():
+                future.set_result(("error", "process exited"))
+        return future
+
+    def _read(self, shard, connection):
+        while True:
+            try:
+                request_id, status, reply = connection.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                _, future = self._pending.pop(request_id, (None, None))
+            if future is not None:
+                future.set_result((status, reply))
+        with self._lock:
+            lost = [request_id for request_id, (owner, _) in self._pending.items() if owner == shard]
+            futures = [self._pending.pop(request_id)[1] for request_id in lost]
+            process = self._processes[shard]
+        for future in futures:
+            future.set_result(("error", "process exited"))
+        connection.close()
+        try:
+            code = process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            code = process.wait()
+        if code == 0:
+            # A clean exit means this process is shutting down
+            return
+        print(f"Index shard {shard} exited with code {code}, restarting it")
+        # Paced, so a shard that can't start doesn't spin
+        time.sleep(1)
+        self.restarts += 1
+        self._spawn(shard)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_handles = itertools.count()
+
+
+def shard_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ShardPool()
+        return _pool
+
+
+class ShardedIndex:
+    """The SparseIndex interface over rows spread across the shard processes."""
+
+    kind = "sharded"
+
+    def __init__(self, dim, pool=None):
+        self.dim = dim
+        self.pool = pool if pool is not None else shard_pool()
+        self.handle = next(_handles)
+        self._added = 0
+        self._live = 0
+        # Called with this index to send every live row through reload() after a shard restarts;
+        # set by whoever holds the rows, without it a restarted shard stays empty
+        self.source = None
+        self._epochs = list(self.pool.epochs)
+        self.pool.call([("create", self.handle, (dim,))] * len(self.pool))
+        weakref.finalize(self, self.pool.drop, self.handle)
+
+    @property
+    def ntotal(self):
+        return self._live
+
+    def _stale(self):
+        """Shards restarted since they last had this index's rows."""
+        return [shard for shard, epoch in enumerate(self.pool.epochs) if epoch != self._epochs[shard]]
+
+    def _recover(self):
+        if self.source is not None and self._stale():
+            self.source(self)
+
+    def reload(self, ids, rows):
+        """Send the live rows, with their faiss ids, to every restarted shard."""
+        epochs = list(self.pool.epochs)
+        stale = {shard for shard in range(len(self.pool)) if epochs[shard] != self._epochs[shard]}
+        if not stale:
+            return
+        ids = np.asarray(ids, dtype="int64")
+        rows = sparse.csr_matrix(rows, dtype="float32")
+        self.pool.call([("create", self.handle, (self.dim,)) if shard in stale else None for shard in range(len(self.pool))])
+        self.pool.call([
+            ("add", self.handle, (ids[positions], rows[positions])) if shard in stale and len(positions) else None
+            for shard, positions in enumerate(self._split(ids))
+        ])
+        for shard in stale:
+            self._epochs[shard] = epochs[shard]
+        print(f"Reloaded {len(ids)} rows of sharded index {self.handle} on restarted shards {sorted(stale)}")
+
+    def _split(self, ids):
+        """Per shard, the positions of `ids` that live there."""
+        shards = shard_of(ids, len(self.pool))
+        return [np.flatnonzero(shards == shard) for shard in range(len(self.pool))]
+
+    def add(self, ids, rows):
+        self._recover()
+        ids = np.asarray(ids, dtype="int64")
+        rows = sparse.csr_matrix(rows, dtype="float32")
+        self.pool.call([
+            ("add", self.handle, (ids[positions], rows[positions])) if len(positions) else None
+            for positions in self._split(ids)
+        ])
+        self._added += len(ids)
+        self._live += len(ids)
+
+    def remove(self, ids):
+        self._recover()
+        ids = np.asarray(ids, dtype="int64")
+        if not len(ids):
+            return
+        removed = self.pool.call([
+            ("remove", self.handle, (ids[positions],)) if len(positions) else None
+            for positions in self._split(ids)
+        ])
+        self._live -= sum(count for count in removed if count is not None)
+
+    def needs_rebuild(self):
+        dead = self._added - self._live
+        return dead > TOMBSTONE_REBUILD_RATIO * max(1, self._added)
+
+    def memory_bytes(self):
+        self._recover()
+        return int(sum(self.pool.call([("bytes", self.handle, ())] * len(self.pool))))
+
+    def search(self, queries, k, ids=None):
+        """Per query row, up to k (id, cosine similarity) pairs, best first; see SparseIndex.search."""
+        self._recover()
+        queries = sparse.csr_matrix(queries, dtype="float32")
+        if ids is None:
+            requests = [("search", self.handle, (queries, k, None))] * len(self.pool)
+        else:
+            ids = np.asarray(ids, dtype="int64")
+            requests = [
+                ("search", self.handle, (queries, k, ids[positions])) if len(positions) else None
+                for positions in self._split(ids)
+            ]
+        shard_rows = [rows for rows in self.pool.call(requests) if rows is not None]
+        results = []
+        for row in range(queries.shape[0]):
+            merged = [pair for rows in shard_rows for pair in rows[row]]
+            merged.sort(key=lambda pair: (-pair[1], pair[0]))
+            results.append(merged[:k])
+        return results
+
+
+def serve(connection):
+    """A shard's loop: SparseIndexes by handle, changed and searched on request."""
+    indexes = {}
+    while True:
+        try:
+            request_id, op, handle, args = connection.recv()
+        except EOFError:
+            return
+        try:
+            reply = None
+            if op == "create":
+                indexes[handle] = SparseIndex(*args)
+            elif op == "drop":
+                indexes.pop(handle, None)
+            elif op == "add":
+                indexes[handle].add(*args)
+            elif op == "remove":
+                index = indexes[handle]
+                before = index.ntotal
+                index.remove(*args)
+                reply = before - index.ntotal
+            elif op == "search":
+                reply = indexes[handle].search(*args)
+            elif op == "bytes":
+                reply = indexes[handle].memory_bytes()
+            else:
+                raise ValueError(f"unknown operation '{op}'")
+        except Exception as e:
+            connection.send((request_id, "error", f"{type(e).__name__}: {e}"))
+        else:
+            connection.send((request_id, "ok", reply))
+
+
+if __name__ == "__main__":
+    # Ctrl-C is for the coordinator; shards stop when their socket closes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    serve(Connection(int(sys.argv[1])))
@@ -0,0 +1,226 @@
+"""Typeahead over a catalog's category names and required skills, for /typeahead.
+
+Names come from the jobs' tags and jobRequirementSkills, plus categories
+registered through /typeahead/categories before any job uses them. A
+name's popularity is the number of jobs carrying it.
+
+Each PrefixIndex is a sorted array of keys: every name once from the
+start and once from each later word, so "rea" finds "Frontend React".
+A prefix is the range of keys between two binary searches, and
+suggestions are the most popular names in that range. Ranges of very
+short prefixes are too long to rank per request, so their top names are
+worked out when the index is built.
+"""
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+
+from catalog import job_categories
+from persist import WATCH_INTERVAL
+
+# Most suggestions a request gets
+TYPEAHEAD_MAX = int(os.environ.get("RECOMMENDER_TYPEAHEAD_MAX", "20"))
+# Prefixes up to this long have their suggestions precomputed
+SHORT_PREFIX = 2
+KINDS = ("category", "skill")
+# Where a new word starts inside a name
+WORD_START = re.compile(r"(?<=[\s/&,.+_-])\w")
+
+
+def normalized_name(name):
+    return " ".join(str(name).casefold().split())
+
+
+class PrefixIndex:
+    """Immutable sorted-array index of names ranked by popularity; rebuilt whole on change."""
+
+    def __init__(self, names, popularity):
+        """`names`: display names; `popularity`: jobs per name, same order."""
+        self.names = list(names)
+        self.popularity = np.asarray(popularity, dtype="int64")
+        normalized = [normalized_name(name) for name in self.names]
+        # Most popular first, then shorter, then alphabetical
+        order = sorted(range(len(self.names)), key=lambda i: (-self.popularity[i], len(normalized[i]), normalized[i]))
+        self.rank = np.empty(len(self.names), dtype="int64")
+        self.rank[order] = np.arange(len(self.names))
+        self.by_rank = np.array(order, dtype="int64")
+
+        keys = []
+        for i, name in enumerate(normalized):
+            keys.append((name, i))
+            keys += [(name[match.start():], i) for match in WORD_START.finditer(name)]
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.ids = np.array([i for _, i in keys], dtype="int64")
+
+        self.short = {}
+        for key in self.keys:
+            for length in range(1, min(SHORT_PREFIX, len(key)) + 1):
+                prefix = key[:length]
+                if prefix not in self.short:
+                    self.short[prefix] = self._rank_range(prefix, TYPEAHEAD_MAX)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _range(self, prefix):
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + "\U0010ffff")
+
+    def _rank_range(self, prefix, k):
+        start, end = self._range(prefix)
+        ranks = np.unique(self.rank[self.ids[start:end]])
+        return self.by_rank[ranks[:k]]
+
+    def suggest(self, prefix, k):
+        """Up to k (name, popularity) pairs for names with a word starting with `prefix`."""
+        prefix = normalized_name(prefix)
+        if not prefix:
+            ids = self.by_rank[:k]
+        elif len(prefix) <= SHORT_PREFIX:
+            ids = self.short.get(prefix, self.by_rank[:0])[:k]
+        else:
+            ids = self._rank_range(prefix, k)
+        return [(self.names[i], int(self.popularity[i])) for i in ids.tolist()]
+
+
+class Typeahead:
+    """PrefixIndexes of one catalog's names, per kind and combined, kept in step with its JobIndex.
+
+    A background thread follows the catalog's version and the catalog's log
+    of created categories (a persist.JsonLog), counting only the jobs that
+    changed, and swaps in new indexes when any name or count moved.
+    """
+
+    def __init__(self, name, job_index, created_log):
+        self.name = name
+        self.job_index = job_index
+        self.created_log = created_log
+        self.lock = threading.Lock()
+        self.indexes = {kind: PrefixIndex([], []) for kind in (*KINDS, "all")}
+        self.synced_version = None
+        self.syncs = 0
+        self.last_sync_seconds = 0.0
+        # (kind, normalized name) -> jobs carrying it
+        self._counts = Counter()
+        self._display = {}
+        self._created = set()
+        self._jobs = {}
+        self._job_names = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def mark_dirty(self):
+        self._wake.set()
+
+    def retarget(self, job_index):
+        """Follow a catalog whose JobIndex was replaced by a new generation."""
+        self.job_index = job_index
+        self.mark_dirty()
+
+    def _run(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Typeahead sync for '{self.name}' failed: {e}")
+            # Short, so categories created through another worker show up quickly
+            self._wake.wait(WATCH_INTERVAL)
+            self._wake.clear()
+
+    def _names(self, job):
+        names = {("category", name) for name in job_categories(job)}
+        names.update(("skill", skill) for skill in job.get("jobRequirementSkills", []) or [])
+        return {(kind, str(name).strip()) for kind, name in names if str(name).strip()}
+
+    def sync(self):
+        job_index = self.job_index
+        created = [name for entry in self.created_log.read_new(self.name) for name in entry]
+        if job_index.version == self.synced_version and not created:
+            return
+        started = time.perf_counter()
+        with job_index.lock:
+            version = job_index.version
+            jobs = dict(job_index.jobs)
+
+        changed = False
+        for name in created:
+            key = normalized_name(name)
+            if key and key not in self._created:
+                self._created.add(key)
+                self._display.setdefault(("category", key), str(name).strip())
+                changed = True
+        for job_id in [job_id for job_id in self._jobs if job_id not in jobs]:
+            del self._jobs[job_id]
+            self._counts.subtract(self._job_names.pop(job_id, ()))
+            changed = True
+        for job_id, job in jobs.items():
+            # Upserted jobs are new objects; unchanged ones are skipped without a look
+            if self._jobs.get(job_id) is job:
+                continue
+            self._jobs[job_id] = job
+            names = {}
+            for kind, name in self._names(job):
+                names.setdefault((kind, normalized_name(name)), name)
+            for key, name in names.items():
+                self._display.setdefault(key, name)
+            if set(names) != set(self._job_names.get(job_id, ())):
+                self._counts.subtract(self._job_names.get(job_id, ()))
+                self._counts.update(list(names))
+                self._job_names[job_id] = list(names)
+                changed = True
+
+        if changed:
+            indexes = self._build()
+            with self.lock:
+                self.indexes = indexes
+        self.synced_version = version
+        self.syncs += 1
+        self.last_sync_seconds = time.perf_counter() - started
+
+    def _build(self):
+        self._counts = +self._counts
+        for key in list(self._display):
+            if key not in self._counts and not (key[0] == "category" and key[1] in self._created):
+                del self._display[key]
+        per_kind = {kind: {} for kind in KINDS}
+        for kind, key in self._display:
+            per_kind[kind][key] = self._counts.get((kind, key), 0)
+        indexes = {}
+        for kind, counts in per_kind.items():
+            indexes[kind] = PrefixIndex([self._display[(kind, key)] for key in counts], list(counts.values()))
+        # Combined, a name counts every job carrying it under either kind
+        combined = {}
+        for kind, counts in per_kind.items():
+            for key, count in counts.items():
+                if key not in combined:
+                    combined[key] = [self._display[(kind, key)], 0]
+                combined[key][1] += count
+        indexes["all"] = PrefixIndex([name for name, _ in combined.values()], [count for _, count in combined.values()])
+        return indexes
+
+    def suggest(self, prefix, k, kind=None):
+        with self.lock:
+            index = self.indexes[kind or "all"]
+        return index.suggest(prefix, k)
+
+    def stats(self):
+        with self.lock:
+            sizes = {kind: len(index) for kind, index in self.indexes.items()}
+        return {
+            **{f"{kind}Names": sizes[kind] for kind in KINDS},
+            "created": len(self._created),
+            "syncs": self.syncs,
+            "lastSyncSeconds": round(self.last_sync_seconds, 3),
+            "stale": self.job_index.version != self.synced_version,
+        }
@@ -31,6 +31,7 @@ const FaceRecognition: React.FC<FaceRecognitionProps> = ({
   purpose, // Destructure the new prop
 }) => {
   const webcamRef = useRef<Webcam>(null);
+  const captureAbortRef = useRef<AbortController | null>(null);
   const [isCapturing, setIsCapturing] = useState(false);
   const [mode, setMode] = useState<"register" | "verify" | "loading">("loading");
   const [captureCount, setCaptureCount] = useState(0);
@@ -107,6 +108,8 @@ const FaceRecognition: React.FC<FaceRecognitionProps> = ({
       setCaptureCount(0);
       setRegistrationStatus("idle");
     }
+    // Closing the modal aborts any in-flight capture so the server can drop the job
+    return () => captureAbortRef.current?.abort();
   }, [isOpen]);
 
   const capture = async () => {
@@ -152,9 +155,11 @@ const FaceRecognition: React.FC<FaceRecognitionProps> = ({
       console.log("🔍 [FACE RECOG CAPTURE DEBUG] - Is HTTPS page with HTTP API?", window.location.protocol === 'https:' && serviceUrl.startsWith('http://'));
       console.log("🔍 [FACE RECOG CAPTURE DEBUG] Attempting to connect to face recognition service for capture:", serviceUrl);
       
-  const response = await fetch(serviceUrl, {
+      captureAbortRef.current = new AbortController();
+      const response = await fetch(serviceUrl, {
         method: "POST",
         body: formData,
+        signal: captureAbortRef.current.signal,
         headers: {
           Accept: "application/json",
         },
@@ -162,6 +167,15 @@ const FaceRecognition: React.FC<FaceRecognitionProps> = ({
       });
       console.log("Face recognition capture response status:", response.status);
 
+      if (response.status === 429 || response.status === 503) {
+        const retryAfter = response.headers.get("Retry-After") || "a few";
+        throw new Error(`Face service is busy, please try again in ${retryAfter} seconds`);
+      }
+
+      if (response.status === 409) {
+        throw new Error("This face is already registered to another account");
+      }
+
       if (!response.ok) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
@@ -209,6 +223,9 @@ const FaceRecognition: React.FC<FaceRecognitionProps> = ({
         onError(result.message || "Failed to process request");
       }
     } catch (error) {
+      if (error instanceof DOMException && error.name === "AbortError") {
+        return;
+      }
       console.error("Error in capture:", error);
       setRegistrationStatus("error");
       onError(
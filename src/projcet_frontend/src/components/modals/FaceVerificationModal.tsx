@@ -11,6 +11,7 @@ import { loginWithInternetIdentity } from '../../controller/userController';
 export function FaceVerificationModal({ parentIndex, index }: { parentIndex: number, index: number }) {
   const { closeModal } = useModal();
   const webcamRef = useRef<Webcam>(null);
+  const verifyAbortRef = useRef<AbortController | null>(null);
   const [isCapturing, setIsCapturing] = useState(false);
   const navigate = useNavigate();
 
@@ -52,9 +53,11 @@ export function FaceVerificationModal({ parentIndex, index }: { parentIndex: num
       console.log('🔍 [FACE VERIFY DEBUG] - Face verify URL:', apiUrl);
       console.log('🔍 [FACE VERIFY DEBUG] - Is HTTPS page with HTTP API?', window.location.protocol === 'https:' && apiUrl.startsWith('http://'));
 
+      verifyAbortRef.current = new AbortController();
       const response = await fetch(apiUrl, {
         method: 'POST',
         body: formData,
+        signal: verifyAbortRef.current.signal,
         headers: {
           'Accept': 'application/json',
         },
@@ -82,6 +85,9 @@ export function FaceVerificationModal({ parentIndex, index }: { parentIndex: num
         throw new Error(result.message || 'Verification failed');
       }
     } catch (error) {
+      if (error instanceof DOMException && error.name === 'AbortError') {
+        return;
+      }
       console.error('Error in face verification:', error);
 
     } finally {
@@ -135,7 +141,11 @@ export function FaceVerificationModal({ parentIndex, index }: { parentIndex: num
 
           <ModalFooter className="flex items-center justify-center mt-2 p-0">
             <div
-              onClick={() => closeModal(index, parentIndex)}
+              onClick={() => {
+                // Abort an in-flight verification so the server can drop the job
+                verifyAbortRef.current?.abort();
+                closeModal(index, parentIndex);
+              }}
               className="w-full h-full text-lg text-center font-semibold rounded-b-2xl border-b border-b-[#112D4E] text-black transition-colors hover:text-white hover:bg-[#D9534F] hover:border-[#D9534F] py-4"
             >
               Cancel